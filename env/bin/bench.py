@@ -0,0 +1,384 @@
+"""
+Benchmark harness: starts local shard servers and bootstrap server like test_env.py,
+drives configurable workload and reports throughput and latency as json.
+
+Usage (from repository root):
+
+    python env/bin/bench.py --shards 4 --workers 8 --ops 20000 --read-ratio 0.9 \\
+        --skew 1.1 --doc-size 256 --output bench.json
+    python env/bin/bench.py ... --baseline bench.json --tolerance 0.1
+
+Targets:
+    e2e - Pyshard read/write/scan
+    shard - ShardClient read/write against single shard
+    master - MasterClient.get_shard against bootstrap server
+    import - `from pyshard import Pyshard` time in fresh interpreters (--import-runs), no servers
+
+Writes always go to new keys (storage doesn't overwrite existing ones),
+key skew applies to reads. Batch size is the page size of scan operations.
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import random
+import argparse
+import bisect
+import subprocess
+import tempfile
+import threading
+from itertools import accumulate
+
+import test_env
+
+from pyshard import Pyshard, MasterClient
+from pyshard.shard.client import ShardClient
+
+
+BENCH_INDEX = 'bench'
+BASE_PORT = 6050
+BOOTSTRAP_PORT = 9292
+HOST = '127.0.0.1'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', choices=('e2e', 'shard', 'master', 'import'), default='e2e')
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--shard-size', type=int, default=1024 ** 3, help='shard memory limit, bytes')
+    parser.add_argument('--keys', type=int, default=10000, help='preloaded key space')
+    parser.add_argument('--ops', type=int, default=10000, help='total measured operations')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--scan-ratio', type=float, default=0.0)
+    parser.add_argument('--batch-size', type=int, default=100, help='scan page size')
+    parser.add_argument('--skew', type=float, default=0.0, help='zipf exponent of reads, 0 is uniform')
+    parser.add_argument('--doc-size', type=int, default=128, help='document size, bytes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, help='json report path, stdout if not set')
+    parser.add_argument('--baseline', type=str, help='json report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative throughput drop and latency growth')
+    parser.add_argument('--log-level', type=str, default='WARNING', help='servers log level')
+    parser.add_argument('--storage', choices=('memory', 'sorted'), default='memory', help='shards storage')
+    parser.add_argument('--import-runs', type=int, default=20, help='interpreters started by import target')
+    parser.add_argument('--import-statement', type=str, default='from pyshard import Pyshard')
+
+    return parser.parse_args(argv)
+
+
+def write_config(path, shards_num, shard_size):
+    step = 1.0 / shards_num
+    shards = []
+    for i in range(shards_num):
+        shards.append({
+            'name': f'bench{i}',
+            'start': round(i * step, 7),
+            'end': 1.0 if i == shards_num - 1 else round((i + 1) * step, 7),
+            'size': shard_size,
+            'host': HOST,
+            'port': BASE_PORT + i
+        })
+    config = {'shards': shards, 'bootstrap': {'host': HOST, 'port': BOOTSTRAP_PORT}}
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+    return config
+
+
+class Env:
+    def __init__(self, args):
+        self._args = args
+        self._pids = []
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def __enter__(self):
+        os.environ['PYSHARD_LOG_LEVEL'] = self._args.log_level
+        os.environ['PYSHARD_STORAGE'] = self._args.storage
+        config_path = os.path.join(self._tmpdir.name, 'bench_config.json')
+        config = write_config(config_path, self._args.shards, self._args.shard_size)
+        self._pids.extend(test_env.run_shard_servers(config['shards']))
+        _wait_for_ports([(shard['host'], shard['port']) for shard in config['shards']])
+        self._pids.append(test_env.run_bootstrap_server(config['bootstrap'], config_path))
+        _wait_for_ports([(HOST, BOOTSTRAP_PORT)])
+        self.config = config
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for pid in self._pids:
+            try:
+                os.kill(pid, 2)
+            except ProcessLookupError:
+                pass
+        self._tmpdir.cleanup()
+
+
+def _wait_for_ports(addrs, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    for addr in addrs:
+        while True:
+            try:
+                socket.create_connection(addr, timeout=1.0).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Server {addr} did not start')
+                time.sleep(0.05)
+
+
+class KeySampler:
+    def __init__(self, keys_num, skew, rnd):
+        self._keys_num = keys_num
+        self._rnd = rnd
+        self._cum_weights = None
+        if skew > 0:
+            self._cum_weights = list(accumulate(1.0 / (rank ** skew) for rank in range(1, keys_num + 1)))
+
+    def __call__(self):
+        if self._cum_weights is None:
+            return self._rnd.randrange(self._keys_num)
+        point = self._rnd.random() * self._cum_weights[-1]
+        return bisect.bisect_left(self._cum_weights, point)
+
+
+def _key(n):
+    return f'key{n}'
+
+
+class Workload:
+    def __init__(self, args, worker_id):
+        self._args = args
+        self._worker_id = worker_id
+        self._rnd = random.Random(args.seed + worker_id)
+        self._sample = KeySampler(args.keys, args.skew, self._rnd)
+        self._written = 0
+
+    def next_op(self):
+        point = self._rnd.random()
+        if point < self._args.scan_ratio:
+            return 'scan', None
+        if point < self._args.scan_ratio + self._args.read_ratio:
+            return 'read', _key(self._sample())
+        self._written += 1
+        return 'write', f'w{self._worker_id}-{self._written}'
+
+
+class E2EClient:
+    def __init__(self, args, env):
+        self._app = Pyshard(bootstrap_server=[HOST, BOOTSTRAP_PORT])
+        self._doc = 'x' * args.doc_size
+        self._batch_size = args.batch_size
+
+    def read(self, key):
+        return self._app.read(BENCH_INDEX, key)
+
+    def write(self, key):
+        return self._app.write(BENCH_INDEX, key, self._doc)
+
+    def scan(self, _):
+        # first page of every shard
+        query = self._app.query(BENCH_INDEX, batch_size=self._batch_size)
+        for _ in zip(range(self._batch_size), query):
+            pass
+        query.close()
+
+    def close(self):
+        self._app.close()
+
+
+class ShardBenchClient:
+    def __init__(self, args, env):
+        shard = env.config['shards'][0]
+        self._client = ShardClient(shard['host'], shard['port'])
+        self._doc = 'x' * args.doc_size
+        self._batch_size = args.batch_size
+        self._hash = shard['start']
+
+    def read(self, key):
+        return self._client.read(BENCH_INDEX, key)
+
+    def write(self, key):
+        return self._client.write(BENCH_INDEX, key, self._hash, self._doc)
+
+    def scan(self, _):
+        return self._client.query(BENCH_INDEX, limit=self._batch_size)
+
+    def close(self):
+        self._client.close()
+
+
+class MasterBenchClient:
+    def __init__(self, args, env):
+        self._client = MasterClient(HOST, BOOTSTRAP_PORT)
+
+    def read(self, key):
+        return self._client.get_shard(BENCH_INDEX, key)
+
+    write = scan = read
+
+    def close(self):
+        self._client.close()
+
+
+CLIENTS = {
+    'e2e': E2EClient,
+    'shard': ShardBenchClient,
+    'master': MasterBenchClient,
+}
+
+
+def preload(args, env):
+    doc = 'x' * args.doc_size
+    with Pyshard(bootstrap_server=[HOST, BOOTSTRAP_PORT]) as app:
+        app.create_index(BENCH_INDEX)
+        if args.target == 'shard':
+            shard = env.config['shards'][0]
+            client = ShardClient(shard['host'], shard['port'])
+            for n in range(args.keys):
+                client.write(BENCH_INDEX, _key(n), shard['start'], doc)
+            client.close()
+        else:
+            for n in range(args.keys):
+                app.write(BENCH_INDEX, _key(n), doc)
+
+
+def run_worker(args, env, worker_id, ops, latencies, barrier):
+    client = CLIENTS[args.target](args, env)
+    workload = Workload(args, worker_id)
+    barrier.wait()
+    try:
+        for _ in range(ops):
+            op, key = workload.next_op()
+            started = time.perf_counter()
+            getattr(client, op)(key)
+            latencies[op].append(time.perf_counter() - started)
+    finally:
+        client.close()
+
+
+def run(args, env):
+    preload(args, env)
+
+    per_worker = [args.ops // args.workers + (1 if i < args.ops % args.workers else 0)
+                  for i in range(args.workers)]
+    latencies = [{'read': [], 'write': [], 'scan': []} for _ in range(args.workers)]
+    barrier = threading.Barrier(args.workers + 1)
+    threads = [threading.Thread(target=run_worker, args=(args, env, i, per_worker[i], latencies[i], barrier))
+               for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {}
+    merged = []
+    for op in ('read', 'write', 'scan'):
+        op_latencies = [latency for worker in latencies for latency in worker[op]]
+        if op_latencies:
+            results[op] = summarize(op_latencies, elapsed)
+            merged.extend(op_latencies)
+    results['total'] = summarize(merged, elapsed)
+
+    return results
+
+
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+{statement}
+print(time.perf_counter() - started)
+'''
+
+
+def run_import(args):
+    script = IMPORT_SCRIPT.format(statement=args.import_statement)
+    subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.DEVNULL)  # warm up bytecode cache
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.import_runs):
+        output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE).stdout
+        latencies.append(float(output))
+    elapsed = time.perf_counter() - started
+
+    return {'import': summarize(latencies, elapsed)}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    # nearest-rank method
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    ms = 1000.0
+    return {
+        'ops': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': sum(latencies) / len(latencies) * ms,
+        'p50_ms': percentile(latencies, 0.5) * ms,
+        'p99_ms': percentile(latencies, 0.99) * ms,
+        'p999_ms': percentile(latencies, 0.999) * ms,
+        'max_ms': latencies[-1] * ms
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns list of regressions of report relative to baseline
+
+    :param report: current report
+    :param baseline: earlier report
+    :param tolerance: allowed relative change
+    :return:
+    """
+    regressions = []
+    for op, current in report['results'].items():
+        previous = baseline['results'].get(op)
+        if not previous:
+            continue
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{op}: throughput {previous['throughput']:.1f} -> {current['throughput']:.1f} ops/s")
+        for metric in ('p50_ms', 'p99_ms', 'p999_ms'):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{op}: {metric} {previous[metric]:.3f} -> {current[metric]:.3f}")
+
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.target == 'import':
+        results = run_import(args)
+    else:
+        with Env(args) as env:
+            results = run(args, env)
+
+    report = {'config': vars(args), 'results': results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
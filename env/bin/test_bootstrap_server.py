@@ -1,17 +1,20 @@
+import os
 import sys
-import asyncio
 import logging.config
 
 from pyshard import BootstrapServer
+from pyshard.core.eventloop import new_event_loop
 
 # create logger
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger('pyshard')
+logger.setLevel(os.environ.get('PYSHARD_LOG_LEVEL', 'DEBUG'))
 
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    server = BootstrapServer(host=sys.argv[1], port=int(sys.argv[2]), config_path='config_example.json',
+    config_path = sys.argv[3] if len(sys.argv) > 3 else 'config_example.json'
+    loop = new_event_loop()
+    server = BootstrapServer(host=sys.argv[1], port=int(sys.argv[2]), config_path=config_path,
                              buffer_size=1024, loop=loop)
     try:
         loop.run_until_complete(server._do_run())
@@ -42,9 +42,10 @@ def run_shard_servers(shards_config):
     return processes
 
 
-def run_bootstrap_server(bootstrap_config):
+def run_bootstrap_server(bootstrap_config, config_path=None):
     host, port = bootstrap_config['host'], bootstrap_config['port']
-    proc = _mkserver('test_bootstrap_server', host, port)
+    args = (config_path,) if config_path else ()
+    proc = _mkserver('test_bootstrap_server', host, port, *args)
     return proc.pid
 
 
@@ -52,10 +53,11 @@ def _wait_for(delay):
     time.sleep(delay)
 
 
-def _mkserver(module, host, port):
+def _mkserver(module, host, port, *args):
     logfile_name = f"{module}_{host}:{port}.log"
     logfile = open(logfile_name, 'w')
     cmd = shlex.split(f'{INTERPRETER} {BIN_PATH}/{module}.py {host} {port}')
+    cmd.extend(args)
     proc = subprocess.Popen(cmd, stdout=logfile, stderr=logfile)
 
     return proc
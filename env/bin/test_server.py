@@ -1,20 +1,26 @@
+import os
 import sys
-import asyncio
 import logging.config
 
 from pyshard import ShardServer
+from pyshard.core.eventloop import new_event_loop
+from pyshard.storage import InMemoryStorage, SortedStorage
 
 # create logger
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger('pyshard')
+logger.setLevel(os.environ.get('PYSHARD_LOG_LEVEL', 'DEBUG'))
 
-loop = asyncio.get_event_loop()
+loop = new_event_loop()
+
+STORAGES = {'memory': InMemoryStorage, 'sorted': SortedStorage}
 
 
 if __name__ == '__main__':
     host, port = sys.argv[1], int(sys.argv[2])
     try:
-        with ShardServer(host=host, port=port, start=.0, end=.1) as server:
+        storage_class = STORAGES[os.environ.get('PYSHARD_STORAGE', 'memory')]
+        with ShardServer(host=host, port=port, start=.0, end=.1, storage_class=storage_class) as server:
             loop.run_until_complete(server._do_run())
     finally:
         loop.close()
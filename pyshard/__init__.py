@@ -1,7 +1,35 @@
-from .app.app import Pyshard
-from .shard.server import ShardServer
-from .master.client import MasterClient
-from .master.master import BootstrapServer
+import sys
+from importlib import import_module
+
+
+# exported names are imported on first access, so that clients don't pay for server modules
+_EXPORTS = {
+    'Pyshard': 'pyshard.app.app',
+    'ShardServer': 'pyshard.shard.server',
+    'MasterClient': 'pyshard.master.client',
+    'BootstrapServer': 'pyshard.master.master',
+}
+
+
+def __getattr__(name):
+    try:
+        module = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    value = getattr(import_module(module), name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
+
+
+if sys.version_info < (3, 7):  # no module __getattr__ (PEP 562)
+    for _name in _EXPORTS:
+        __getattr__(_name)
 
 
 __all__ = [
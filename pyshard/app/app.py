@@ -1,11 +1,24 @@
+import os
 import abc
+import json
+import time
+import uuid
+import heapq
+import queue
+import threading
+from collections import OrderedDict
+from itertools import islice
 from typing import Union
 
-from ..master.master import Master, _Shards
+from ..master.sharding import Master, _Shards
 from ..master.client import MasterClient
 from ..shard.client import ShardClient
-from ..core.client import ClientError
+from ..core.client import ClientError, ServerBusyError, ClientTimeoutError
 from ..core.typing import Key, Doc, Hash
+from ..shard.query import merge_aggregates
+from ..storage.sorted import _order
+from ..storage.bloom import BloomFilter
+from ..settings import settings
 
 
 class AbstractResult(abc.ABC):
@@ -27,12 +40,67 @@ class PyshardABC(abc.ABC):
     @abc.abstractmethod
     def remove(self, index, key: Key) -> AbstractResult: ...
     @abc.abstractmethod
-    def create_index(self, index): ...
+    def create_index(self, index, secondary=None): ...
+
+
+_maps = dict()  # bootstrap server addr: (fetch time, shard map)
+
+
+def _load_map(bootstrap_client):
+    """
+    Returns shard map of bootstrap server, cached for settings.MAP_CACHE_TTL seconds
+    """
+    key = '{}:{}'.format(*bootstrap_client.addr)
+    now = time.time()
+    cached = _maps.get(key) or _read_map_cache(key)
+    if cached and now - cached[0] < settings.MAP_CACHE_TTL:
+        _maps[key] = cached
+        return cached[1]
+
+    map_ = bootstrap_client.get_map()
+    _maps[key] = (now, map_)
+    _write_map_cache(key, now, map_)
+
+    return map_
+
+
+def _read_map_cache(key):
+    if not settings.MAP_CACHE_PATH:
+        return None
+
+    try:
+        with open(settings.MAP_CACHE_PATH, 'r') as f:
+            entry = json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return entry['fetched'], entry['map']
+
+
+def _write_map_cache(key, fetched, map_):
+    path = settings.MAP_CACHE_PATH
+    if not path:
+        return
+
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = dict()
+    cache[key] = {'fetched': fetched, 'map': map_}
+
+    tmp_path = f'{path}.{os.getpid()}'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass  # cache is optional
 
 
 def _map_shards(bootstrap_client, **kwargs):
     shard_map = {}
-    map_ = bootstrap_client.get_map()
+    map_ = _load_map(bootstrap_client)
     for bin, addr in map_.items():
         shard_map[float(bin)] = ShardClient(*addr, **kwargs)
 
@@ -56,15 +124,227 @@ class Result(AbstractResult):
         yield from [self.result, self.hash]
 
 
+_MISSING = object()
+
+
+class _HotKeyCache:
+    """
+    Reads of keys reported hot by shards, kept for ttl seconds
+    """
+    def __init__(self, ttl, size):
+        self._ttl = ttl
+        self._size = size
+        self._docs = OrderedDict()  # (index, key): (expiration time, doc)
+
+    def get(self, index, key):
+        entry = self._docs.get((index, key))
+        if entry is None:
+            return _MISSING
+        if entry[0] < time.monotonic():
+            del self._docs[(index, key)]
+            return _MISSING
+
+        return entry[1]
+
+    def put(self, index, key, doc):
+        self._docs[(index, key)] = (time.monotonic() + self._ttl, doc)
+        self._docs.move_to_end((index, key))
+        if len(self._docs) > self._size:
+            self._docs.popitem(last=False)
+
+    def discard(self, index, key):
+        self._docs.pop((index, key), None)
+
+
+def _unanswered(err):
+    # shard didn't get request or its answer was lost, unlike shard answering error
+    return isinstance(err, (OSError, ServerBusyError, ClientTimeoutError))
+
+
+def _maybe_prepared(err):
+    # prepare may have reached shard, unless connection was refused or shard answered
+    return isinstance(err, ClientTimeoutError) or (isinstance(err, OSError)
+                                                    and not isinstance(err, ConnectionRefusedError))
+
+
+class TransactionError(Exception):
+    """
+    Transaction failed on some shards: it is aborted, unless commit itself failed, i.e. shard lost
+    prepared transaction (shards not listed in errors have committed their changes then)
+    """
+    def __init__(self, message, errors):
+        """
+        :param errors: {shard address: exception}
+        """
+        self.errors = errors
+        failed = '; '.join(f'{host}:{port}: {err!r}' for (host, port), err in errors.items())
+        super(TransactionError, self).__init__(f'{message}: {failed}')
+
+
+class Transaction:
+    """
+    Changes of keys on any shards applied all or none, see Pyshard.transaction.
+    Changes are sent on commit, with block commits them unless it raises
+    """
+    def __init__(self, app):
+        self._app = app
+        self._ops = []
+        self.results = None
+
+    def set(self, index, key, doc, expected_version=None):
+        """
+        Writes doc whether key exists or not
+
+        :param expected_version: version doc must have when transaction is prepared (0 for absent key),
+            not checked if None
+        """
+        self._ops.append(('set', index, key, doc, expected_version))
+
+    def remove(self, index, key, expected_version=None):
+        self._ops.append(('remove', index, key, None, expected_version))
+
+    def commit(self):
+        """
+        :return: results of changes in order: new doc version for set, removed size for remove
+        """
+        ops, self._ops = self._ops, []
+        self.results = self._app._commit(ops) if ops else []
+
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+
+class _KeyFilters:
+    """
+    Bloom filters of index keys pulled from shards by background thread (over its own
+    connections) every interval seconds. Key a filter doesn't contain is absent on its shard,
+    unless another client wrote it after the filter was pulled
+    """
+    def __init__(self, shards, interval, **client_kwargs):
+        self._interval = interval
+        self._clients = [ShardClient(*shard.addr, lazy=True, **client_kwargs) for shard in shards]
+        self._filters = dict()  # (index, shard addr): BloomFilter
+        self._indexes = set()  # indexes filters are pulled for
+        self._written = []  # (index, shard addr, key) written since pull started
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def absent(self, index, shard, key):
+        if index not in self._indexes:
+            self._indexes.add(index)
+            self._wake.set()  # pull filters of new index now
+            return False
+
+        bloom = self._filters.get((index, shard.addr))
+        return bloom is not None and key not in bloom
+
+    def add(self, index, shard, key):
+        """
+        Adds key written by this client, must be called after shard has written it
+        """
+        with self._lock:
+            self._written.append((index, shard.addr, key))
+            bloom = self._filters.get((index, shard.addr))
+            if bloom is not None:
+                bloom.add(key)
+
+    def forget(self, index):
+        with self._lock:
+            self._indexes.discard(index)
+            for shard in self._clients:
+                self._filters.pop((index, shard.addr), None)
+
+    def refresh(self):
+        with self._lock:
+            self._written = []
+        for index in list(self._indexes):
+            for shard in self._clients:
+                try:
+                    bloom = BloomFilter.from_dict(shard.bloom(index))
+                except (ClientError, OSError):
+                    bloom = None  # shard is asked until filter is pulled
+                with self._lock:
+                    if bloom is None or index not in self._indexes:
+                        self._filters.pop((index, shard.addr), None)
+                        continue
+                    for written_index, addr, key in self._written:  # written while filter was pulled
+                        if written_index == index and addr == shard.addr:
+                            bloom.add(key)
+                    self._filters[(index, shard.addr)] = bloom
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            if self._closed:
+                return
+            self.refresh()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        for shard in self._clients:
+            shard.close()
+
+
 class Pyshard(PyshardABC):
     def __init__(self, bootstrap_server, buffer_size=1024, master_class=Master,
-                 **master_args):
-        self._bootstrap_client = MasterClient(*bootstrap_server, buffer_size=buffer_size)
-        shards = _map_shards(self._bootstrap_client)  # TODO: add ShardClient kwargs
+                 connect=None, connect_timeout=None, hot_key_ttl=None, bloom_refresh=None, **master_args):
+        """
+        :param bootstrap_server: bootstrap server address
+        :param connect: 'lazy' to connect to shard on first use, 'parallel' to connect
+            to all shards here at once, settings.SHARD_CONNECT by default
+        :param connect_timeout: seconds, settings.CONNECT_TIMEOUT by default
+        :param hot_key_ttl: seconds to keep reads of keys shards report hot,
+            settings.HOT_KEY_CACHE_TTL by default
+        :param bloom_refresh: seconds between pulls of shards bloom filters of index keys used to answer
+            has and read of absent keys locally, settings.BLOOM_FILTER_REFRESH by default
+        """
+        connect = connect or settings.SHARD_CONNECT
+        if connect not in ('lazy', 'parallel'):
+            raise ValueError(f'Unknown connect mode: {connect!r}')
+
+        self._bootstrap_client = MasterClient(*bootstrap_server, buffer_size=buffer_size, lazy=True,
+                                              connect_timeout=connect_timeout)
+        shards = _map_shards(self._bootstrap_client, lazy=True,
+                             connect_timeout=connect_timeout)  # TODO: add ShardClient kwargs
         self._master = master_class(shards=shards, **master_args)
+        self._executor_instance = None
+        hot_key_ttl = settings.HOT_KEY_CACHE_TTL if hot_key_ttl is None else hot_key_ttl
+        self._hot_keys = _HotKeyCache(hot_key_ttl, settings.HOT_KEY_CACHE_SIZE) if hot_key_ttl else None
+        bloom_refresh = settings.BLOOM_FILTER_REFRESH if bloom_refresh is None else bloom_refresh
+        self._key_filters = _KeyFilters(self._master.shards, bloom_refresh,
+                                        connect_timeout=connect_timeout) if bloom_refresh else None
+        if connect == 'parallel':
+            try:
+                list(self._executor.map(lambda shard: shard.connect(), self._master.shards))
+            except Exception:
+                self.close()
+                raise
+
+    @property
+    def _executor(self):
+        if self._executor_instance is None:
+            from concurrent.futures import ThreadPoolExecutor  # not needed by single key operations
+
+            self._executor_instance = ThreadPoolExecutor(max_workers=len(self._master.shards))
+
+        return self._executor_instance
 
     def write(self, index, key, doc) -> Result:
         hash_, shard = self._master.get_shard(index, key)
+        if self._hot_keys is not None:
+            self._hot_keys.discard(index, key)
         try:
             offset = shard.write(index, key, hash_, doc)
         except ClientError as err:
@@ -72,16 +352,47 @@ class Pyshard(PyshardABC):
             res = 0
         else:
             res = offset
+            if self._key_filters is not None:
+                self._key_filters.add(index, shard, key)
 
         return Result(res, hash_)
 
+    def write_blob(self, index, key, data, chunk_size=None) -> Result:
+        """
+        Streams binary value (bytes-like or binary file object) to its shard
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return Result(shard.write_blob(index, key, hash_, data, chunk_size), hash_)
+
+    def read_blob(self, index, key, file=None) -> Result:
+        """
+        Streams binary value from its shard, to file if it is set
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return Result(shard.read_blob(index, key, file), hash_)
+
+    def remove_blob(self, index, key) -> Result:
+        hash_, shard = self._master.get_shard(index, key)
+
+        return Result(shard.remove_blob(index, key), hash_)
+
     def has(self, index, key) -> Result:
         hash_, shard = self._master.get_shard(index, key)
+        if self._key_filters is not None and self._key_filters.absent(index, shard, key):
+            return Result(False, hash_)
 
         return Result(shard.has(index, key), hash_)
 
     def read(self, index, key) -> Result:
         hash_, shard = self._master.get_shard(index, key)
+        if self._hot_keys is not None:
+            doc = self._hot_keys.get(index, key)
+            if doc is not _MISSING:
+                return Result(doc, hash_)
+        if self._key_filters is not None and self._key_filters.absent(index, shard, key):
+            return Result(None, hash_)
         try:
             doc = shard.read(index, key)
         except ClientError as err:
@@ -89,11 +400,15 @@ class Pyshard(PyshardABC):
             res = None
         else:
             res = doc
+            if self._hot_keys is not None and shard.last_meta and shard.last_meta.get('hot'):
+                self._hot_keys.put(index, key, doc)
 
         return Result(res, hash_)
         
     def pop(self, index, key) -> Result:
         hash_, shard = self._master.get_shard(index, key)
+        if self._hot_keys is not None:
+            self._hot_keys.discard(index, key)
         try:
             doc = shard.pop(index, key)
         except ClientError as err:
@@ -106,6 +421,8 @@ class Pyshard(PyshardABC):
 
     def remove(self, index, key) -> Result:
         hash_, shard = self._master.get_shard(index, key)
+        if self._hot_keys is not None:
+            self._hot_keys.discard(index, key)
         try:
             offset = shard.remove(index, key)
         except ClientError as err:
@@ -116,10 +433,147 @@ class Pyshard(PyshardABC):
 
         return Result(res, hash_)
 
-    def create_index(self, index):
-        self._master.create_index(index)
+    def update(self, index, key, doc) -> Result:
+        """
+        Replaces doc of existing key on shard side
+
+        :return: Result of new version of doc, None if there is no such key
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return self._modify(index, key, hash_, shard, shard.update(index, key, doc))
+
+    def upsert(self, index, key, doc) -> Result:
+        """
+        Writes doc whether key exists or not
+
+        :return: Result of new version of doc
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return self._modify(index, key, hash_, shard, shard.upsert(index, key, hash_, doc))
+
+    def cas(self, index, key, expected_version, doc) -> Result:
+        """
+        Compare-and-set: replaces doc if its version is still expected_version
+        (`version` of doc returned by read, 0 to write absent key only)
+
+        :return: Result of new version of doc, None if doc was changed meanwhile
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return self._modify(index, key, hash_, shard, shard.cas(index, key, hash_, expected_version, doc))
+
+    def incr(self, index, key, amount=1) -> Result:
+        """
+        Adds amount to numeric doc on shard side, missing key counts as 0
+
+        :return: Result of new value
+        """
+        hash_, shard = self._master.get_shard(index, key)
+
+        return self._modify(index, key, hash_, shard, shard.incr(index, key, hash_, amount))
+
+    def transaction(self):
+        """
+        Returns Transaction: its changes are prepared on their shards, which lock changed keys only,
+        and committed if all shards prepared them or aborted otherwise (two-phase commit)
+
+            with app.transaction() as tx:
+                tx.set('accounts', 'alice', {'balance': 90}, expected_version=3)
+                tx.set('accounts', 'bob', {'balance': 110}, expected_version=7)
+        """
+        return Transaction(self)
+
+    def _commit(self, ops):
+        # two-phase commit coordinator, shards are asked in parallel
+        txid = uuid.uuid4().hex
+        shard_ops = OrderedDict()  # shard: [(position of op, op)]
+        for position, (kind, index, key, doc, expected_version) in enumerate(ops):
+            hash_, shard = self._master.get_shard(index, key)
+            shard_ops.setdefault(shard, []).append((position, [kind, index, key, hash_, doc, expected_version]))
+            if self._hot_keys is not None:
+                self._hot_keys.discard(index, key)
+
+        _, errors = self._each_shard(shard_ops, lambda shard: shard.prepare(txid, [op for _, op in shard_ops[shard]]))
+        if errors:
+            prepared = [shard for shard in shard_ops
+                        if shard.addr not in errors or _maybe_prepared(errors[shard.addr])]
+            _, abort_errors = self._until_answered(prepared, lambda shard: shard.abort(txid))
+            for addr, err in abort_errors.items():  # such shards keep keys locked until abort reaches them
+                errors.setdefault(addr, err)
+            raise TransactionError('Transaction is aborted', errors)
+
+        committed, errors = self._until_answered(shard_ops, lambda shard: shard.commit(txid))
+        if errors:  # shard lost prepared transaction, e.g. restarted
+            raise TransactionError('Transaction is committed partially', errors)
+
+        results = [None] * len(ops)
+        for shard, shard_results in committed.items():
+            for (position, (kind, index, key, *_)), result in zip(shard_ops[shard], shard_results):
+                results[position] = result
+                if kind == 'set' and self._key_filters is not None:
+                    self._key_filters.add(index, shard, key)
+
+        return results
+
+    def _until_answered(self, shards, func):
+        # sends decision of transaction until every shard answers: prepared shard keeps keys locked
+        # until it gets one, so unreachable or busy shards are retried with growing backoff
+        # for settings.TRANSACTION_RETRY_TIMEOUT seconds, their last errors are returned then
+        results, errors = {}, {}
+        pending = list(shards)
+        backoff = settings.TRANSACTION_RETRY_BACKOFF
+        deadline = time.monotonic() + settings.TRANSACTION_RETRY_TIMEOUT
+        while pending:
+            answered, failed = self._each_shard(pending, func)
+            results.update(answered)
+            retried = []
+            for shard in pending:
+                err = failed.get(shard.addr)
+                if err is None:
+                    errors.pop(shard.addr, None)
+                    continue
+                errors[shard.addr] = err
+                if _unanswered(err):
+                    retried.append(shard)
+
+            pending = retried
+            if pending and time.monotonic() + backoff > deadline:
+                break
+            if pending:
+                time.sleep(backoff)
+                backoff = min(2 * backoff, 1.0)
+
+        return results, errors
+
+    def _each_shard(self, shards, func):
+        # calls func(shard) in parallel, returns ({shard: result}, {shard address: exception})
+        futures = [(shard, self._executor.submit(func, shard)) for shard in shards]
+        results, errors = {}, {}
+        for shard, future in futures:
+            try:
+                results[shard] = future.result()
+            except Exception as err:
+                errors[shard.addr] = err
+
+        return results, errors
+
+    def _modify(self, index, key, hash_, shard, result):
+        # key may be written first time by the change
+        if self._hot_keys is not None:
+            self._hot_keys.discard(index, key)
+        if self._key_filters is not None and result is not None:
+            self._key_filters.add(index, shard, key)
+
+        return Result(result, hash_)
+
+    def create_index(self, index, secondary=None):
+        self._master.create_index(index, secondary)
 
     def drop_index(self, index):
+        if self._key_filters is not None:
+            self._key_filters.forget(index)
         self._master.drop_index(index)
 
     def keys(self, index):
@@ -127,7 +581,150 @@ class Pyshard(PyshardABC):
             for key in shard.keys(index):
                 yield key
 
+    def find(self, index, field, value):
+        for shard in self._master.shards:
+            for key, doc in shard.find(index, field, value):
+                yield key, doc
+
+    def find_range(self, index, field, lo=None, hi=None):
+        for shard in self._master.shards:
+            for key, doc in shard.find_range(index, field, lo, hi):
+                yield key, doc
+
+    def range(self, index, lo=None, hi=None, limit=None, batch_size=1000):
+        """
+        Scans keys in range [lo, hi] in key order (numbers before strings), shards must use SortedStorage.
+        Shards are read page by page and merged, first pages are requested in parallel.
+
+        :param lo: lower bound or None for unbounded
+        :param hi: upper bound or None for unbounded
+        :param limit: max number of docs
+        :param batch_size: max number of docs per shard response
+        :return: generator of (key, doc)
+        """
+        return self._scan(lambda shard, size, after: shard.range(index, lo, hi, size, after), limit, batch_size)
+
+    def prefix(self, index, prefix, limit=None, batch_size=1000):
+        """
+        Scans string keys starting with prefix in key order, see range
+        """
+        return self._scan(lambda shard, size, after: shard.prefix(index, prefix, size, after), limit, batch_size)
+
+    def _scan(self, fetch, limit, batch_size):
+        size = batch_size if limit is None else min(limit, batch_size)
+        shards = list(self._master.shards)
+        first_pages = self._executor.map(lambda shard: fetch(shard, size, None), shards)
+
+        def pages(shard, page):
+            while True:
+                for key, doc in page:
+                    yield key, doc
+                if len(page) < size:
+                    return
+                page = fetch(shard, size, page[-1][0])
+
+        merged = heapq.merge(*(pages(shard, page) for shard, page in zip(shards, first_pages)),
+                             key=lambda item: _order(item[0]))
+
+        return islice(merged, limit)
+
+    def query(self, index, where=None, fields=None, batch_size=1000):
+        """
+        Filters index on shards side, only matching docs are transferred.
+        Pages are requested from all shards in parallel.
+
+        :param index: index name
+        :param where: predicate spec, e.g. {'user.age': {'$gte': 18}, 'country': 'NL'}
+        :param fields: record field paths to return, None for whole record
+        :param batch_size: max number of docs per shard response
+        :return: generator of (key, doc)
+        """
+        cursors = {shard: None for shard in self._master.shards}
+        while cursors:
+            pages = self._executor.map(
+                lambda item: item[0].query(index, where, fields, cursor=item[1], limit=batch_size),
+                cursors.items())
+            next_cursors = {}
+            for shard, page in zip(list(cursors), pages):
+                for key, doc in page['items']:
+                    yield key, doc
+                if page['cursor'] is not None:
+                    next_cursors[shard] = page['cursor']
+            cursors = next_cursors
+
+    def aggregate(self, index, metrics, group_by=None, where=None):
+        """
+        Computes aggregates on shards side and merges shards partials.
+
+        :param index: index name
+        :param metrics: {alias: [op, field path]}, op is one of count, sum, min, max, avg
+        :param group_by: record field path to group by
+        :param where: predicate spec, see query
+        :return: {alias: value} or {group: {alias: value}} if group_by is set
+        """
+        partials = self._executor.map(lambda shard: shard.aggregate(index, metrics, group_by, where),
+                                      self._master.shards)
+
+        return merge_aggregates(partials, metrics, group_by)
+
+    def subscribe(self, index, from_offsets=None):
+        """
+        Follows changes of index on all shards, each shard is read by its own thread and connection.
+        Changes of shard come in order of their offsets, changes of different shards are interleaved.
+        Offsets are counted by shard from its start, shard keeps settings.CHANGE_LOG_SIZE last changes.
+
+        :param from_offsets: {shard name: offset of first change} to resume from,
+            changes made after subscription by default
+        :return: generator of (shard name, offset, op, key, doc), op is 'write' or 'remove' (doc is None),
+            close it to unsubscribe
+        """
+        from_offsets = from_offsets or {}
+        clients, streams = [], []
+        try:
+            for shard in self._master.shards:
+                client = ShardClient(*shard.addr, lazy=True)
+                clients.append(client)
+                streams.append((shard.name, client.subscribe(index, from_offsets.get(shard.name))))
+        except Exception:
+            for client in clients:
+                client.close()
+            raise
+
+        return self._follow(streams, clients)
+
+    @staticmethod
+    def _follow(streams, clients):
+        changes = queue.Queue()
+        closed = threading.Event()
+
+        def pump(name, stream):
+            try:
+                for offset, op, key, doc in stream:
+                    changes.put((name, offset, op, key, doc))
+                raise ClientError(f'Change stream of shard {name} is closed')
+            except Exception as err:
+                if not closed.is_set():
+                    changes.put(err)
+
+        for name, stream in streams:
+            threading.Thread(target=pump, args=(name, stream), daemon=True).start()
+
+        try:
+            while True:
+                change = changes.get()
+                if isinstance(change, Exception):
+                    raise change
+                yield change
+        finally:
+            closed.set()
+            for client in clients:
+                client.close()  # wakes pumps blocked reading streams
+
     def close(self):
+        if self._executor_instance is not None:
+            self._executor.shutdown()
+        if self._key_filters is not None:
+            self._key_filters.close()
         self._bootstrap_client.close()
         self._master.close()
 
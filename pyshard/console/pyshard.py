@@ -45,8 +45,7 @@ def cat(index, bootstrap_server=None):
     bootstrap_server = _retrieve_bootstrap_server(bootstrap_server)
 
     with Pyshard(bootstrap_server=bootstrap_server) as app:
-        for key in app.keys(index):
-            doc = app.read(index, key).result
+        for key, doc in app.query(index):
             sys.stdout.write(f'{key}{SEPARATOR}{json.dumps(doc)}\n')
             sys.stdout.flush()
 
@@ -1,8 +1,14 @@
 import abc
+import time
+import random
+import socket
+from contextlib import contextmanager
 from typing import Any
 import json
 
 from .connect import ConnectionABC, TCPConnection, AsyncTCPConnection
+from .tracing import new_trace, mark, spans, log_slow_request
+from ..settings import settings
 
 
 Payload = dict
@@ -39,13 +45,72 @@ class ClientABC(abc.ABC):
 class ClientError(Exception): ...
 
 
+class ServerBusyError(ClientError): ...
+
+
+class ClientTimeoutError(ClientError): ...
+
+
 class ClientBase(ClientABC):
     def __init__(self, host, port, transport_class=TCPConnection,
-                 serialyzer=Serialyzer, **conn_kwargs):
+                 serialyzer=Serialyzer, trace=None, slow_request_threshold=None,
+                 busy_retries=None, busy_backoff=None, lazy=False, connect_timeout=None, **conn_kwargs):
+        """
+        :param lazy: connect on first request instead of here
+        :param connect_timeout: seconds, settings.CONNECT_TIMEOUT by default
+        """
         self.addr = (host, port)
         self._serialyzer = serialyzer
+        self._trace = settings.TRACE if trace is None else trace
+        self._slow_request_threshold = settings.SLOW_REQUEST_THRESHOLD if slow_request_threshold is None \
+            else slow_request_threshold
+        self.last_trace = None
+        self.last_meta = None
+        self._busy_retries = settings.BUSY_RETRIES if busy_retries is None else busy_retries
+        self._busy_backoff = settings.BUSY_BACKOFF if busy_backoff is None else busy_backoff
+        self._connect_timeout = settings.CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self._request_timeout = None
+        self._transport_class = transport_class
+        self._conn_kwargs = conn_kwargs
         self._transport = transport_class(host, port, **conn_kwargs)
-        self._transport.connect()
+        self.connected = False
+        if not lazy:
+            self.connect()
+
+    def connect(self, timeout=None):
+        if self.connected:
+            return
+
+        self._transport.connect(self._connect_timeout if timeout is None else timeout)
+        self.connected = True
+        if self._request_timeout is not None:
+            self._transport.settimeout(self._request_timeout)
+
+    @contextmanager
+    def timeout(self, seconds):
+        """
+        Requests made inside fail with ClientTimeoutError if server doesn't answer in time,
+        connection is dropped then (late response would be taken for answer to next request)
+        and reestablished by next request
+
+        :param seconds: None waits forever
+        """
+        previous = self._request_timeout
+        self._set_request_timeout(seconds)
+        try:
+            yield
+        finally:
+            self._set_request_timeout(previous)
+
+    def _set_request_timeout(self, seconds):
+        self._request_timeout = seconds
+        if self.connected:
+            self._transport.settimeout(seconds)
+
+    def _reset(self):
+        self._transport.close()
+        self._transport = self._transport_class(*self.addr, **self._conn_kwargs)
+        self.connected = False
 
     def _serialize(self, payload):
         return self._serialyzer.dump(payload)
@@ -58,10 +123,73 @@ class ClientBase(ClientABC):
                    'args': args,
                    'kwargs': kwargs}
 
+        attempt = 0
+        response = self._request(method, payload)
+        while response['type'] == 'busy' and attempt < self._busy_retries:
+            # exponential backoff with full jitter
+            time.sleep(random.uniform(0, self._busy_backoff * 2 ** attempt))
+            attempt += 1
+            response = self._request(method, payload)
+
+        return self._handle_response(response)
+
+    def _request(self, method, payload):
+        if not self.connected:
+            self.connect()
+        try:
+            return self._roundtrip(method, payload)
+        except socket.timeout:
+            self._reset()
+            raise ClientTimeoutError(f'No response from {self.addr} in {self._request_timeout}s')
+        except OSError:
+            self._reset()  # next request reconnects
+            raise
+
+    def _roundtrip(self, method, payload):
+        if not self._trace:
+            self._transport.send(self._serialize(payload))
+            return self._deserialize(self._transport.recv())
+
+        payload['trace'] = new_trace()
+        mark(payload['trace'], 'client_send')
         self._transport.send(self._serialize(payload))
+        response = self._deserialize(self._transport.recv())
+        trace = response.get('trace') or payload['trace']
+        mark(trace, 'client_receive')
+        self._finish_trace(method, trace)
+
+        return response
+
+    def _execute_stream(self, method, chunks, *args, **kwargs):
+        """
+        Executes request followed by stream of bytes-like chunks.
+        Busy response is not retried since stream can't be sent again.
+        """
+        payload = {'endpoint': method,
+                   'args': args,
+                   'kwargs': kwargs,
+                   'stream': True}
+
+        self.connect()
+        self._transport.send(self._serialize(payload))
+        self._transport.send_stream(chunks)
+
         return self._handle_response(self._deserialize(self._transport.recv()))
 
+    def _recv_stream(self):
+        # stream must be read to the end before next request
+        return self._transport.recv_stream()
+
+    def _finish_trace(self, method, trace):
+        trace['endpoint'] = method
+        trace['spans'] = spans(trace)
+        self.last_trace = trace
+        log_slow_request('client', method, trace['id'], trace['spans'], self._slow_request_threshold)
+
     def _handle_response(self, response):
+        self.last_meta = response.get('meta')
+        if response['type'] == 'busy':
+            raise ServerBusyError(*response['message'])
         if response['type'] == 'error':
             err = response['message']
             raise ClientError(f'Couldn\'t execute: {err}')
@@ -69,6 +197,7 @@ class ClientBase(ClientABC):
         return response['message']
 
     def getsockname(self):
+        self.connect()
         return self._transport.getsockname()
 
     def close(self) -> None:
@@ -98,6 +227,8 @@ class AsyncClientBase(ClientABC):
         return await self._conn.recv()
 
     def _handle_response(self, response):
+        if response['type'] == 'busy':
+            raise ServerBusyError(*response['message'])
         if response['type'] == 'error':
             err = response['message']
             raise ClientError(f'Couldn\'t execute: {err}')
@@ -1,10 +1,11 @@
 import abc
+import zlib
 import struct
 import logging
 import socket
-import asyncio
 
 from .typing import Codec
+from ..settings import settings
 
 logger = logging.getLogger(__name__)
 Kb = 1024
@@ -48,90 +49,183 @@ class AsyncProtocolABC(abc.ABC):
     async def do_recv(self, sock: socket.socket) -> bytes: ...
 
 
+FLAG_COMPRESSED = 0x01  # payload is zlib compressed
+FLAG_ACCEPTS_COMPRESSED = 0x02  # sender decompresses payloads, peer may compress frames it sends back
+FLAG_CHUNK = 0x04  # frame is a chunk of stream, stream ends with empty chunk
+
+
+class _Compression:
+    """
+    Per connection payload compression.
+
+    Every frame of side with compression enabled carries FLAG_ACCEPTS_COMPRESSED,
+    payloads above threshold are compressed only after peer's frame carried it too,
+    so side without compression never gets compressed frames.
+    """
+    def _setup_compression(self, compress_threshold=None):
+        self._compress_threshold = settings.COMPRESSION_THRESHOLD if compress_threshold is None \
+            else compress_threshold
+        self.peer_accepts_compressed = False
+
+    def _encode_payload(self, data):
+        if self._compress_threshold is None:
+            return 0, data
+
+        if self.peer_accepts_compressed and len(data) >= self._compress_threshold:
+            compressed = zlib.compress(data, settings.COMPRESSION_LEVEL)
+            if len(compressed) < len(data):
+                return FLAG_COMPRESSED | FLAG_ACCEPTS_COMPRESSED, compressed
+
+        return FLAG_ACCEPTS_COMPRESSED, data
+
+    def _chunk_frames(self, chunks):
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            yield self._chunk_frame(chunk)
+        yield self._prefix.pack(0, FLAG_CHUNK), b''
+
+    def _chunk_frame(self, chunk):
+        flags, payload = self._encode_payload(chunk)
+        return self._prefix.pack(len(payload), flags | FLAG_CHUNK), payload
+
+    def _check_frame_size(self, size):
+        if size > settings.MAX_FRAME_SIZE:
+            raise AssertionError(f'Frame of {size} bytes exceeds limit of {settings.MAX_FRAME_SIZE} bytes')
+
+    def _decode_payload(self, flags, data):
+        if flags & FLAG_ACCEPTS_COMPRESSED and self._compress_threshold is not None:
+            self.peer_accepts_compressed = True
+        if flags & FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, settings.MAX_FRAME_SIZE)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise AssertionError(f'Compressed frame is truncated or exceeds limit of '
+                                     f'{settings.MAX_FRAME_SIZE} bytes once decompressed')
+            return data
+
+        return data
+
+
 class ConnectionABC(abc.ABC):
     @abc.abstractmethod
-    def connect(self) -> None: ...
+    def connect(self, timeout: float=None) -> None: ...
     @abc.abstractmethod
     def send(self, str_obj: str) -> None: ...
     @abc.abstractmethod
     def recv(self) -> str: ...
 
 
-class Protocol(ProtocolABC):
-    def __init__(self, buffer_size: int=Kb, codec: Codec='utf-8'):
-        self._prefix = struct.Struct('I')
+class Protocol(ProtocolABC, _Compression):
+    def __init__(self, buffer_size: int=Kb, codec: Codec='utf-8', compress_threshold: int=None):
+        self._prefix = struct.Struct('<QB')  # payload length, flags
         self._buffer_size = buffer_size
         self._codec = codec
+        self._setup_compression(compress_threshold)
 
     def _pack(self, obj):
-        prefix = self._prefix.pack(len(obj))
-        return prefix + obj
+        flags, payload = self._encode_payload(obj)
+        prefix = self._prefix.pack(len(payload), flags)
+        return prefix + payload
 
     def do_send(self, bytes_data: bytes, sock=None):
         sock = sock or self._sock
         sock.sendall(self._pack(bytes_data))
 
     def do_recv(self, sock=None):
-        data = b''
-        total = 0
-        sock = sock or self._sock
-
-        prefix = sock.recv(self._prefix.size)
-        logger.debug(f"Peer received prefix: {prefix}")
-        if not prefix:
-            raise RuntimeError('Connection was closed by peer')
+        flags, data = self._recv_frame(sock or self._sock)
 
-        msg_len = self._prefix.unpack(prefix)[0]
-        logger.debug(f"Peer will receive message of length {msg_len} bytes")
+        return self._decode_payload(flags, data)
 
-        while total < msg_len:
-            buff_size = min(msg_len - total, self._buffer_size)
-            chunk = sock.recv(buff_size)
-            if not chunk:
-                raise AssertionError(f'Expected {msg_len} bytes, received: {len(data)} bytes')
-
-            data += chunk
-            total += buff_size
+    def send_stream(self, chunks, sock=None):
+        """
+        Sends bytes-like chunks as chunk frames, one chunk in memory at a time
+        """
+        sock = sock or self._sock
+        for prefix, payload in self._chunk_frames(chunks):
+            sock.sendall(prefix)
+            sock.sendall(payload)
+
+    def recv_stream(self, sock=None):
+        """
+        Yields chunks of stream sent by peer's send_stream
+        """
+        sock = sock or self._sock
+        while True:
+            flags, data = self._recv_frame(sock)
+            if not flags & FLAG_CHUNK:
+                raise AssertionError(f'Expected stream chunk, received frame with flags={flags}')
+            if not data:
+                return
+            yield self._decode_payload(flags, data)
+
+    def _recv_frame(self, sock):
+        prefix = self._recv_exactly(sock, self._prefix.size, closed_ok=True)
+        logger.debug("Peer received prefix: %s", prefix)
+
+        msg_len, flags = self._prefix.unpack(prefix)
+        self._check_frame_size(msg_len)
+        logger.debug("Peer will receive message of length %s bytes", msg_len)
+
+        return flags, self._recv_exactly(sock, msg_len)
+
+    def _recv_exactly(self, sock, size, closed_ok=False):
+        data = bytearray(size)
+        view = memoryview(data)
+        total = 0
+        while total < size:
+            received = sock.recv_into(view[total:], min(size - total, self._buffer_size))
+            if not received:
+                if closed_ok and not total:
+                    raise RuntimeError('Connection was closed by peer')
+                raise AssertionError(f'Expected {size} bytes, received: {total} bytes')
+            total += received
 
-        return data
+        return bytes(data)
 
 
-class AsyncProtocol(AsyncProtocolABC):
-    def __init__(self, buffer_size: int=Kb, loop=None, codec: Codec='utf-8'):
-        self._prefix = struct.Struct('I')
+class AsyncProtocol(AsyncProtocolABC, _Compression):
+    def __init__(self, buffer_size: int=Kb, loop=None, codec: Codec='utf-8', compress_threshold: int=None):
+        self._prefix = struct.Struct('<QB')  # payload length, flags
         self._buffer_size = buffer_size
         self._codec = codec
-        self._loop = loop if loop else asyncio.get_event_loop()
+        if loop is None:
+            import asyncio  # clients of sync protocol don't need it
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._setup_compression(compress_threshold)
 
     def _pack(self, obj):
-        prefix = self._prefix.pack(len(obj))
-        return prefix + obj
+        flags, payload = self._encode_payload(obj)
+        prefix = self._prefix.pack(len(payload), flags)
+        return prefix + payload
 
     async def do_send(self, bytes_data: bytes, conn):
         await self._loop.sock_sendall(conn, self._pack(bytes_data))
 
     async def do_recv(self, conn):
-        data = b''
-        total = 0
+        prefix = await self._recv_exactly(conn, self._prefix.size, closed_ok=True)
+        logger.debug("Peer received prefix: %s", prefix)
 
-        prefix = await self._loop.sock_recv(conn, self._prefix.size)
-        logger.debug(f"Peer received prefix: {prefix}")
-        if not prefix:
-            raise RuntimeError('Connection was closed by peer')
-            
-        msg_len = self._prefix.unpack(prefix)[0]
-        logger.debug(f"Peer will receive message of length {msg_len} bytes")
+        msg_len, flags = self._prefix.unpack(prefix)
+        self._check_frame_size(msg_len)
+        logger.debug("Peer will receive message of length %s bytes", msg_len)
 
-        while total < msg_len:
-            buff_size = min(msg_len - total, self._buffer_size)
-            chunk = await self._loop.sock_recv(conn, buff_size)
-            if not chunk:
-                raise AssertionError(f'Expected {msg_len} bytes, received: {len(data)} bytes')
+        return self._decode_payload(flags, await self._recv_exactly(conn, msg_len))
 
-            data += chunk
-            total += buff_size
+    async def _recv_exactly(self, conn, size, closed_ok=False):
+        data = bytearray(size)
+        view = memoryview(data)
+        total = 0
+        while total < size:
+            received = await self._loop.sock_recv_into(conn, view[total:total + self._buffer_size])
+            if not received:
+                if closed_ok and not total:
+                    raise RuntimeError('Connection was closed by peer')
+                raise AssertionError(f'Expected {size} bytes, received: {total} bytes')
+            total += received
 
-        return data
+        return bytes(data)
 
 
 def _to_bytes(str_obj: str, codec: Codec) -> bytes:
@@ -149,7 +243,10 @@ class ConnectionBase(ConnectionABC, Protocol):
 
         super(ConnectionBase, self).__init__(**protocol_kwargs)
 
-    def connect(self):
+    def connect(self, timeout=None):
+        raise NotImplementedError()
+
+    def settimeout(self, timeout):
         raise NotImplementedError()
 
     def send(self, str_obj):
@@ -179,7 +276,7 @@ class AsyncConnectionBase(ConnectionABC, AsyncProtocol):
 
         super(AsyncConnectionBase, self).__init__(**protocol_kwargs)
 
-    def connect(self):
+    def connect(self, timeout=None):
         raise NotImplementedError()
 
     async def send(self, str_obj):
@@ -200,13 +297,23 @@ class TCPConnection(ConnectionBase):
 
         super(TCPConnection, self).__init__(*args, **kwargs)
 
-    def connect(self):
+    def connect(self, timeout=None):
+        self._sock.settimeout(timeout)
         self._sock.connect(self._addr)
+        self._sock.settimeout(None)
+
+    def settimeout(self, timeout):
+        # seconds every socket operation of request may take, None waits forever
+        self._sock.settimeout(timeout)
 
     def getsockname(self):
         return self._sock.getsockname()
 
     def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)  # wakes thread blocked reading from socket
+        except OSError:
+            pass  # not connected
         self._sock.close()
 
 
@@ -216,8 +323,10 @@ class AsyncTCPConnection(AsyncConnectionBase):
 
         super(AsyncTCPConnection, self).__init__(*args, **kwargs)
 
-    def connect(self):
+    def connect(self, timeout=None):
+        self._sock.settimeout(timeout)
         self._sock.connect(self._addr)
+        self._sock.settimeout(None)
 
     def getsockname(self):
         return self._sock.getsockname()
@@ -0,0 +1,45 @@
+import asyncio
+import logging
+
+from ..settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def install_policy(name=None):
+    """
+    Sets event loop policy chosen by name or settings.EVENT_LOOP:
+    'asyncio' - default asyncio loop, 'uvloop' - uvloop (must be installed),
+    'auto' - uvloop if it is installed
+
+    :param name: event loop name
+    :return: name of installed event loop
+    """
+    name = name or settings.EVENT_LOOP
+    if name == 'asyncio':
+        return name
+    if name not in ('uvloop', 'auto'):
+        raise ValueError(f'Unknown event loop {name!r}')
+
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise
+        return 'asyncio'
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def new_event_loop(name=None):
+    """
+    Installs policy (see install_policy) and returns new current event loop
+    """
+    installed = install_policy(name)
+    logger.info('Using %s event loop', installed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    return loop
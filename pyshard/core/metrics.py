@@ -0,0 +1,190 @@
+import time
+import bisect
+import asyncio
+from collections import defaultdict
+
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns upper bound of bucket containing q-quantile
+
+        :param q: quantile in [0, 1]
+        :return:
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class EndpointMetrics:
+    __slots__ = ('requests', 'errors', 'latency')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': self.latency.snapshot()
+        }
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.endpoints = defaultdict(EndpointMetrics)
+        self.queue_wait = defaultdict(Histogram)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.shed = 0
+        self.coalesced = 0
+
+    def observe_request(self, endpoint, latency, error=False):
+        metrics = self.endpoints[endpoint]
+        metrics.requests += 1
+        if error:
+            metrics.errors += 1
+        metrics.latency.observe(latency)
+
+    def snapshot(self, queues):
+        """
+        Returns json serializable metrics
+
+        :param queues: {queue name: asyncio.Queue} to report depth of
+        :return:
+        """
+        return {
+            'uptime': time.time() - self.started,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'shed': self.shed,
+            'coalesced': self.coalesced,
+            'queues': {name: {'depth': queue.qsize(),
+                              'maxsize': queue.maxsize,
+                              'wait': self.queue_wait[name].snapshot()}
+                       for name, queue in queues.items()},
+            'endpoints': {endpoint: metrics.snapshot()
+                          for endpoint, metrics in self.endpoints.items()}
+        }
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _render_histogram(lines, name, histogram, **labels):
+    total = 0
+    for bound, count in zip(histogram['buckets'], histogram['counts']):
+        total += count
+        lines.append(f'{name}_bucket{{{_labels(**labels, le=bound)}}} {total}')
+    lines.append(f'{name}_bucket{{{_labels(**labels, le="+Inf")}}} {histogram["count"]}')
+    lines.append(f'{name}_sum{{{_labels(**labels)}}} {histogram["sum"]}')
+    lines.append(f'{name}_count{{{_labels(**labels)}}} {histogram["count"]}')
+
+
+def render_prometheus(snapshot, prefix='pyshard'):
+    """
+    Renders metrics snapshot in Prometheus text exposition format
+
+    :param snapshot: ServerMetrics.snapshot result
+    :param prefix: metrics names prefix
+    :return:
+    """
+    lines = [
+        f'# TYPE {prefix}_uptime_seconds gauge',
+        f'{prefix}_uptime_seconds {snapshot["uptime"]}',
+        f'# TYPE {prefix}_received_bytes_total counter',
+        f'{prefix}_received_bytes_total {snapshot["bytes_in"]}',
+        f'# TYPE {prefix}_sent_bytes_total counter',
+        f'{prefix}_sent_bytes_total {snapshot["bytes_out"]}',
+        f'# TYPE {prefix}_shed_requests_total counter',
+        f'{prefix}_shed_requests_total {snapshot["shed"]}',
+        f'# TYPE {prefix}_coalesced_requests_total counter',
+        f'{prefix}_coalesced_requests_total {snapshot["coalesced"]}',
+        f'# TYPE {prefix}_queue_depth gauge',
+    ]
+    for name, queue in snapshot['queues'].items():
+        lines.append(f'{prefix}_queue_depth{{{_labels(queue=name)}}} {queue["depth"]}')
+    lines.append(f'# TYPE {prefix}_queue_wait_seconds histogram')
+    for name, queue in snapshot['queues'].items():
+        _render_histogram(lines, f'{prefix}_queue_wait_seconds', queue['wait'], queue=name)
+
+    endpoints = snapshot['endpoints']
+    lines.append(f'# TYPE {prefix}_requests_total counter')
+    for endpoint, metrics in endpoints.items():
+        lines.append(f'{prefix}_requests_total{{{_labels(endpoint=endpoint)}}} {metrics["requests"]}')
+    lines.append(f'# TYPE {prefix}_request_errors_total counter')
+    for endpoint, metrics in endpoints.items():
+        lines.append(f'{prefix}_request_errors_total{{{_labels(endpoint=endpoint)}}} {metrics["errors"]}')
+    lines.append(f'# TYPE {prefix}_request_duration_seconds histogram')
+    for endpoint, metrics in endpoints.items():
+        _render_histogram(lines, f'{prefix}_request_duration_seconds', metrics['latency'], endpoint=endpoint)
+
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter:
+    """
+    Minimal HTTP server exposing server metrics for Prometheus scraping
+    """
+    def __init__(self, server, host, port):
+        self._server = server
+        self._addr = (host, port)
+
+    async def run(self):
+        http_server = await asyncio.start_server(self._handle, *self._addr)
+        async with http_server:
+            await http_server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while (await reader.readline()).strip():  # skip request line and headers
+                pass
+            body = render_prometheus(self._server.metrics_snapshot()).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
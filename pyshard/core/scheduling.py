@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, now=0.0):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._last = now
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def ready(self, now):
+        self._refill(now)
+        return self._tokens >= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self._tokens >= self.burst
+
+    def take(self):
+        self._tokens -= 1
+
+    def wait_time(self, now):
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+
+class _Flow:
+    __slots__ = ('key', 'items', 'weight', 'deficit', 'bucket')
+
+    def __init__(self, key, weight=1, bucket=None):
+        self.key = key
+        self.items = deque()
+        self.weight = weight
+        self.deficit = 0.0
+        self.bucket = bucket
+
+    def ready(self, now):
+        return self.bucket is None or self.bucket.ready(now)
+
+
+class FairQueue:
+    """
+    Queue with separate FIFO per flow (token, connection) served by deficit round robin.
+
+    Flow with weight 2 gets twice as many requests served as flow with weight 1
+    while both are backlogged. Flow with rate limit is served no faster than
+    `rate` requests per second with bursts up to `burst`. Interface follows
+    asyncio.Queue as far as ServerBase uses it, except that empty() only tells
+    whether items are queued: get_nowait raises asyncio.QueueEmpty while every
+    flow having items waits for its rate limit, check ready() before it instead.
+    """
+    def __init__(self, maxsize=0, loop=None):
+        self.maxsize = maxsize
+        self._loop = loop
+        self._flows = dict()
+        self._idle = dict()  # key: rate limited flow, in order flows became idle
+        self._active = deque()
+        self._size = 0
+        self._changed = asyncio.Condition()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return not self._size
+
+    def full(self):
+        return 0 < self.maxsize <= self._size
+
+    def ready(self):
+        """
+        Whether get_nowait returns item now
+        """
+        now = self._now()
+        return any(flow.ready(now) for flow in self._active)
+
+    def task_done(self): ...
+
+    def _now(self):
+        return (self._loop or asyncio.get_event_loop()).time()
+
+    async def put(self, item, flow=None, weight=1, rate=None, burst=None):
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self.full())
+            self._put(item, flow, weight, rate, burst)
+            self._changed.notify_all()
+
+    def _put(self, item, key, weight, rate, burst):
+        if weight <= 0:
+            raise ValueError(f'Flow weight must be positive, got: {weight}')
+
+        now = self._now()
+        self._forget_idle(now)
+        flow = self._flows.get(key)
+        if flow is None:
+            bucket = TokenBucket(rate, burst, now) if rate else None
+            flow = self._flows[key] = _Flow(key, weight, bucket)
+        flow.weight = weight
+
+        if not flow.items:
+            self._idle.pop(key, None)
+            self._active.append(flow)
+        flow.items.append(item)
+        self._size += 1
+
+    def _forget_idle(self, now):
+        # idle flow with refilled bucket is the same as new one
+        while self._idle:
+            key, flow = next(iter(self._idle.items()))
+            if not flow.bucket.full(now):
+                return
+            del self._idle[key]
+            del self._flows[key]
+
+    async def get(self):
+        async with self._changed:
+            while True:
+                item, delay = self._pop(self._now())
+                if item is not None:
+                    self._changed.notify_all()
+                    return item
+
+                self._changed.notify_all()  # wake putters after get_nowait calls
+                if delay is None:
+                    await self._changed.wait()
+                    continue
+                try:  # every backlogged flow is rate limited
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def get_nowait(self):
+        item, _ = self._pop(self._now())
+        if item is None:
+            raise asyncio.QueueEmpty()
+
+        return item
+
+    def _pop(self, now):
+        """
+        Returns (item, None) or (None, seconds until some flow is allowed) or (None, None) if empty
+        """
+        if not self._active:
+            return None, None
+
+        if not any(flow.ready(now) for flow in self._active):
+            return None, min(flow.bucket.wait_time(now) for flow in self._active)
+
+        while True:
+            flow = self._active[0]
+            if not flow.ready(now):
+                self._active.rotate(-1)
+                continue
+            if flow.deficit < 1:
+                flow.deficit += flow.weight
+                self._active.rotate(-1)
+                continue
+
+            flow.deficit -= 1
+            if flow.bucket:
+                flow.bucket.take()
+            item = flow.items.popleft()
+            self._size -= 1
+            if not flow.items:
+                self._active.popleft()
+                flow.deficit = 0.0
+                if flow.bucket is None:  # nothing to remember about idle flow
+                    del self._flows[flow.key]
+                else:  # forgotten once bucket is refilled
+                    self._idle[flow.key] = flow
+
+            return item, None
@@ -1,5 +1,7 @@
 import json
+import time
 import asyncio
+import tempfile
 from collections import defaultdict
 from struct import error as struct_error
 
@@ -9,43 +11,78 @@ from ..core.typing import Request, Response, rRequest, rResponse
 from ..utils import to_bytes, from_bytes
 from ..settings import settings
 
-from .connect import AsyncProtocol, mksock
+from .connect import mksock
+from .streams import StreamProtocol
+from .metrics import ServerMetrics, PrometheusExporter, render_prometheus
+from .tracing import log_slow_request
+from .scheduling import FairQueue
 
 
 logger = logging.getLogger(__name__)
 
 Kb = 1024
 
-class _Channel(AsyncProtocol):
-    def __init__(self, sock, loop, buffer_size=1024):
-        self._sock = sock
-        self._loop = loop
-        self._chan = None
+class _Channel(StreamProtocol):
+    def __init__(self, reader, writer, loop, buffer_size=1024, metrics=None, max_in_flight=None):
+        self._reader = reader
+        self._writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self._metrics = metrics
+        self._slots = asyncio.Semaphore(max_in_flight or settings.MAX_IN_FLIGHT)
+        self.in_flight = 0
         self.token = None
         self.permission_group = None
+        self.streams = set()  # tasks sending long-lived streams, cancelled when connection closes
 
         super(_Channel, self).__init__(buffer_size, loop)
 
-    async def connect(self):
-        self._chan = await self._loop.sock_accept(self._sock)
-        return self
-
     async def retrieve_token(self):
-        rdata = await self.do_recv(self.sock)
+        rdata = await self.do_recv(self._reader)
         self.token = from_bytes(rdata, self._codec)
 
-    @property
-    def sock(self):
-        return self._chan[0]
+    async def send(self, bytes_data):
+        return await self.do_send(bytes_data, self._writer)
+
+    async def send_chunks(self, chunks):
+        return await self.send_stream(chunks, self._writer)
+
+    async def spool_stream(self):
+        """
+        Receives stream following request into temporary file, kept in memory up to settings.STREAM_SPOOL_SIZE
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.STREAM_SPOOL_SIZE)
+        try:
+            async for chunk in self.recv_stream(self._reader):
+                if self._metrics:
+                    self._metrics.bytes_in += self.received_frame_size
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+
+        spool.seek(0)
+        return spool
+
+    def close(self):
+        self._writer.close()
+
+    async def acquire(self):
+        # waits for free slot, so that connection is not read further meanwhile
+        await self._slots.acquire()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
 
     @property
-    def addr(self):
-        return self._chan[1]
+    def sock(self):
+        return self._writer.get_extra_info('socket')
 
     async def msg_iterator(self):
         while True:
             try:
-                data = await self.do_recv(self.sock)
+                data = await self.do_recv(self._reader)
             except struct_error as err:
                 logger.error(f'Couldn\'t unpack message: {err}')
             except RuntimeError as err:
@@ -55,15 +92,19 @@ class _Channel(AsyncProtocol):
                 logger.warning(f'Addr={self.addr} send not enought data. {err}')
                 break
             else:
-                logger.debug(f'Received message from addr={self.addr}: {data}')
+                logger.debug('Received message from addr=%s: %s', self.addr, data)
+                if self._metrics:
+                    self._metrics.bytes_in += self.received_frame_size
                 yield from_bytes(data, self._codec)
 
 
 class Endpoint:
-    def __init__(self, path, method, permission_group):
+    def __init__(self, path, method, permission_group, batch=None, exclusive=True):
         self._path = path
         self._method = method
         self._permission_group = permission_group
+        self._batch = batch
+        self._exclusive = exclusive
 
     @property
     def path(self):
@@ -77,6 +118,54 @@ class Endpoint:
     def permission_group(self):
         return self._permission_group
 
+    @property
+    def batch(self):
+        return self._batch
+
+    @property
+    def exclusive(self):
+        return self._exclusive
+
+
+class Stream:
+    """
+    Handler result: message is sent as usual response followed by chunks as stream.
+    Async iterable chunks are sent by separate task, so that worker serves other requests meanwhile
+    """
+    __slots__ = ('message', 'chunks')
+
+    def __init__(self, message, chunks):
+        self.message = message
+        self.chunks = chunks
+
+
+class Reply:
+    """
+    Handler result: message is sent with response metadata (e.g. hints for client)
+    """
+    __slots__ = ('message', 'meta')
+
+    def __init__(self, message, meta):
+        self.message = message
+        self.meta = meta
+
+
+_NO_KWARGS = {}  # never mutated, handlers get kwargs copy through **
+
+
+class _Route:
+    """
+    Endpoint resolved for server instance: bound method, bound batch handler,
+    the only permission group allowed and whether handler runs under server lock
+    """
+    __slots__ = ('method', 'permission_group', 'batch', 'exclusive')
+
+    def __init__(self, method, permission_group=None, batch=None, exclusive=True):
+        self.method = method
+        self.permission_group = permission_group
+        self.batch = batch
+        self.exclusive = exclusive
+
 
 def _auth(func):
     async def wrapper(self, *args, **kwargs):
@@ -91,13 +180,19 @@ def _auth(func):
     return wrapper if settings.AUTH else func
 
 
-class ServerBase(AsyncProtocol):
+class ServerBase(StreamProtocol):
+    busy_errors = ()  # handler exceptions answered with busy response, so that clients retry request
+
     def __init__(self, host, port, buffer_size, loop,
                  serialize=json.dumps, deserialize=json.loads,
-                 backlog=5):
+                 backlog=5, max_in_flight=None, shed_ratio=None):
         self.sock = mksock(host, port, backlog=backlog, mode='l')
-        self._default_queue = asyncio.Queue(maxsize=buffer_size)
+        self._default_queue = FairQueue(maxsize=buffer_size, loop=loop)
         self._master_queue = asyncio.Queue(maxsize=buffer_size // 2)
+        self._max_in_flight = max_in_flight or settings.MAX_IN_FLIGHT
+        self._shed_depth = max(1, int(buffer_size * (shed_ratio or settings.SHED_RATIO)))
+        self._batch_size = settings.WRITE_BATCH_SIZE
+        self._batch_window = settings.WRITE_BATCH_WINDOW
         self._master_group = 'master'
         self._token_storage = defaultdict(dict)
         self._channels = dict()
@@ -109,19 +204,43 @@ class ServerBase(AsyncProtocol):
 
         self._routes = dict()
         self._roles = set()
-        self._permissions = defaultdict(set)
+        # responses are rendered from templates when serializer is plain json
+        self._json_templates = serialize is json.dumps
+        self._busy_resp = self._serialize({"type": "busy", "message": ["Server is busy, retry later"]})
+
+        self._metrics = ServerMetrics()
+        self._queues = {'master': self._master_queue, 'default': self._default_queue}
 
         self._discover_endpoints()
 
         super(ServerBase, self).__init__(buffer_size, loop)
 
     async def _do_run(self):
-        await asyncio.gather(self._worker(self._master_queue),
-                             self._worker(self._default_queue),
+        await asyncio.gather(self._worker(self._master_queue, 'master'),
+                             self._worker(self._default_queue, 'default'),
                              self._main_loop())
 
+    async def serve_metrics(self, host, port):
+        """
+        Runs Prometheus exporter on (host, port) next to the server,
+        e.g. asyncio.gather(server._do_run(), server.serve_metrics(host, port))
+        """
+        await PrometheusExporter(self, host, port).run()
+
+    def metrics_snapshot(self):
+        return self._metrics.snapshot(self._queues)
+
+    async def _get_metrics(self, format='json'):
+        snapshot = self.metrics_snapshot()
+        if format == 'prometheus':
+            return render_prometheus(snapshot)
+
+        return snapshot
+
+    get_metrics = Endpoint('metrics', _get_metrics, None)
+
     def _dispatch(self, endpoint):
-        return self._routes[endpoint]
+        return self._routes[endpoint].method
 
     def _discover_endpoints(self):
         for key in dir(self):
@@ -132,95 +251,335 @@ class ServerBase(AsyncProtocol):
     def _init_endpoint(self, endpoint):
         if endpoint.permission_group:
             self._roles.add(endpoint.permission_group)
-            self._permissions[endpoint.path].add(endpoint.permission_group)
 
-        self._routes[endpoint.path] = endpoint.method
+        batch = getattr(self, endpoint.batch) if endpoint.batch else None
+        self._routes[endpoint.path] = _Route(endpoint.method.__get__(self), endpoint.permission_group, batch,
+                                             endpoint.exclusive)
 
     @classmethod
-    def endpoint(cls, path, permission_group=None):
+    def endpoint(cls, path, permission_group=None, batch=None, exclusive=True):
+        """
+        Declares endpoint
+
+        :param path: endpoint name
+        :param permission_group: the only group allowed to call endpoint
+        :param batch: name of method handling several queued requests to this endpoint at once,
+            it gets list of (args, kwargs) and returns list of results or exceptions
+        :param exclusive: run handler under server lock, handler that is not exclusive must
+            tolerate other requests handled while it awaits (e.g. long maintenance yielding to loop)
+        :return:
+        """
         def _wrapper(method):
-            return Endpoint(path, method, permission_group)
+            return Endpoint(path, method, permission_group, batch, exclusive)
 
         return _wrapper
 
-    def _check_permission(self, chan, endpoint):
-        if not self._permissions[endpoint]:
-            return
-
-        if chan.permission_group not in self._permissions[endpoint]:
+    async def _dispatch_and_execute(self, chan, endpoint, *args, timings=None, **kwargs):
+        route = self._routes.get(endpoint)
+        if route is None:
+            raise KeyError(endpoint)
+        if route.permission_group is not None and chan.permission_group != route.permission_group:
             raise Exception("Permission denied")
 
-    async def _dispatch_and_execute(self, chan, endpoint, *args, **kwargs):
-        self._check_permission(chan, endpoint)
+        if not route.exclusive:
+            if timings is not None:
+                timings['lock'] = time.time()
+            return await route.method(*args, **kwargs)
+
         async with self._proc_locker:
-            return await self._dispatch(endpoint)(self, *args, **kwargs)
+            if timings is not None:
+                timings['lock'] = time.time()
+            return await route.method(*args, **kwargs)
 
-    async def _worker(self, queue):
+    async def _worker(self, queue, name='default'):
+        pending = None
         while True:
-            chan, endpoint, args, kwargs = await queue.get()
+            item = pending if pending is not None else await queue.get()
+            pending = None
+            batch = [item]  # taken from queue and not answered yet
+
+            try:
+                route = self._routes.get(item[1])
+                if route is not None and route.batch is not None and self._batch_size > 1:
+                    pending = await self._collect_batch(queue, batch)
+                    if len(batch) > 1:
+                        await self._execute_batch(queue, name, route, batch)
+                        continue
+
+                await self._execute(queue, name, item)
+            except Exception as err:  # requests fail, not the server
+                logger.exception(f'Worker {name} failed to serve {len(batch)} request(s)')
+                await self._fail(queue, batch, err)
+
+    async def _fail(self, queue, items, err):
+        for chan, *_ in items:
+            await self._send(chan, self._handle_error_resp(err))
+            chan.release()
+            queue.task_done()
+
+    async def _collect_batch(self, queue, batch):
+        """
+        Adds following queued requests to the same endpoint to batch.
+        Returns the first request of another endpoint if it was taken.
+        """
+        endpoint = batch[0][1]
+        deadline = None
+        while len(batch) < self._batch_size:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if self._batch_window <= 0 or not queue.empty():  # queued requests wait for rate limit
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self._batch_window
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            if item[1] != endpoint:
+                return item
+            batch.append(item)
+
+        return None
+
+    async def _execute_batch(self, queue, name, route, batch):
+        dequeued = time.time()
+        results = [None] * len(batch)
+        allowed = []
+        for i, (chan, *_) in enumerate(batch):
+            if route.permission_group is not None and chan.permission_group != route.permission_group:
+                results[i] = Exception("Permission denied")
+            else:
+                allowed.append(i)
+
+        started = time.perf_counter()
+        async with self._proc_locker:
+            locked = time.time()
             try:
-                rresp = await self._dispatch_and_execute(chan, endpoint, *args, **kwargs)
+                outcomes = await route.batch([(batch[i][2], batch[i][3]) for i in allowed])
             except Exception as err:
-                resp = self._handle_error_resp(err)
+                outcomes = [err] * len(allowed)
+        for i, outcome in zip(allowed, outcomes):
+            results[i] = outcome
+        latency = time.perf_counter() - started
+        self._metrics.coalesced += len(batch)
+
+        for result in results:
+            chan, endpoint, args, kwargs, trace, received = batch[0]
+            timings = {'server_receive': received, 'dequeue': dequeued, 'lock': locked}
+            error = isinstance(result, Exception)
+            resp_trace = self._finish_trace(endpoint, trace, timings)
+            if error:
+                resp = self._handle_error_resp(result, resp_trace)
+            elif isinstance(result, Reply):
+                resp = self._handle_success_resp(result.message, resp_trace, result.meta)
             else:
-                resp = self._handle_success_resp(rresp)
+                resp = self._handle_success_resp(result, resp_trace)
+
+            self._metrics.queue_wait[name].observe(dequeued - received)
+            self._metrics.observe_request(endpoint, latency, error)
 
-            await self.do_send(to_bytes(resp, self._codec), chan.sock)
+            await self._send(chan, resp)
+            del batch[0]  # answered
+            chan.release()
 
             queue.task_done()
 
+    async def _execute(self, queue, name, item):
+        chan, endpoint, args, kwargs, trace, received = item
+        timings = {'server_receive': received, 'dequeue': time.time()}
+        started = time.perf_counter()
+        stream = None
+        try:
+            rresp = await self._dispatch_and_execute(chan, endpoint, *args, timings=timings, **kwargs)
+        except Exception as err:
+            error = True
+            resp_trace = self._finish_trace(endpoint, trace, timings)
+            resp = self._handle_error_resp(err, resp_trace)
+        else:
+            error = False
+            meta = None
+            if isinstance(rresp, Stream):
+                rresp, stream = rresp.message, rresp.chunks
+            elif isinstance(rresp, Reply):
+                rresp, meta = rresp.message, rresp.meta
+            resp_trace = self._finish_trace(endpoint, trace, timings)
+            resp = self._handle_success_resp(rresp, resp_trace, meta)
+
+        self._metrics.queue_wait[name].observe(timings['dequeue'] - received)
+        self._metrics.observe_request(endpoint if endpoint in self._routes else '<unknown>',
+                                      time.perf_counter() - started, error)
+
+        await self._send(chan, resp)
+        if stream is not None and hasattr(stream, '__aiter__'):  # long-lived stream doesn't hold worker
+            task = asyncio.ensure_future(self._send_stream(chan, stream))
+            task.add_done_callback(chan.streams.discard)
+            chan.streams.add(task)
+        elif stream is not None:
+            await self._send_stream(chan, stream)
+        chan.release()
+
+        queue.task_done()
+
+    async def _send_stream(self, chan, chunks):
+        try:
+            self._metrics.bytes_out += await chan.send_chunks(chunks)
+        except OSError as err:
+            logger.warning(f'Couldn\'t send stream to addr={chan.addr}: {err}')
+
+    async def _send(self, chan, resp):
+        bresp = to_bytes(resp, self._codec)
+        try:
+            self._metrics.bytes_out += await chan.send(bresp)
+        except OSError as err:
+            logger.warning(f'Couldn\'t send response to addr={chan.addr}: {err}')
+
     async def _main_loop(self):
-        async for chan in self._channel_iterator():
-            logger.debug(f"Connection accepted from: {chan.addr}")
-            self._loop.create_task(self._handle_channel(chan))
+        logger.debug("Waiting for connection...")
+        server = await asyncio.start_server(self._on_connect, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    async def _on_connect(self, reader, writer):
+        try:
+            chan = await self._accept(reader, writer)
+        except KeyError as err:
+            logger.warning(err)
+            writer.close()
+            return
+        except (RuntimeError, AssertionError):
+            logger.warning('Couldn\'t recieve token from peer')
+            writer.close()
+            return
 
-        self.sock.close()
+        logger.debug("Connection accepted from: %s", chan.addr)
+        await self._handle_channel(chan)
 
     async def _handle_channel(self, chan):
         async for msg in chan.msg_iterator():
+            received = time.time()
             try:
-                endpoint, args, kwargs = self._parse_request(msg)
+                endpoint, args, kwargs, trace, stream = self._parse_request(msg)
             except Exception as err:
                 logger.warning(f"Couldn\'t parse message={msg!r}, addr={chan.addr} error: {err}")
                 break
 
+            if stream:
+                # stream is received before scheduling, handler gets it as file object
+                try:
+                    kwargs = dict(kwargs, stream=await chan.spool_stream())
+                except (RuntimeError, AssertionError) as err:
+                    logger.warning(f'Addr={chan.addr} couldn\'t receive stream: {err}')
+                    break
+
             if chan.permission_group == self._master_group:
                 queue = self._master_queue
+            elif self._overloaded(chan):
+                self._metrics.shed += 1
+                if stream:
+                    kwargs['stream'].close()
+                await self._send(chan, self._handle_busy_resp())
+                continue
             else:
                 queue = self._default_queue
 
-            await queue.put((chan, endpoint, args, kwargs))
+            await chan.acquire()
+            item = (chan, endpoint, args, kwargs, trace, received)
+            if queue is self._default_queue:
+                await queue.put(item, **self._flow(chan))
+            else:
+                await queue.put(item)
 
-        chan.sock.close()
+        for task in chan.streams:
+            task.cancel()
+        chan.close()
         del self._channels[chan.addr]
 
-    async def _channel_iterator(self):
-        while True:
-            logger.debug("Waiting for connection...")
-            try:
-                yield await self._accept(self.sock, self._loop)
-            except KeyError as err:
-                logger.warning(err)
-            except asyncio.TimeoutError:
-                logger.warning('Couldn\'t recieve token from peer')
+    def _flow(self, chan):
+        """
+        Returns scheduling options of channel: requests of one token (or one
+        connection if auth is off) share a flow in fair queue
+        """
+        qos = dict(settings.QOS.get(chan.permission_group, {}))
+        if chan.token is not None:
+            qos.update(self._token_storage.get(chan.token, {}))
+            key = ('token', chan.token)
+        else:
+            key = ('addr', chan.addr)
+
+        return {'flow': key,
+                'weight': qos.get('weight', 1),
+                'rate': qos.get('rate'),
+                'burst': qos.get('burst')}
+
+    def _overloaded(self, chan):
+        # busy answer must not overtake responses to requests already queued,
+        # such connections are slowed down by in-flight limit instead
+        return not chan.in_flight and self._default_queue.qsize() >= self._shed_depth
 
     @_auth
-    async def _accept(self, sock, loop):
-        chan = await _Channel(sock, loop).connect()
+    async def _accept(self, reader, writer):
+        chan = _Channel(reader, writer, self._loop, metrics=self._metrics,
+                        max_in_flight=self._max_in_flight)
         self._channels[chan.addr] = chan
         return chan
 
     def _parse_request(self, request: rRequest) -> Request:
         req = self._deserialize(request)
-
-        return req['endpoint'], req.get('args', list()), req.get('kwargs', dict())
-
-    def _handle_success_resp(self, rresp: rResponse) -> Response:
-        resp = {"type": "success", "message": rresp}
-
-        return self._serialize(resp)
-
-    def _handle_error_resp(self, err: Exception) -> str:
-        resp = {"type": "error", "message": err.args}
-
-        return self._serialize(resp)
+        trace = req.get('trace')
+        if not isinstance(trace, dict):  # malformed trace is dropped, timings are added to it
+            trace = None
+
+        return (req['endpoint'], req.get('args', ()), req.get('kwargs', _NO_KWARGS), trace,
+                req.get('stream', False))
+
+    def _finish_trace(self, endpoint, trace, timings):
+        timings['handler_done'] = done = time.time()
+        threshold = settings.SLOW_REQUEST_THRESHOLD
+        slow = threshold is not None and done - timings['server_receive'] >= threshold
+        if trace is None and not slow:
+            return None
+
+        timings.setdefault('lock', timings['dequeue'])  # failed before lock acquired
+        if slow:
+            durations = {'total': done - timings['server_receive'],
+                         'queue': timings['dequeue'] - timings['server_receive'],
+                         'lock': timings['lock'] - timings['dequeue'],
+                         'handler': done - timings['lock']}
+            log_slow_request('server', endpoint, trace and trace.get('id'), durations, threshold)
+
+        if trace is None:
+            return None
+        trace.update(timings)
+
+        return trace
+
+    def _render_resp(self, type_, message, trace, meta=None):
+        if not self._json_templates or meta is not None:
+            resp = {"type": type_, "message": message}
+            if trace is not None:
+                resp['trace'] = trace
+            if meta is not None:
+                resp['meta'] = meta
+            return self._serialize(resp)
+
+        # same text json.dumps produces for the dict above
+        if trace is None:
+            return f'{{"type": "{type_}", "message": {self._serialize(message)}}}'
+        return f'{{"type": "{type_}", "message": {self._serialize(message)}, "trace": {self._serialize(trace)}}}'
+
+    def _handle_success_resp(self, rresp: rResponse, trace=None, meta=None) -> Response:
+        return self._render_resp('success', rresp, trace, meta)
+
+    def _handle_busy_resp(self) -> str:
+        return self._busy_resp
+
+    def _handle_error_resp(self, err: Exception, trace=None) -> str:
+        if isinstance(err, self.busy_errors):
+            return self._render_resp('busy', err.args, trace)
+
+        return self._render_resp('error', err.args, trace)
@@ -0,0 +1,104 @@
+import struct
+import asyncio
+import logging
+
+from .connect import AsyncProtocolABC, _Compression, FLAG_CHUNK, Kb
+from .typing import Codec
+
+
+logger = logging.getLogger(__name__)
+
+
+class StreamProtocol(AsyncProtocolABC, _Compression):
+    """
+    Same framing as AsyncProtocol over buffered asyncio streams
+    """
+    def __init__(self, buffer_size: int=Kb, loop=None, codec: Codec='utf-8', compress_threshold: int=None):
+        self._prefix = struct.Struct('<QB')  # payload length, flags
+        self._buffer_size = buffer_size
+        self._codec = codec
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._setup_compression(compress_threshold)
+        self.received_frame_size = 0  # bytes on the wire of last received frame
+        self.received_flags = 0
+
+    def _pack(self, obj):
+        flags, payload = self._encode_payload(obj)
+        prefix = self._prefix.pack(len(payload), flags)
+        return prefix + payload
+
+    async def do_send(self, bytes_data: bytes, writer: asyncio.StreamWriter):
+        flags, payload = self._encode_payload(bytes_data)
+        writer.writelines((self._prefix.pack(len(payload), flags), payload))
+        await writer.drain()
+
+        return self._prefix.size + len(payload)
+
+    async def do_recv(self, reader: asyncio.StreamReader):
+        try:
+            prefix = await reader.readexactly(self._prefix.size)
+        except asyncio.IncompleteReadError as err:
+            if not err.partial:
+                raise RuntimeError('Connection was closed by peer')
+            raise AssertionError(f'Expected {self._prefix.size} bytes of prefix, received: {len(err.partial)} bytes')
+        except ConnectionResetError:
+            raise RuntimeError('Connection was reset by peer')
+        logger.debug("Peer received prefix: %s", prefix)
+
+        msg_len, flags = self._prefix.unpack(prefix)
+        self._check_frame_size(msg_len)
+        logger.debug("Peer will receive message of length %s bytes", msg_len)
+
+        try:
+            data = await reader.readexactly(msg_len)
+        except asyncio.IncompleteReadError as err:
+            raise AssertionError(f'Expected {msg_len} bytes, received: {len(err.partial)} bytes')
+        except ConnectionResetError:
+            raise RuntimeError('Connection was reset by peer')
+
+        self.received_frame_size = self._prefix.size + msg_len
+        self.received_flags = flags
+        return self._decode_payload(flags, data)
+
+    async def send_stream(self, chunks, writer: asyncio.StreamWriter):
+        """
+        Sends bytes-like chunks as chunk frames, waits for every chunk to be flushed.
+        Chunks may be async iterable, e.g. of data produced while stream is open
+
+        :return: bytes sent
+        """
+        if hasattr(chunks, '__aiter__'):
+            return await self._send_async_stream(chunks, writer)
+
+        total = 0
+        for prefix, payload in self._chunk_frames(chunks):
+            writer.writelines((prefix, payload))
+            await writer.drain()
+            total += len(prefix) + len(payload)
+
+        return total
+
+    async def _send_async_stream(self, chunks, writer):
+        total = 0
+        async for chunk in chunks:
+            if not len(chunk):
+                continue
+            prefix, payload = self._chunk_frame(chunk)
+            writer.writelines((prefix, payload))
+            await writer.drain()
+            total += len(prefix) + len(payload)
+
+        total += await self.send_stream((), writer)  # end of stream
+        return total
+
+    async def recv_stream(self, reader: asyncio.StreamReader):
+        """
+        Yields chunks of stream sent by peer's send_stream
+        """
+        while True:
+            data = await self.do_recv(reader)
+            if not self.received_flags & FLAG_CHUNK:
+                raise AssertionError(f'Expected stream chunk, received frame with flags={self.received_flags}')
+            if not data:
+                return
+            yield data
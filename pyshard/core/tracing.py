@@ -0,0 +1,51 @@
+import os
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# request lifecycle points in order they are passed
+POINTS = ('client_send', 'server_receive', 'dequeue', 'lock', 'handler_done', 'client_receive')
+
+
+def new_trace():
+    return {'id': os.urandom(16).hex()}
+
+
+def mark(trace, point):
+    trace[point] = time.time()
+
+
+def spans(trace):
+    """
+    Splits request latency to network, queueing, lock waiting and handler time.
+
+    Server side spans are computed from server timestamps only and network span
+    is the rest of client measured total, so clocks don't need to be in sync.
+
+    :param trace: trace with timestamps of POINTS
+    :return: {span name: seconds}
+    """
+    total = trace['client_receive'] - trace['client_send']
+    result = {'total': total}
+    if 'handler_done' not in trace:  # server didn't trace request
+        return result
+
+    server = trace['handler_done'] - trace['server_receive']
+    result.update(network=total - server,
+                  queue=trace['dequeue'] - trace['server_receive'],
+                  lock=trace['lock'] - trace['dequeue'],
+                  handler=trace['handler_done'] - trace['lock'])
+
+    return result
+
+
+def log_slow_request(side, endpoint, trace_id, durations, threshold):
+    if threshold is None or durations['total'] < threshold:
+        return False
+
+    details = ' '.join(f'{name}={value * 1000:.3f}ms' for name, value in durations.items())
+    logger.warning('Slow request on %s: endpoint=%s trace_id=%s %s', side, endpoint, trace_id, details)
+
+    return True
@@ -8,7 +8,7 @@ Addr = Tuple[str, int]
 
 Codec = str
 
-Request = Tuple[str, list, dict]
+Request = Tuple[str, list, dict, Optional[dict], bool]
 Response = str
 rRequest = str
 rResponse = str
@@ -6,17 +6,30 @@ Key = Union[int, float, str]
 
 
 class MasterClient(ClientBase):
-    def get_shard(self, key):
-        return self._execute("get_shard", key)
+    def get_shard(self, index, key):
+        return self._execute("get_shard", index, key)
 
     def get_map(self):
         return self._execute("get_map")
 
     def stat(self):
+        """
+        Returns {'shards': {name: stat}, 'load': ..., 'hot_keys': ..., 'errors': [...]}, see Master.stat
+        """
         return self._execute("stat")
 
-    def create_index(self, index):
-        return self._execute("create_index", index)
+    def aggregate(self, index, metrics, group_by=None, where=None):
+        result = self._execute("aggregate", index, metrics, group_by=group_by, where=where)
+        if group_by is not None:
+            result = {group: values for group, values in result}
+
+        return result
+
+    def metrics(self, format='json'):
+        return self._execute("metrics", format=format)
+
+    def create_index(self, index, secondary=None):
+        return self._execute("create_index", index, secondary=secondary)
 
 
 class AsyncMasterClient(MasterClient):
@@ -1,22 +1,8 @@
-import hashlib
-import bisect
 import json
-from contextlib import contextmanager
 
 from ..core.server import ServerBase
 from ..shard.client import ShardClient
-
-
-def _normalize_number(num, boundary):
-    # Normalizes between 0 and 1
-    return float(num % boundary)/boundary
-
-
-def _hash_key(key, method, boundary):
-    hash_function = getattr(hashlib, method)
-    hashed_key = int(hash_function(str(key).encode()).hexdigest(), 16)
-
-    return _normalize_number(hashed_key, boundary)
+from .sharding import _normalize_number, _hash_key, MasterABC, Master, _Shards
 
 
 def _make_bins(num):
@@ -34,7 +20,6 @@ def _make_bins(num):
     return bins
 
 
-import abc
 from typing import Union, List, Tuple
 
 
@@ -82,68 +67,6 @@ class Shards:
         return self._shard_map.__getitem__(item)
 
 
-class MasterABC(abc.ABC):
-    @abc.abstractmethod
-    def get_shard(self, index, key: Key) -> Tuple[Hash, ShardClient]: ...
-    @abc.abstractmethod
-    def create_index(self, index): ...
-    @abc.abstractmethod
-    def stat(self): ...
-    @abc.abstractmethod
-    def close(self): ...
-
-
-class Master(MasterABC):
-    def __init__(self, shards: dict, hash_method: str='md5'):
-        self._shards = shards
-        self._hash_method = hash_method
-
-    @property
-    def shards(self):  # TODO: remove values method
-        return self._shards.values()
-    
-    def get_shard(self, index, key):
-        key_comp = self._join_key(index, key)
-        bin_, hash_ = self._get_bin(key_comp)
-        shard = self._shards[bin_]
-
-        return hash_, shard
-
-    def _join_key(self, *parts):
-        chain = []
-        for part in parts:
-            chain.append(str(part))  # TODO: make parts only string
-
-        return ':'.join(chain)
-
-    def _get_bin(self, key: Key) -> Tuple[Bin, Hash]:
-        bins = self._shards.bins
-        hash_ = _hash_key(key, self._hash_method, 1e7)
-        index = bisect.bisect_left(bins, hash_)-1
-        bin_ = bins[index]
-
-        return bin_, hash_
-
-    def create_index(self, index):
-        # TODO: update meta (for additional shards)
-        for shard in self.shards:
-            shard.create_index(index)
-
-    def drop_index(self, index):
-        # TODO: update meta (for additional shards)
-        for shard in self.shards:
-            shard.drop_index(index)
-
-    def stat(self):
-        stat = {}
-        for shard in self.shards:
-            stat[shard.name] = shard.get_stat()
-
-        return stat
-
-    def close(self):
-        self._shards.close()
-
 # class Master:
 #   _shard = Shard
 
@@ -258,11 +181,12 @@ class Master(MasterABC):
 def _bootstrap(conf_path=None, *args, **kwargs):
     master_token = kwargs.pop('token', None)
     config = _get_config(conf_path)
-    shards = _mkshards(config['shards'], *args, **kwargs)
+    shards = _mkshards(config['shards'], *args, lazy=True, **kwargs)
+    shards.connect()
     shards.get_master_role(master_token)
     with shards.lock():
-        _mark_shards(shards, config['shards'])
-        _config_shards(shards, config['shards'])
+        shards.each(_mark_shard, config['shards'])
+        shards.each(_config_shard, config['shards'])
 
     return shards
 
@@ -336,38 +260,6 @@ def _check_names(shards):
         names.add(name)
 
 
-class _Shards(dict):
-    def __init__(self, *args, **kwargs):
-        super(_Shards, self).__init__(*args, **kwargs)
-        self._bins = sorted(self.keys())
-
-    @property
-    def bins(self):
-        return self._bins
-
-    def get_master_role(self, token=None):
-        for shard in self.values():
-            shard.change_role('master', token)
-
-    @contextmanager
-    def lock(self):
-        for shard in self.values():
-            shard.lock_shard()
-        try:
-            yield
-        finally:
-            for shard in self.values():
-                shard.release_shard()
-
-    def close(self):
-        for shard in self.values():
-            shard.close()
-
-    def __setitem__(self, key, value):
-        super(_Shards, self).__setitem__(key, value)
-        bisect.insort_right(self._bins, key)
-
-
 def _mkshards(shards_conf, *args, **kwargs):
     shards = _Shards()
     for shard in shards_conf:
@@ -378,23 +270,21 @@ def _mkshards(shards_conf, *args, **kwargs):
     return shards
 
 
-def _mark_shards(shards, shards_conf):
-    for shard, shard_conf in zip(shards.values(), shards_conf):  # TODO: remove values method
-        start, end = shard_conf['start'], shard_conf['end']
-        shard.set_start(start)
-        shard.set_end(end)
+def _mark_shard(shard, shard_conf):
+    start, end = shard_conf['start'], shard_conf['end']
+    shard.set_start(start)
+    shard.set_end(end)
 
-        shard.update_distr()
+    shard.update_distr()
 
 
-def _config_shards(shards, shards_conf):
-    for shard, shard_conf in zip(shards.values(), shards_conf):
-        size = shard_conf.get('size', None)
-        if size:
-            shard.set_maxsize(size)
+def _config_shard(shard, shard_conf):
+    size = shard_conf.get('size', None)
+    if size:
+        shard.set_maxsize(size)
 
-        name = shard_conf['name']
-        shard.name = name
+    name = shard_conf['name']
+    shard.name = name
 
 
 class _Server(ServerBase): ...
@@ -418,8 +308,16 @@ class BootstrapServer(_Server):
         return hash_, shard.addr
 
     @_Server.endpoint('create_index')
-    async def create_index(self, index):
-        return self._master.create_index(index)
+    async def create_index(self, index, secondary=None):
+        return self._master.create_index(index, secondary)
+
+    @_Server.endpoint('aggregate')
+    async def aggregate(self, index, metrics, group_by=None, where=None):
+        result = self._master.aggregate(index, metrics, group_by, where)
+        if group_by is not None:  # json objects can't keep non-string group keys
+            result = list(result.items())
+
+        return result
 
     @_Server.endpoint('stat')
     async def stat(self):
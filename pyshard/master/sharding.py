@@ -0,0 +1,198 @@
+"""
+Client side of sharding: key hashing, shard lookup and fan-out over shard clients.
+Kept apart from bootstrap server so that clients don't import server modules.
+"""
+import abc
+import hashlib
+import bisect
+from contextlib import contextmanager
+from typing import Union, Tuple
+
+from ..settings import settings
+from ..shard.client import ShardClient
+from ..shard.query import merge_aggregates
+from ..shard.sketch import merge_histograms, merge_heavy_hitters
+
+
+Key = Union[int, float, str]
+Hash = float
+Bin = float
+
+
+class FanOutError(Exception):
+    """
+    Request sent to all shards failed on some of them, it may have succeeded on others
+    """
+    def __init__(self, errors):
+        """
+        :param errors: {shard address: exception}
+        """
+        self.errors = errors
+        failed = '; '.join(f'{host}:{port}: {err!r}' for (host, port), err in errors.items())
+        super(FanOutError, self).__init__(f'Failed on {len(errors)} shard(s): {failed}')
+
+
+def _normalize_number(num, boundary):
+    # Normalizes between 0 and 1
+    return float(num % boundary)/boundary
+
+
+def _hash_key(key, method, boundary):
+    hash_function = getattr(hashlib, method)
+    hashed_key = int(hash_function(str(key).encode()).hexdigest(), 16)
+
+    return _normalize_number(hashed_key, boundary)
+
+
+class MasterABC(abc.ABC):
+    @abc.abstractmethod
+    def get_shard(self, index, key: Key) -> Tuple[Hash, ShardClient]: ...
+    @abc.abstractmethod
+    def create_index(self, index, secondary=None): ...
+    @abc.abstractmethod
+    def stat(self): ...
+    @abc.abstractmethod
+    def close(self): ...
+
+
+class Master(MasterABC):
+    def __init__(self, shards: dict, hash_method: str='md5'):
+        self._shards = shards
+        self._hash_method = hash_method
+
+    @property
+    def shards(self):  # TODO: remove values method
+        return self._shards.values()
+    
+    def get_shard(self, index, key):
+        key_comp = self._join_key(index, key)
+        bin_, hash_ = self._get_bin(key_comp)
+        shard = self._shards[bin_]
+
+        return hash_, shard
+
+    def _join_key(self, *parts):
+        chain = []
+        for part in parts:
+            chain.append(str(part))  # TODO: make parts only string
+
+        return ':'.join(chain)
+
+    def _get_bin(self, key: Key) -> Tuple[Bin, Hash]:
+        bins = self._shards.bins
+        hash_ = _hash_key(key, self._hash_method, 1e7)
+        index = bisect.bisect_left(bins, hash_)-1
+        bin_ = bins[index]
+
+        return bin_, hash_
+
+    def create_index(self, index, secondary=None):
+        # TODO: update meta (for additional shards)
+        self._fan_out(lambda shard: shard.create_index(index, secondary))
+
+    def drop_index(self, index):
+        # TODO: update meta (for additional shards)
+        self._fan_out(lambda shard: shard.drop_index(index))
+
+    def _fan_out(self, func):
+        results, errors = self._shards.gather(func, settings.FAN_OUT_TIMEOUT)
+        if errors:
+            raise FanOutError({shard.addr: err for shard, err in errors.items()})
+
+        return list(results.values())
+
+    def aggregate(self, index, metrics, group_by=None, where=None):
+        partials = self._fan_out(lambda shard: shard.aggregate(index, metrics, group_by, where))
+
+        return merge_aggregates(partials, metrics, group_by)
+
+    def stat(self):
+        """
+        Returns stats of every shard and load histogram and hot keys merged over shards that answered
+
+        :return: {'shards': {name: stat}, 'load': histogram, 'hot_keys': heavy hitters,
+            'errors': [{'addr': shard address, 'error': message}, ...]}
+        """
+        results, errors = self._shards.gather(lambda shard: (shard.name, shard.get_stat()),
+                                              settings.FAN_OUT_TIMEOUT)
+        shards = dict(results.values())
+
+        return {
+            'shards': shards,
+            'load': merge_histograms(stat['load'] for stat in shards.values()),
+            'hot_keys': merge_heavy_hitters(stat['hot_keys'] for stat in shards.values()),
+            'errors': [{'addr': shard.addr, 'error': repr(err)} for shard, err in errors.items()]
+        }
+
+    def close(self):
+        self._shards.close()
+
+
+class _Shards(dict):
+    def __init__(self, *args, **kwargs):
+        super(_Shards, self).__init__(*args, **kwargs)
+        self._bins = sorted(self.keys())
+
+    @property
+    def bins(self):
+        return self._bins
+
+    def each(self, func, *iterables):
+        """
+        Calls func(shard, *items of iterables) for every shard in parallel
+
+        :return: list of results in shards order
+        """
+        shards = list(self.values())
+        if len(shards) < 2:
+            return list(map(func, shards, *iterables))
+
+        from concurrent.futures import ThreadPoolExecutor  # only servers and bootstrap need it
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            return list(executor.map(func, shards, *iterables))
+
+    def gather(self, func, timeout=None):
+        """
+        Calls func(shard) for every shard in parallel, failures of some shards don't stop others
+
+        :param timeout: seconds every shard request may take
+        :return: ({shard: result}, {shard: exception}) of succeeded and failed shards
+        """
+        def call(shard):
+            try:
+                with shard.timeout(timeout):
+                    return func(shard), None
+            except Exception as err:
+                return None, err
+
+        results, errors = {}, {}
+        for shard, (result, err) in zip(self.values(), self.each(call)):
+            if err is None:
+                results[shard] = result
+            else:
+                errors[shard] = err
+
+        return results, errors
+
+    def connect(self, timeout=None):
+        self.each(lambda shard: shard.connect(timeout))
+
+    def get_master_role(self, token=None):
+        self.each(lambda shard: shard.change_role('master', token))
+
+    @contextmanager
+    def lock(self):
+        self.each(lambda shard: shard.lock_shard())
+        try:
+            yield
+        finally:
+            self.each(lambda shard: shard.release_shard())
+
+    def close(self):
+        for shard in self.values():
+            shard.close()
+
+    def __setitem__(self, key, value):
+        super(_Shards, self).__setitem__(key, value)
+        bisect.insort_right(self._bins, key)
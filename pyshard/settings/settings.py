@@ -1,2 +1,90 @@
 AUTH = False
-BOOTSTRAP_SERVER = ['localhost', 9192]
\ No newline at end of file
+# servers event loop: 'asyncio', 'uvloop' or 'auto' (uvloop if installed)
+EVENT_LOOP = 'auto'
+BOOTSTRAP_SERVER = ['localhost', 9192]
+# attach trace to every client request
+TRACE = False
+# seconds, requests slower than threshold are logged with latency breakdown
+SLOW_REQUEST_THRESHOLD = 0.5
+# max requests of one connection waiting in server queue, reading from connection pauses above it
+MAX_IN_FLIGHT = 8
+# server answers 'busy' when default queue is filled above this ratio
+SHED_RATIO = 0.9
+# client retries of 'busy' responses and base of exponential backoff, seconds
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.01
+# scheduling of permission groups: {group: {'weight': 1, 'rate': requests per second, 'burst': 100}},
+# token options in server token storage override group ones
+QOS = {}
+# consecutive queued requests to endpoint with batch handler (e.g. shard writes) are handled
+# together: up to WRITE_BATCH_SIZE requests, waiting up to WRITE_BATCH_WINDOW seconds for more
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_WINDOW = 0.0
+# bytes, payloads larger than threshold are zlib compressed if both sides of connection enable it,
+# None disables compression
+COMPRESSION_THRESHOLD = None
+COMPRESSION_LEVEL = 1
+# bytes, chunk size of streamed blobs
+STREAM_CHUNK_SIZE = 1024 * 1024
+# bytes, peer sending larger frame (compressed or not) is disconnected, larger values have to be streamed
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# bytes, server keeps received stream in memory up to this size, spills it to temporary file above
+STREAM_SPOOL_SIZE = 16 * 1024 * 1024
+# seconds, timeout of connecting to server
+CONNECT_TIMEOUT = 5.0
+# seconds, shards answering requests sent to all of them (stat, create_index, drop_index, aggregate)
+# slower than this are reported failed
+FAN_OUT_TIMEOUT = 10.0
+# Pyshard connects to shards on first use ('lazy') or to all of them on start in parallel ('parallel')
+SHARD_CONNECT = 'lazy'
+# seconds, shard maps fetched from bootstrap server are reused by Pyshard instances of the process
+# for this time, MAP_CACHE_PATH (json file) shares them between processes too
+MAP_CACHE_TTL = 60.0
+MAP_CACHE_PATH = None
+# docs handled by shard maintenance (distribution update) before it lets other requests in
+MAINTENANCE_CHUNK_SIZE = 10000
+# seconds, shard dumps storage in background (forked process) this often, None disables it
+SNAPSHOT_INTERVAL = None
+# seconds, how often server checks whether background dump is done
+SNAPSHOT_POLL_INTERVAL = 0.1
+# shards count keys, bytes, reads and writes in this many equal buckets of hash space,
+# and track this many most accessed keys
+LOAD_HISTOGRAM_BUCKETS = 1024
+HOT_KEYS_CAPACITY = 64
+# hot keys sketch counts are halved after this many accesses, so it follows recent traffic
+HOT_KEYS_DECAY = 100000
+# key is hot when it gets at least this share of shard accesses (after HOT_KEY_MIN_ACCESSES
+# accesses counted), shard marks its reads hot in response metadata; None disables it
+HOT_KEY_SHARE = 0.01
+HOT_KEY_MIN_ACCESSES = 1000
+# seconds, Pyshard keeps reads of hot keys this long (stale reads of keys written by other
+# clients are possible meanwhile), None disables caching; max number of cached keys
+HOT_KEY_CACHE_TTL = None
+HOT_KEY_CACHE_SIZE = 1024
+# LSMStorage: bytes of logged writes kept in memtable before it is written to table file, number of
+# tables of index merged into one by compaction, keys per sparse index entry of table, bloom filter
+# bits per key (10 gives about 1% false positives), number of records read from tables kept in memory
+LSM_MEMTABLE_SIZE = 4 * 1024 * 1024
+LSM_COMPACTION_TABLES = 4
+LSM_INDEX_INTERVAL = 64
+LSM_BLOOM_BITS_PER_KEY = 10
+LSM_CACHE_SIZE = 10000
+# LSMStorage fsyncs write ahead log on every storage flush (group commit), OS flushes it otherwise
+LSM_SYNC = False
+# storages keep bloom filter of keys of every index: bits per key, keys filter is sized for at least
+# (filter is rebuilt for twice as many keys once it is full)
+BLOOM_FILTER_BITS_PER_KEY = 10
+BLOOM_FILTER_MIN_CAPACITY = 1024
+# seconds, Pyshard pulls bloom filters of shards this often to answer has and read of absent keys
+# locally (keys written by other clients meanwhile may be reported absent), None disables it
+BLOOM_FILTER_REFRESH = None
+# seconds, prepared transaction waiting longer for commit or abort is reported in doubt by shard stat,
+# its keys stay locked; seconds between first retries of commit or abort on shard that didn't answer;
+# seconds such retries go on before TransactionError is raised
+TRANSACTION_TIMEOUT = 30.0
+TRANSACTION_RETRY_BACKOFF = 0.1
+TRANSACTION_RETRY_TIMEOUT = 30.0
+# shard keeps at least this many last changes of docs for subscribers, their docs aren't counted
+# in shard max_size, None disables change log; max number of changes per chunk of change stream
+CHANGE_LOG_SIZE = None
+CHANGE_FEED_BATCH = 1000
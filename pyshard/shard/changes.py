@@ -0,0 +1,51 @@
+class ChangeLogError(Exception): ...
+
+
+class ChangeLog:
+    """
+    Last changes of shard docs numbered by increasing offsets: (offset, index, op, key, doc),
+    op is 'write' (doc is stored) or 'remove' (doc is None).
+
+    Keeps from size to 2 * size changes, older half is dropped at once, so that append
+    is amortized O(1) and changes are found by offset without search.
+    """
+    def __init__(self, size):
+        self._size = size
+        self._changes = []
+        self.next_offset = 0  # offset of next change
+        self.on_append = None  # called after every change, e.g. to wake up subscribers
+
+    @property
+    def first_offset(self):
+        return self.next_offset - len(self._changes)
+
+    def append(self, index, op, key, doc=None):
+        self._changes.append((self.next_offset, index, op, key, doc))
+        self.next_offset += 1
+        if len(self._changes) >= 2 * self._size:
+            del self._changes[:-self._size]
+        if self.on_append is not None:
+            self.on_append()
+
+    def read(self, index, offset, limit=None):
+        """
+        Returns changes of index from offset on
+
+        :param offset: offset of first change to read
+        :param limit: max number of changes
+        :return: ([[offset, op, key, doc], ...], offset to read following changes from)
+        """
+        first = self.first_offset
+        if not first <= offset <= self.next_offset:
+            raise ChangeLogError(f'Changes from offset {offset} are not kept, '
+                                 f'log has offsets from {first} to {self.next_offset}')
+
+        changes = []
+        position = offset - first
+        while position < len(self._changes) and (limit is None or len(changes) < limit):
+            change_offset, change_index, op, key, doc = self._changes[position]
+            if change_index == index:
+                changes.append([change_offset, op, key, doc])
+            position += 1
+
+        return changes, first + position
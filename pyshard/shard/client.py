@@ -1,5 +1,7 @@
 from ..core.typing import (Addr, Key, Hash, Doc, Offset)
-from ..core.client import ClientABC, ClientBase
+from ..core.client import ClientABC, ClientBase, ClientError
+from ..settings import settings
+from ..utils import iter_chunks
 
 
 def mkpipe(addr: Addr, **kwargs) -> ClientABC:
@@ -14,22 +16,110 @@ def mkpipe(addr: Addr, **kwargs) -> ClientABC:
 
 
 class ShardClient(ClientBase):
+    def __init__(self, host, port, **kwargs):
+        self._name = None  # shard names don't change once shards are configured
+
+        super(ShardClient, self).__init__(host, port, **kwargs)
+
     def write(self, index, key: Key, hash_: Hash, doc: Doc) -> Offset:
         record = {"record": doc, "hash_": hash_}
         return self._execute("write", index, key, **record)
 
+    def write_blob(self, index, key: Key, hash_: Hash, data, chunk_size=None) -> Offset:
+        """
+        Streams binary value to shard
+
+        :param data: bytes-like object or binary file object
+        :param chunk_size: bytes, settings.STREAM_CHUNK_SIZE by default
+        :return: value size or 0 if key exists
+        """
+        chunks = iter_chunks(data, chunk_size or settings.STREAM_CHUNK_SIZE)
+        return self._execute_stream("write_blob", chunks, index, key, hash_)
+
+    def read_blob(self, index, key: Key, file=None):
+        """
+        Streams binary value from shard
+
+        :param file: binary file object to write value to, value is returned if not set
+        :return: {'hash_': ..., 'blob': value} or {'hash_': ..., 'size': value size} if file is set,
+            None if there is no such key
+        """
+        meta = self._execute("read_blob", index, key)
+        if meta is None:
+            return None
+
+        chunks = self._recv_stream()
+        if file is None:
+            return {'hash_': meta['hash_'], 'blob': b''.join(chunks)}
+
+        for chunk in chunks:
+            file.write(chunk)
+        return meta
+
+    def remove_blob(self, index, key: Key):
+        return self._execute("remove_blob", index, key)
+
     def has(self, index, key: Key):
         return self._execute("has", index, key)
 
+    def bloom(self, index):
+        """
+        Returns bloom filter of index keys on shard, see BloomFilter.from_dict
+        """
+        return self._execute("bloom", index)
+
     def read(self, index, key: Key):
         return self._execute("read", index, key)
 
+    def subscribe(self, index, from_offset=None):
+        """
+        Follows changes of index on shard, connection is taken by stream for good
+
+        :param from_offset: offset of first change, changes made after subscription by default
+        :return: generator of [offset, op, key, doc], op is 'write' or 'remove' (doc is None)
+        """
+        self._execute("subscribe", index, from_offset)
+
+        return self._changes()
+
+    def _changes(self):
+        for chunk in self._recv_stream():
+            changes = self._deserialize(chunk.decode())
+            if isinstance(changes, dict):
+                raise ClientError(f'Couldn\'t follow changes: {changes["error"]}')
+
+            yield from changes
+
     def pop(self, index, key: Key):
         return self._execute("pop", index, key)
 
     def remove(self, index, key: Key):
         return self._execute("remove", index, key)
 
+    def update(self, index, key: Key, doc: Doc):
+        return self._execute("update", index, key, doc)
+
+    def upsert(self, index, key: Key, hash_: Hash, doc: Doc):
+        return self._execute("upsert", index, key, hash_, doc)
+
+    def cas(self, index, key: Key, hash_: Hash, expected_version, doc: Doc):
+        return self._execute("cas", index, key, hash_, expected_version, doc)
+
+    def incr(self, index, key: Key, hash_: Hash, amount=1):
+        return self._execute("incr", index, key, hash_, amount)
+
+    def prepare(self, txid, ops):
+        """
+        Locks keys of transaction changes on shard, see Shard.prepare
+        """
+        return self._execute("prepare", txid, ops)
+
+    def commit(self, txid):
+        return self._execute("commit", txid)
+
+    def abort(self, txid):
+        return self._execute("abort", txid)
+
     def open_pipe(self, host, port):
         return self._execute("open_pipe", (host, port))
 
@@ -60,8 +150,11 @@ class ShardClient(ClientBase):
     def update_distr(self):
         return self._execute("update_distr")
 
-    def create_index(self, index):
-        return self._execute("create_index", index)
+    def snapshot(self):
+        return self._execute("snapshot")
+
+    def create_index(self, index, secondary=None):
+        return self._execute("create_index", index, secondary=secondary)
 
     def drop_index(self, index):
         return self._execute("drop_index", index)
@@ -69,13 +162,38 @@ class ShardClient(ClientBase):
     def keys(self, index):  # TODO: bulk operation
         return self._execute("keys", index)
 
+    def find(self, index, field, value):
+        return self._execute("find", index, field, value)
+
+    def find_range(self, index, field, lo=None, hi=None):
+        return self._execute("find_range", index, field, lo=lo, hi=hi)
+
+    def range(self, index, lo=None, hi=None, limit=None, after=None):
+        return self._execute("range", index, lo=lo, hi=hi, limit=limit, after=after)
+
+    def prefix(self, index, prefix, limit=None, after=None):
+        return self._execute("prefix", index, prefix, limit=limit, after=after)
+
+    def query(self, index, where=None, fields=None, cursor=None, limit=None):
+        return self._execute("query", index, where=where, fields=fields, cursor=cursor, limit=limit)
+
+    def aggregate(self, index, metrics, group_by=None, where=None):
+        return self._execute("aggregate", index, metrics, group_by=group_by, where=where)
+
+    def metrics(self, format='json'):
+        return self._execute("metrics", format=format)
+
     def set_maxsize(self, size):
         return self._execute("set_maxsize", size)
 
     @property
     def name(self):
-        return self._execute("get_name")
+        if self._name is None:
+            self._name = self._execute("get_name")
+
+        return self._name
 
     @name.setter
     def name(self, name):
         self._execute("set_name", name)
+        self._name = name
@@ -0,0 +1,300 @@
+import json
+
+from ..storage.secondary import resolve_path, _MISSING
+
+
+def _eq(field, value):
+    return field == value
+
+
+def _ne(field, value):
+    return field != value
+
+
+def _compare(op):
+    def _wrapper(field, value):
+        try:
+            return op(field, value)
+        except TypeError:  # incomparable types never match
+            return False
+
+    return _wrapper
+
+
+OPERATORS = {
+    '$eq': _eq,
+    '$ne': _ne,
+    '$gt': _compare(lambda field, value: field > value),
+    '$gte': _compare(lambda field, value: field >= value),
+    '$lt': _compare(lambda field, value: field < value),
+    '$lte': _compare(lambda field, value: field <= value),
+    '$in': _compare(lambda field, value: field in value),
+    '$contains': _compare(lambda field, value: value in field),
+}
+
+
+class QueryError(Exception): ...
+
+
+def _is_condition(cond):
+    return isinstance(cond, dict) and cond and all(op.startswith('$') for op in cond)
+
+
+def compile_where(where):
+    """
+    Compiles predicate spec to function over record.
+
+    Spec is a dict {field path: condition} where all fields must match.
+    Condition is either a plain value (equality) or a dict of operators,
+    e.g. {'user.age': {'$gte': 18}, 'country': 'NL', 'email': {'$exists': True}}
+
+    :param where: predicate spec or None for match all
+    :return:
+    """
+    if not where:
+        return lambda record: True
+
+    checks = []
+    for path, cond in where.items():
+        if not _is_condition(cond):
+            cond = {'$eq': cond}
+        for op, value in cond.items():
+            checks.append(_compile_check(path, op, value))
+
+    def predicate(record):
+        for check in checks:
+            if not check(record):
+                return False
+        return True
+
+    return predicate
+
+
+def _compile_check(path, op, value):
+    if op == '$exists':
+        return lambda record: (resolve_path(record, path) is not _MISSING) == bool(value)
+
+    try:
+        operator = OPERATORS[op]
+    except KeyError:
+        raise QueryError(f'Unknown operator {op!r}')
+
+    def check(record):
+        field = resolve_path(record, path)
+        if field is _MISSING:
+            return False
+        return operator(field, value)
+
+    return check
+
+
+def equalities(where):
+    """
+    Yields (field path, value) pairs of equality conditions of predicate spec
+
+    :param where: predicate spec
+    :return:
+    """
+    for path, cond in (where or {}).items():
+        if not _is_condition(cond):
+            yield path, cond
+        elif '$eq' in cond:
+            yield path, cond['$eq']
+
+
+def project(record, fields):
+    """
+    Returns {field path: value} for fields present in record
+
+    :param record: user's record
+    :param fields: list of field paths or None for whole record
+    :return:
+    """
+    if fields is None:
+        return record
+
+    projection = {}
+    for path in fields:
+        field = resolve_path(record, path)
+        if field is not _MISSING:
+            projection[path] = field
+
+    return projection
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _group_key(value):
+    # group values become dict keys, unhashable ones are grouped by their json
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+
+    return value
+
+
+class _Count:
+    @staticmethod
+    def initial():
+        return 0
+
+    @staticmethod
+    def step(partial, field):
+        return partial + 1
+
+    @staticmethod
+    def merge(left, right):
+        return left + right
+
+    @staticmethod
+    def final(partial):
+        return partial
+
+
+class _Sum:
+    @staticmethod
+    def initial():
+        return 0
+
+    @staticmethod
+    def step(partial, field):
+        return partial + field if _is_number(field) else partial
+
+    merge = step
+
+    @staticmethod
+    def final(partial):
+        return partial
+
+
+def _extremum(pick):
+    class _Extremum:
+        @staticmethod
+        def initial():
+            return None
+
+        @staticmethod
+        def step(partial, field):
+            if partial is None:
+                return field
+            try:
+                return pick(partial, field)
+            except TypeError:  # incomparable values are skipped
+                return partial
+
+        merge = step
+
+        @staticmethod
+        def final(partial):
+            return partial
+
+    return _Extremum
+
+
+class _Avg:
+    @staticmethod
+    def initial():
+        return [0, 0]
+
+    @staticmethod
+    def step(partial, field):
+        if _is_number(field):
+            return [partial[0] + field, partial[1] + 1]
+        return partial
+
+    @staticmethod
+    def merge(left, right):
+        return [left[0] + right[0], left[1] + right[1]]
+
+    @staticmethod
+    def final(partial):
+        total, count = partial
+        return total / count if count else None
+
+
+AGGREGATES = {
+    'count': _Count,
+    'sum': _Sum,
+    'min': _extremum(min),
+    'max': _extremum(max),
+    'avg': _Avg,
+}
+
+
+def _compile_metrics(metrics):
+    compiled = {}
+    for alias, spec in metrics.items():
+        op, path = spec[0], (spec[1] if len(spec) > 1 else None)
+        try:
+            compiled[alias] = AGGREGATES[op], path
+        except KeyError:
+            raise QueryError(f'Unknown aggregate {op!r}')
+
+    return compiled
+
+
+def aggregate(records, metrics, group_by=None):
+    """
+    Computes mergeable partial aggregates over records.
+
+    Metrics spec is a dict {alias: [op, field path]} where op is one of
+    count, sum, min, max, avg, e.g. {'n': ['count'], 'total': ['sum', 'price']}.
+    Count without field path counts records, with field path - records having that field.
+
+    :param records: iterable of user's records
+    :param metrics: metrics spec
+    :param group_by: field path to group records by or None
+    :return: list of [group, {alias: partial}]
+    """
+    compiled = _compile_metrics(metrics)
+    groups = {}
+    for record in records:
+        group = None
+        if group_by is not None:
+            group = resolve_path(record, group_by)
+            group = None if group is _MISSING else _group_key(group)
+
+        partials = groups.get(group)
+        if partials is None:
+            partials = groups[group] = {alias: agg.initial() for alias, (agg, _) in compiled.items()}
+
+        for alias, (agg, path) in compiled.items():
+            if path is None:
+                field = None
+            else:
+                field = resolve_path(record, path)
+                if field is _MISSING:
+                    continue
+            partials[alias] = agg.step(partials[alias], field)
+
+    return [[group, partials] for group, partials in groups.items()]
+
+
+def merge_aggregates(partials_list, metrics, group_by=None):
+    """
+    Merges partial aggregates from several shards and finalizes them
+
+    :param partials_list: results of aggregate
+    :param metrics: metrics spec
+    :param group_by: field path records were grouped by or None
+    :return: {group: {alias: value}} or {alias: value} if not grouped
+    """
+    compiled = _compile_metrics(metrics)
+    merged = {}
+    for partials in partials_list:
+        for group, values in partials:
+            if group not in merged:
+                merged[group] = values
+                continue
+            for alias, (agg, _) in compiled.items():
+                merged[group][alias] = agg.merge(merged[group][alias], values[alias])
+
+    if group_by is None:
+        values = merged.get(None) or {alias: agg.initial() for alias, (agg, _) in compiled.items()}
+        return {alias: agg.final(values[alias]) for alias, (agg, _) in compiled.items()}
+
+    return {group: {alias: agg.final(values[alias]) for alias, (agg, _) in compiled.items()}
+            for group, values in merged.items()}
@@ -1,16 +1,25 @@
+import os
 import json
-
+import time
+import asyncio
 import logging
 
 from ..settings import settings
-from ..core.server import ServerBase
-from .shard import Shard
+from ..core.server import ServerBase, Stream, Reply
+from ..utils import iter_chunks
+from ..storage.errors import IndexNotFoundError
+from .shard import Shard, KeyLockedError
+from .changes import ChangeLogError
 from .client import mkpipe
 
 
 logger = logging.getLogger(__name__)
 
 
+def _write_args(index, key, hash_, record):
+    return index, key, hash_, record
+
+
 class _Server(ServerBase):
     def __init__(self, host, port, buffer_size, loop,
                  serialize=json.dumps, deserialize=json.loads,
@@ -31,26 +40,92 @@ class _Server(ServerBase):
 
 
 class ShardServer(_Server):
+    busy_errors = (KeyLockedError,)  # writes of keys locked by transaction are retried by clients
+
     def __init__(self, host, port, buffer_size=1024, loop=None, **shard_kwargs):
         self._shard = Shard(**shard_kwargs)
         self._pipe = None
+        self._snapshot = None
+        self._last_snapshot = None
+        self._distr_update = None
+        self._changed = None  # event set on next change, created by waiting subscribers
+        if self._shard.changes is not None:
+            self._shard.changes.on_append = self._notify_changes
 
         super(ShardServer, self).__init__(host, port, buffer_size, loop)
 
-    @_Server.endpoint('write')
+    async def _do_run(self):
+        if settings.SNAPSHOT_INTERVAL is None:
+            return await super(ShardServer, self)._do_run()
+
+        await asyncio.gather(super(ShardServer, self)._do_run(), self._snapshot_loop(settings.SNAPSHOT_INTERVAL))
+
+    async def _snapshot_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self._start_snapshot()
+
+    @_Server.endpoint('write', batch='write_batch')
     @_Server.with_shard_lock
     async def write(self, index, key, hash_, record):
         return self._shard.write(index, key, hash_, record)
 
+    @_Server.with_shard_lock
+    async def write_batch(self, requests):
+        results = [None] * len(requests)
+        positions, items = [], []
+        for i, (args, kwargs) in enumerate(requests):
+            try:
+                items.append(_write_args(*args, **kwargs))
+            except TypeError as err:
+                results[i] = err
+            else:
+                positions.append(i)
+
+        for i, result in zip(positions, self._shard.write_many(items)):
+            results[i] = result
+
+        return results
+
+    @_Server.endpoint('write_blob')
+    @_Server.with_shard_lock
+    async def write_blob(self, index, key, hash_, stream):
+        with stream:
+            return self._shard.write_blob(index, key, hash_, stream)
+
+    @_Server.endpoint('read_blob')
+    @_Server.with_shard_lock
+    async def read_blob(self, index, key):
+        doc = self._shard.read_blob(index, key)
+        if doc is None:
+            return None
+
+        blob = doc['blob']
+        return Stream({'hash_': doc['hash_'], 'size': len(blob)}, iter_chunks(blob, settings.STREAM_CHUNK_SIZE))
+
+    @_Server.endpoint('remove_blob')
+    @_Server.with_shard_lock
+    async def remove_blob(self, index, key):
+        return self._shard.remove_blob(index, key)
+
     @_Server.endpoint('has')
     @_Server.with_shard_lock
     async def has(self, index, key):
         return self._shard.has(index, key)
 
+    @_Server.endpoint('bloom')
+    @_Server.with_shard_lock
+    async def bloom(self, index):
+        return self._shard.bloom(index)
+
     @_Server.endpoint('read')
     @_Server.with_shard_lock
     async def read(self, index, key):
-        return self._shard.read(index, key)
+        doc = self._shard.read(index, key)
+        if self._shard.is_hot(index, key):
+            return Reply(doc, {'hot': True})
+
+        return doc
 
     @_Server.endpoint('pop')
     @_Server.with_shard_lock
@@ -62,6 +137,72 @@ class ShardServer(_Server):
     async def remove(self, index, key):
         return self._shard.remove(index, key)
 
+    @_Server.endpoint('update')
+    @_Server.with_shard_lock
+    async def update(self, index, key, record):
+        return self._shard.update(index, key, record)
+
+    @_Server.endpoint('upsert')
+    @_Server.with_shard_lock
+    async def upsert(self, index, key, hash_, record):
+        return self._shard.upsert(index, key, hash_, record)
+
+    @_Server.endpoint('cas')
+    @_Server.with_shard_lock
+    async def cas(self, index, key, hash_, expected_version, record):
+        return self._shard.cas(index, key, hash_, expected_version, record)
+
+    @_Server.endpoint('incr')
+    @_Server.with_shard_lock
+    async def incr(self, index, key, hash_, amount=1):
+        return self._shard.incr(index, key, hash_, amount)
+
+    @_Server.endpoint('prepare')
+    @_Server.with_shard_lock
+    async def prepare(self, txid, ops):
+        return self._shard.prepare(txid, ops)
+
+    @_Server.endpoint('commit')
+    @_Server.with_shard_lock
+    async def commit(self, txid):
+        return self._shard.commit(txid)
+
+    @_Server.endpoint('abort')
+    @_Server.with_shard_lock
+    async def abort(self, txid):
+        return self._shard.abort(txid)
+
+    @_Server.endpoint('subscribe')
+    @_Server.with_shard_lock
+    async def subscribe(self, index, from_offset=None):
+        if from_offset is None:
+            from_offset = self._shard.changes.next_offset if self._shard.changes is not None else 0
+        self._shard.read_changes(index, from_offset, 0)  # fails before stream is opened
+
+        return Stream(from_offset, self._feed(index, from_offset))
+
+    async def _feed(self, index, offset):
+        # chunk is json list of [offset, op, key, doc] or {'error': ...} ending the stream
+        while True:
+            try:
+                changes, offset = self._shard.read_changes(index, offset, settings.CHANGE_FEED_BATCH)
+            except (ChangeLogError, IndexNotFoundError) as err:
+                yield json.dumps({'error': f'{type(err).__name__}: {err}'}).encode()
+                return
+
+            if changes:
+                yield json.dumps(changes).encode()
+                continue
+
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            await self._changed.wait()
+
+    def _notify_changes(self):
+        changed, self._changed = self._changed, None
+        if changed is not None:
+            changed.set()
+
     @_Server.endpoint('open_pipe')
     @_Server.with_shard_lock
     async def open_pipe(self, *args, **kwargs):
@@ -92,7 +233,46 @@ class ShardServer(_Server):
     @_Server.endpoint('get_stat')
     @_Server.with_shard_lock
     async def get_stat(self):
-        return self._shard.get_stat()
+        stat = self._shard.get_stat()
+        stat['snapshot'] = {'running': self._snapshot_running, 'last': self._last_snapshot}
+
+        return stat
+
+    @property
+    def _snapshot_running(self):
+        return self._snapshot is not None and not self._snapshot.done()
+
+    @_Server.endpoint('snapshot', permission_group='master')
+    async def snapshot(self):
+        """
+        Starts dumping storage in background
+
+        :return: False if previous snapshot is still running
+        """
+        return self._start_snapshot()
+
+    def _start_snapshot(self):
+        if self._snapshot_running:
+            return False
+
+        self._snapshot = asyncio.ensure_future(self._take_snapshot())
+        return True
+
+    async def _take_snapshot(self):
+        started = time.time()
+        pid = self._shard.snapshot()
+        ok = True
+        if pid is not None:
+            while True:
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    break
+                await asyncio.sleep(settings.SNAPSHOT_POLL_INTERVAL)
+            ok = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+            if not ok:
+                logger.error(f'Snapshot process pid={pid} failed with status={status}')
+
+        self._last_snapshot = {'started': started, 'finished': time.time(), 'ok': ok}
 
     @_Server.endpoint('lock_shard', permission_group='master')
     async def lock_shard(self):
@@ -132,13 +312,21 @@ class ShardServer(_Server):
     async def set_end(self, value):
         self._shard.end = value
 
-    @_Server.endpoint('update_distr', permission_group='master')
+    @_Server.endpoint('update_distr', permission_group='master', exclusive=False)
     async def update_distr(self):
-        self._shard.update_distr()
+        # concurrent calls wait for the same recomputation
+        if self._distr_update is None or self._distr_update.done():
+            self._distr_update = asyncio.ensure_future(self._update_distr())
+
+        await asyncio.shield(self._distr_update)
+
+    async def _update_distr(self):
+        for _ in self._shard.iter_update_distr(settings.MAINTENANCE_CHUNK_SIZE):
+            await asyncio.sleep(0)  # let requests in between chunks
 
     @_Server.endpoint('create_index')
-    async def create_index(self, index):
-        self._shard.create_index(index)
+    async def create_index(self, index, secondary=None):
+        self._shard.create_index(index, secondary)
 
     @_Server.endpoint("drop_index")
     async def drop_index(self, index):
@@ -148,6 +336,36 @@ class ShardServer(_Server):
     async def keys(self, index):
         return self._shard.keys(index)
 
+    @_Server.endpoint('find')
+    @_Server.with_shard_lock
+    async def find(self, index, field, value):
+        return self._shard.find(index, field, value)
+
+    @_Server.endpoint('find_range')
+    @_Server.with_shard_lock
+    async def find_range(self, index, field, lo=None, hi=None):
+        return self._shard.find_range(index, field, lo, hi)
+
+    @_Server.endpoint('range')
+    @_Server.with_shard_lock
+    async def range(self, index, lo=None, hi=None, limit=None, after=None):
+        return self._shard.range(index, lo, hi, limit, after)
+
+    @_Server.endpoint('prefix')
+    @_Server.with_shard_lock
+    async def prefix(self, index, prefix, limit=None, after=None):
+        return self._shard.prefix(index, prefix, limit, after)
+
+    @_Server.endpoint('query')
+    @_Server.with_shard_lock
+    async def query(self, index, where=None, fields=None, cursor=None, limit=None):
+        return self._shard.query(index, where, fields, cursor, limit)
+
+    @_Server.endpoint('aggregate')
+    @_Server.with_shard_lock
+    async def aggregate(self, index, metrics, group_by=None, where=None):
+        return self._shard.aggregate(index, metrics, group_by, where)
+
     @_Server.endpoint('get_name')
     async def get_name(self):
         return self._shard.name
@@ -1,13 +1,39 @@
+import time
+import bisect
 from collections import defaultdict
 
+from ..settings import settings
 from ..storage import InMemoryStorage
+from ..storage.errors import IndexNotFoundError
+from ..storage.sorted import _order
 from .client import ShardClient
-from ..utils import get_size
+from .query import compile_where, equalities, project, aggregate
+from .sketch import LoadHistogram, HeavyHitters
+from .changes import ChangeLog, ChangeLogError
+
+
+class TransactionError(Exception): ...
+
+
+class KeyLockedError(TransactionError):
+    """
+    Key is locked by prepared transaction, its change can be retried once transaction is over
+    """
+
+
+def _record_path(field):
+    # secondary indexes are built over the user's record, not the whole doc
+    return f'record.{field}'
+
+
+def _version(doc):
+    # docs of dumps made before versions were kept count as first version
+    return 0 if doc is None else doc.get('version', 1)
 
 
 class Shard:
     def __init__(self, start, end, storage_class=InMemoryStorage, max_size=1024, bins_num=5,
-                 buffer_size=1024,
+                 buffer_size=1024, load_buckets=None, hot_keys=None, change_log_size=None,
                  **storage_kwargs):
         self._name = None
         self._empty = True
@@ -22,6 +48,14 @@ class Shard:
         self._bins_num = bins_num
         self._bin_step = self.estimate_bin_step()
         self._distr = defaultdict(int)
+        self._distr_changes = None
+        self._load_changes = None
+        self.load = LoadHistogram(load_buckets or settings.LOAD_HISTOGRAM_BUCKETS)
+        self.hot_keys = HeavyHitters(hot_keys or settings.HOT_KEYS_CAPACITY, settings.HOT_KEYS_DECAY)
+        self._locks = dict()  # (index, key): id of prepared transaction
+        self._transactions = dict()  # id: (prepare time, ops, reserved size)
+        change_log_size = settings.CHANGE_LOG_SIZE if change_log_size is None else change_log_size
+        self.changes = ChangeLog(change_log_size) if change_log_size else None
 
     @property
     def name(self):
@@ -36,11 +70,69 @@ class Shard:
         return self._distr
 
     def update_distr(self):
-        self._distr = defaultdict(int)
-        for doc in self.storage.values():
-            hash_ = doc['hash_']
-            bin_ = self._get_bin(hash_)
-            self._distr[bin_] += 1
+        for _ in self.iter_update_distr():
+            pass
+
+    def iter_update_distr(self, chunk_size=None):
+        """
+        Recomputes distribution and stored keys and bytes of load histogram over storage snapshot
+        chunk by chunk, yields after every chunk so that caller can handle requests meanwhile.
+        Writes and pops made meanwhile are counted too.
+
+        :param chunk_size: docs per chunk, all at once if not set
+        :return:
+        """
+        if self._distr_changes is not None:
+            raise RuntimeError('Distribution is already being recomputed')
+
+        distr = defaultdict(int)
+        load = LoadHistogram(self.load.buckets)
+        self._distr_changes = defaultdict(int)
+        self._load_changes = LoadHistogram(self.load.buckets)
+        try:
+            for docs in self.storage.chunked_values(chunk_size):
+                for doc in docs:
+                    distr[self._get_bin(doc['hash_'])] += 1
+                    load.add(doc['hash_'], 1, self._doc_size(doc))
+                yield
+            for bin_, change in self._distr_changes.items():
+                distr[bin_] += change
+            load.merge(self._load_changes)
+            load.reads, load.writes = self.load.reads, self.load.writes  # op counters are not rebuilt
+            self._distr, self.load = distr, load
+        finally:
+            self._distr_changes = None
+            self._load_changes = None
+
+    def _doc_size(self, doc):
+        return len(doc['blob']) if 'blob' in doc else self.storage.size_of(doc)
+
+    def _count(self, hash_, change, size):
+        bin_ = self._get_bin(hash_)
+        self._distr[bin_] += change
+        self.load.add(hash_, change, change * size)
+        if self._distr_changes is not None:  # distribution is being recomputed
+            self._distr_changes[bin_] += change
+            self._load_changes.add(hash_, change, change * size)
+
+    def is_hot(self, index, key):
+        """
+        Tells if key gets at least settings.HOT_KEY_SHARE of shard accesses
+        """
+        share = settings.HOT_KEY_SHARE
+        if share is None or self.hot_keys.total < settings.HOT_KEY_MIN_ACCESSES:
+            return False
+
+        return self.hot_keys.share((index, key)) >= share
+
+    def _access(self, index, key, hash_=None, write=False):
+        self.hot_keys.observe((index, key))
+        if hash_ is None:
+            return
+        if write:
+            self.load.write(hash_)
+        else:
+            self.load.read(hash_)
 
     @property
     def start(self):
@@ -85,52 +177,148 @@ class Shard:
         return self.max_size - self.size
 
     def write(self, index, key, hash_, record):
-        item_size = get_size(record)
-        if self.size + item_size > self.max_size:  # TODO replace memory control to storage
-            raise MemoryError(f'Wow! Such data! So big!')
+        return self._insert(index, key, {'hash_': hash_, 'record': record, 'version': 1})
 
-        doc = {'hash_': hash_, 'record': record}
+    def _insert(self, index, key, doc):
+        hash_ = doc['hash_']
+        self._check_unlocked(index, key)
+        self._access(index, key, hash_, write=True)
+        item_size = self.storage.size_of(doc)
+        if self.size + item_size > self.max_size:  # TODO replace memory control to storage
+            raise MemoryError('Wow! Such data! So big!')
 
         offset = self.storage.write(index, key, doc)
+        self.storage.flush()
         if offset == 0:  # TODO replace memory control to storage
             return 0
 
         self.size += item_size
 
-        bin_ = self._get_bin(hash_)
-        self.distr[bin_] += 1
+        self._count(hash_, 1, item_size)
+        self._log(index, 'write', key, doc)
 
         return item_size
 
+    def write_many(self, items):
+        """
+        Group commit: writes several records with one storage operation and one flush
+
+        :param items: list of (index, key, hash_, record)
+        :return: list of write results, exception instance for failed item
+        """
+        results = [None] * len(items)
+        accepted = []
+        reserved = 0
+        for i, (index, key, hash_, record) in enumerate(items):
+            try:
+                self._check_unlocked(index, key)
+            except KeyLockedError as err:
+                results[i] = err
+                continue
+            self._access(index, key, hash_, write=True)
+            doc = {'hash_': hash_, 'record': record, 'version': 1}
+            item_size = self.storage.size_of(doc)
+            if self.size + reserved + item_size > self.max_size:
+                results[i] = MemoryError('Wow! Such data! So big!')
+                continue
+            reserved += item_size
+            accepted.append((i, item_size, hash_, (index, key, doc)))
+
+        offsets = self.storage.write_many([doc for *_, doc in accepted])
+        self.storage.flush()
+
+        for (i, item_size, hash_, (index, key, doc)), offset in zip(accepted, offsets):
+            if isinstance(offset, Exception) or offset == 0:
+                results[i] = offset
+                continue
+
+            self.size += item_size
+            self._count(hash_, 1, item_size)
+            self._log(index, 'write', key, doc)
+            results[i] = item_size
+
+        return results
+
     def has(self, index, key):
         return self.storage.has(index, key)
 
+    def bloom(self, index):
+        return self.storage.bloom(index)
+
     def read(self, index, key):
-        return self.storage.read(index, key)
+        doc = self.storage.read(index, key)
+        self._access(index, key, doc and doc['hash_'])
+
+        return doc
 
     def pop(self, index, key):
+        self._check_unlocked(index, key)
         doc = self.storage.pop(index, key)
+        self._access(index, key, doc and doc['hash_'], write=True)
         if doc is None:
             return
 
-        item_size = get_size(doc['record'])
+        item_size = self.storage.size_of(doc)
         self.size -= item_size
 
-        bin_ = self._get_bin(doc['hash_'])
-        self.distr[bin_] -= 1
+        self._count(doc['hash_'], -1, item_size)
+        self._log(index, 'remove', key)
 
         return doc
 
     def remove(self, index, key):
+        self._check_unlocked(index, key)
         doc = self.storage.pop(index, key)
+        self._access(index, key, doc and doc['hash_'], write=True)
         if doc is None:
             return 0
 
-        item_size = get_size(doc['record'])
+        item_size = self.storage.size_of(doc)
         self.size -= item_size
 
-        bin_ = self._get_bin(doc['hash_'])
-        self.distr[bin_] -= 1
+        self._count(doc['hash_'], -1, item_size)
+        self._log(index, 'remove', key)
+
+        return item_size
+
+    def write_blob(self, index, key, hash_, stream):
+        """
+        Writes binary value
+
+        :param stream: binary file object with value
+        :return: value size or 0 if key exists
+        """
+        self._access(index, key, hash_, write=True)
+        data = stream.read()
+        item_size = len(data)
+        if self.size + item_size > self.max_size:
+            raise MemoryError('Wow! Such data! So big!')
+
+        offset = self.storage.write_blob(index, key, {'hash_': hash_, 'blob': data})
+        self.storage.flush()
+        if offset == 0:
+            return 0
+
+        self.size += item_size
+        self._count(hash_, 1, item_size)
+
+        return item_size
+
+    def read_blob(self, index, key):
+        doc = self.storage.read_blob(index, key)
+        self._access(index, key, doc and doc['hash_'])
+
+        return doc
+
+    def remove_blob(self, index, key):
+        doc = self.storage.pop_blob(index, key)
+        self._access(index, key, doc and doc['hash_'], write=True)
+        if doc is None:
+            return 0
+
+        item_size = len(doc['blob'])
+        self.size -= item_size
+        self._count(doc['hash_'], -1, item_size)
 
         return item_size
 
@@ -139,12 +327,203 @@ class Shard:
         item = pipe.pop(index, key)
 
         if item:
-            return self.write(index, key, **item)
+            return self._insert(index, key, item)  # keeps version, so that cas of relocated key works
         else:
             return 0
 
-    def create_index(self, index):
-        self.storage.create_index(index)
+    def update(self, index, key, record):
+        """
+        Replaces record of existing key
+
+        :return: new version of doc or None if there is no such key
+        """
+        self._check_unlocked(index, key)
+        doc = self.storage.read(index, key)
+        self._access(index, key, doc and doc['hash_'], write=True)
+        if doc is None:
+            return None
+
+        return self._replace(index, key, doc['hash_'], record, doc)
+
+    def upsert(self, index, key, hash_, record):
+        """
+        Writes record whether key exists or not
+
+        :return: new version of doc, 1 if key was written first time
+        """
+        self._check_unlocked(index, key)
+        self._access(index, key, hash_, write=True)
+
+        return self._replace(index, key, hash_, record, self.storage.read(index, key))
+
+    def cas(self, index, key, hash_, expected_version, record):
+        """
+        Compare-and-set: replaces record if doc version is still expected_version
+
+        :param expected_version: version of doc read before, 0 if key must not exist
+        :return: new version of doc or None if version doesn't match
+        """
+        self._check_unlocked(index, key)
+        self._access(index, key, hash_, write=True)
+        doc = self.storage.read(index, key)
+        if _version(doc) != expected_version:
+            return None
+
+        return self._replace(index, key, hash_, record, doc)
+
+    def incr(self, index, key, hash_, amount=1):
+        """
+        Adds amount to numeric record, missing key counts as 0
+
+        :return: new record value
+        """
+        self._check_unlocked(index, key)
+        self._access(index, key, hash_, write=True)
+        doc = self.storage.read(index, key)
+        value = 0 if doc is None else doc['record']
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise TypeError(f'Can\'t increment record of type {type(value).__name__}')
+
+        value += amount
+        self._replace(index, key, hash_, value, doc)
+
+        return value
+
+    def _replace(self, index, key, hash_, record, old):
+        # stores record in place of old doc (None if key is absent) as its next version
+        doc = {'hash_': hash_, 'record': record, 'version': _version(old) + 1}
+        item_size = self.storage.size_of(doc)
+        old_size = 0 if old is None else self.storage.size_of(old)
+        if self.size + item_size - old_size > self.max_size:
+            raise MemoryError('Wow! Such data! So big!')
+
+        self.storage.replace(index, key, doc)
+        self.storage.flush()
+
+        self.size += item_size - old_size
+        if old is not None:
+            self._count(old['hash_'], -1, old_size)
+        self._count(hash_, 1, item_size)
+        self._log(index, 'write', key, doc)
+
+        return doc['version']
+
+    def _log(self, index, op, key, doc=None):
+        if self.changes is not None:
+            self.changes.append(index, op, key, doc)
+
+    def read_changes(self, index, offset, limit=None):
+        """
+        Returns changes of index from offset on, see ChangeLog.read
+        """
+        if self.changes is None:
+            raise ChangeLogError('Change log is disabled')
+        if index not in self.storage.indexes:
+            raise IndexNotFoundError(index)
+
+        return self.changes.read(index, offset, limit)
+
+    def _check_unlocked(self, index, key):
+        if not self._locks:
+            return
+
+        txid = self._locks.get((index, key))
+        if txid is not None:
+            raise KeyLockedError(f'Key {key!r} of index={index!r} is locked by transaction {txid}')
+
+    def in_doubt(self):
+        """
+        Returns ids of transactions prepared more than settings.TRANSACTION_TIMEOUT seconds ago.
+        Shard doesn't abort them on its own, since coordinator may have committed them on other shards
+        """
+        prepared_before = time.monotonic() - settings.TRANSACTION_TIMEOUT
+        return [txid for txid, (prepared, _, _) in self._transactions.items() if prepared <= prepared_before]
+
+    def prepare(self, txid, ops):
+        """
+        First phase of two-phase commit: checks changes of transaction and locks their keys,
+        so that only commit or abort of transaction changes them. Other keys are not blocked
+
+        :param txid: transaction id
+        :param ops: [[kind, index, key, hash_, record, expected_version], ...], kind is 'set' or 'remove',
+            doc version is checked unless expected_version is None (0 for absent key)
+        :return: True
+        """
+        if txid in self._transactions:
+            raise TransactionError(f'Transaction {txid} is already prepared')
+
+        docs = dict()  # (index, key): doc after earlier ops of transaction
+        growth = reserved = 0
+        for kind, index, key, hash_, record, expected_version in ops:
+            if kind not in ('set', 'remove'):
+                raise TransactionError(f'Unknown transaction operation: {kind!r}')
+            self._check_unlocked(index, key)
+            doc = docs[(index, key)] if (index, key) in docs else self.storage.read(index, key)
+            if expected_version is not None and _version(doc) != expected_version:
+                raise TransactionError(f'Key {key!r} of index={index!r} has version {_version(doc)}, '
+                                       f'expected {expected_version}')
+
+            growth -= 0 if doc is None else self.storage.size_of(doc)
+            if kind == 'set':
+                docs[(index, key)] = {'hash_': hash_, 'record': record, 'version': _version(doc) + 1}
+                growth += self.storage.size_of(docs[(index, key)])
+            else:
+                docs[(index, key)] = None
+            reserved = max(reserved, growth)
+
+        if self.size + reserved > self.max_size:
+            raise MemoryError('Wow! Such data! So big!')
+
+        self.size += reserved  # nothing else can take memory commit needs
+        for lock in docs:
+            self._locks[lock] = txid
+        self._transactions[txid] = (time.monotonic(), ops, reserved)
+
+        return True
+
+    def commit(self, txid):
+        """
+        Second phase of two-phase commit: applies changes of prepared transaction and unlocks its keys
+
+        :return: results of ops in order: new doc version for set, removed size for remove
+        """
+        entry = self._transactions.get(txid)
+        if entry is None:
+            raise TransactionError(f'Transaction {txid} is not prepared')
+        self.abort(txid)  # releases keys and reserved memory, changes below take it
+
+        results = []
+        for kind, index, key, hash_, record, _ in entry[1]:
+            if kind == 'set':
+                self._access(index, key, hash_, write=True)
+                results.append(self._replace(index, key, hash_, record, self.storage.read(index, key)))
+            else:
+                results.append(self.remove(index, key))
+
+        return results
+
+    def abort(self, txid):
+        """
+        Unlocks keys of prepared transaction without changing them
+
+        :return: False if transaction is not prepared
+        """
+        entry = self._transactions.pop(txid, None)
+        if entry is None:
+            return False
+
+        _, ops, reserved = entry
+        self.size -= reserved
+        for _, index, key, *_ in ops:
+            if self._locks.get((index, key)) == txid:
+                del self._locks[(index, key)]
+
+        return True
+
+    def create_index(self, index, secondary=None):
+        if secondary:
+            secondary = {_record_path(field): kind for field, kind in secondary.items()}
+        self.storage.create_index(index, secondary)
 
     def drop_index(self, index):
         self.storage.drop_index(index)
@@ -152,6 +531,59 @@ class Shard:
     def keys(self, index):
         return self.storage.keys(index)
 
+    def find(self, index, field, value):
+        return self.storage.find(index, _record_path(field), value)
+
+    def find_range(self, index, field, lo=None, hi=None):
+        return self.storage.find_range(index, _record_path(field), lo, hi)
+
+    def range(self, index, lo=None, hi=None, limit=None, after=None):
+        return self.storage.range(index, lo, hi, limit, after)
+
+    def prefix(self, index, prefix, limit=None, after=None):
+        return self.storage.prefix(index, prefix, limit, after)
+
+    def query(self, index, where=None, fields=None, cursor=None, limit=None):
+        """
+        Scans index and returns page of matching docs with projected records
+
+        :param index: index name
+        :param where: predicate spec (see query.compile_where)
+        :param fields: record field paths to return, None for whole record
+        :param cursor: cursor of previous page to continue scan after, None for first page
+        :param limit: max number of docs in page
+        :return: {'items': [[key, doc], ...], 'cursor': next cursor or None}
+        """
+        predicate = compile_where(where)
+        items = []
+        for position, key, doc in self._candidates(index, where, cursor):
+            if not predicate(doc['record']):
+                continue
+
+            items.append([key, {'hash_': doc['hash_'], 'record': project(doc['record'], fields)}])
+            if limit is not None and len(items) >= limit:
+                return {'items': items, 'cursor': position}
+
+        return {'items': items, 'cursor': None}
+
+    def _candidates(self, index, where, after=None):
+        # (cursor, key, doc) after cursor, scan is narrowed down to secondary index lookup if predicate allows
+        secondary = self.storage.secondary_indexes(index)
+        for field, value in equalities(where):
+            if _record_path(field) in secondary:
+                found = sorted(self.find(index, field, value), key=lambda item: _order(item[0]))
+                start = 0 if after is None else bisect.bisect_right([_order(key) for key, _ in found], _order(after))
+                return ((key, key, doc) for key, doc in found[start:])
+
+        return self.storage.scan(index, after)
+
+    def aggregate(self, index, metrics, group_by=None, where=None):
+        predicate = compile_where(where)
+        records = (doc['record'] for _, _, doc in self._candidates(index, where)
+                   if predicate(doc['record']))
+
+        return aggregate(records, metrics, group_by)
+
     def get_stat(self):
         stat = {
             'start': self.start,
@@ -159,10 +591,16 @@ class Shard:
             'empty': self.empty,
             'max_size': self.max_size,
             'free_mem': self.free_mem,
-            'distribution': dict(self.distr)
+            'distribution': dict(self.distr),
+            'load': self.load.snapshot(),
+            'hot_keys': self.hot_keys.snapshot(),
+            'transactions': {'prepared': len(self._transactions), 'in_doubt': self.in_doubt()}
         }
 
         return stat
 
+    def snapshot(self):
+        return self.storage.snapshot()
+
     def close(self):
         self.storage.stop()
@@ -0,0 +1,245 @@
+import heapq
+import itertools
+
+
+class LoadHistogram:
+    """
+    Keys, bytes, reads and writes per bucket of hash space [0, 1).
+
+    Buckets don't depend on shard range, so histograms of different shards
+    (or of one shard before and after its range changed) merge by summing.
+    """
+    __slots__ = ('buckets', 'keys', 'bytes', 'reads', 'writes')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.keys = [0] * buckets
+        self.bytes = [0] * buckets
+        self.reads = [0] * buckets
+        self.writes = [0] * buckets
+
+    def _bucket(self, hash_):
+        return min(int(hash_ * self.buckets), self.buckets - 1)
+
+    def add(self, hash_, keys, size):
+        """
+        Counts stored (positive keys and size) or deleted (negative ones) doc
+        """
+        bucket = self._bucket(hash_)
+        self.keys[bucket] += keys
+        self.bytes[bucket] += size
+
+    def read(self, hash_):
+        self.reads[self._bucket(hash_)] += 1
+
+    def write(self, hash_):
+        self.writes[self._bucket(hash_)] += 1
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError(f'Can\'t merge histograms of {self.buckets} and {other.buckets} buckets')
+
+        for mine, theirs in ((self.keys, other.keys), (self.bytes, other.bytes),
+                             (self.reads, other.reads), (self.writes, other.writes)):
+            for bucket, value in enumerate(theirs):
+                mine[bucket] += value
+
+    def snapshot(self):
+        """
+        Returns json serializable histogram: {'buckets': n, 'load': {bucket: [keys, bytes, reads, writes]}}
+        with empty buckets left out
+        """
+        load = {}
+        for bucket, row in enumerate(zip(self.keys, self.bytes, self.reads, self.writes)):
+            if any(row):
+                load[str(bucket)] = list(row)
+
+        return {'buckets': self.buckets, 'load': load}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        histogram = cls(snapshot['buckets'])
+        for bucket, (keys, size, reads, writes) in snapshot['load'].items():
+            bucket = int(bucket)
+            histogram.keys[bucket] = keys
+            histogram.bytes[bucket] = size
+            histogram.reads[bucket] = reads
+            histogram.writes[bucket] = writes
+
+        return histogram
+
+
+def merge_histograms(snapshots):
+    """
+    Merges LoadHistogram snapshots (e.g. of all shards) into one
+
+    :param snapshots: LoadHistogram.snapshot results of equal number of buckets
+    :return: snapshot of merged histogram or None if there are no snapshots
+    """
+    merged = None
+    for snapshot in snapshots:
+        histogram = LoadHistogram.from_snapshot(snapshot)
+        if merged is None:
+            merged = histogram
+        else:
+            merged.merge(histogram)
+
+    return merged.snapshot() if merged is not None else None
+
+
+class HeavyHitters:
+    """
+    Space-Saving sketch of most frequent items.
+
+    Keeps at most `capacity` counters. New item takes over the smallest
+    counter and inherits its count as error, so count - error <= true count <= count.
+    Items with true frequency above total / capacity are always kept.
+    Smallest counter is found with lazy min-heap of (count, item) once sketch is full:
+    every count change pushes an entry, outdated entries are skipped when popped.
+    """
+    def __init__(self, capacity, decay=None):
+        """
+        :param capacity: max number of counters
+        :param decay: counts are halved after every `decay` observations, so that sketch
+            follows recent traffic, None keeps counting forever
+        """
+        self.capacity = capacity
+        self.total = 0
+        self._decay = decay
+        self._since_decay = 0
+        self._counts = dict()
+        self._errors = dict()
+        self._heap = None  # [(count, seq, item)], built when sketch gets full
+        self._seq = itertools.count()  # items are never compared
+
+    def __len__(self):
+        return len(self._counts)
+
+    def observe(self, item, count=1):
+        self.total += count
+        if self._decay is not None:
+            self._since_decay += count
+            if self._since_decay >= self._decay:
+                self._halve()
+
+        counts = self._counts
+        if item in counts:
+            counts[item] += count
+            self._push(item)
+            return
+
+        if len(counts) < self.capacity:
+            counts[item] = count
+            self._errors[item] = 0
+            self._push(item)
+            return
+
+        evicted = self._pop_min()
+        error = counts.pop(evicted)
+        del self._errors[evicted]
+        counts[item] = error + count
+        self._errors[item] = error
+        self._push(item)
+
+    def _push(self, item):
+        if self._heap is None:
+            return
+        if len(self._heap) > 2 * self.capacity:  # drop outdated entries
+            self._heap = None
+            self._build_heap()
+            return
+
+        heapq.heappush(self._heap, (self._counts[item], next(self._seq), item))
+
+    def _build_heap(self):
+        self._heap = [(count, next(self._seq), item) for item, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        if self._heap is None:
+            self._build_heap()
+        while True:
+            count, _, item = heapq.heappop(self._heap)
+            if self._counts.get(item) == count:
+                return item
+
+    def _halve(self):
+        self._since_decay = 0
+        self._heap = None
+        self.total //= 2
+        for item in list(self._counts):
+            count = self._counts[item] // 2
+            if count:
+                self._counts[item] = count
+                self._errors[item] //= 2
+            else:
+                del self._counts[item]
+                del self._errors[item]
+
+    def share(self, item):
+        """
+        Returns share of observations guaranteed to be item's, 0 for items not kept
+        """
+        count = self._counts.get(item)
+        if count is None or not self.total:
+            return 0.0
+
+        return (count - self._errors[item]) / self.total
+
+    def top(self, n=None):
+        """
+        Returns [(item, count, error), ...] ordered by count descending
+
+        :param n: number of items, all kept items if not set
+        """
+        n = len(self._counts) if n is None else n
+        items = heapq.nlargest(n, self._counts.items(), key=lambda item: item[1])
+
+        return [(item, count, self._errors[item]) for item, count in items]
+
+    def snapshot(self):
+        return {'capacity': self.capacity,
+                'total': self.total,
+                'items': [[list(item) if isinstance(item, tuple) else item, count, error]
+                          for item, count, error in self.top()]}
+
+
+def merge_heavy_hitters(snapshots, capacity=None):
+    """
+    Merges HeavyHitters snapshots by summing counts and errors of equal items.
+    Item missing from full sketch may have up to its smallest count there, so that count
+    is added to item's count and error to keep count - error <= true count <= count
+
+    :param snapshots: HeavyHitters.snapshot results
+    :param capacity: number of items to keep, the largest snapshot capacity if not set
+    :return: merged snapshot
+    """
+    snapshots = list(snapshots)
+    counts, errors = dict(), dict()
+    largest = total = 0
+    for snapshot in snapshots:
+        largest = max(largest, snapshot['capacity'])
+        total += snapshot['total']
+        for item, count, error in snapshot['items']:
+            item = tuple(item) if isinstance(item, list) else item
+            counts[item] = counts.get(item, 0) + count
+            errors[item] = errors.get(item, 0) + error
+
+    for snapshot in snapshots:
+        items = snapshot['items']
+        if not items or len(items) < snapshot['capacity']:  # sketch counts every item it has seen
+            continue
+        smallest = min(count for _, count, _ in items)
+        present = {tuple(item) if isinstance(item, list) else item for item, _, _ in items}
+        for item in counts:
+            if item not in present:
+                counts[item] += smallest
+                errors[item] += smallest
+
+    capacity = largest if capacity is None else capacity
+    top = heapq.nlargest(capacity, counts.items(), key=lambda item: item[1])
+
+    return {'capacity': capacity,
+            'total': total,
+            'items': [[list(item) if isinstance(item, tuple) else item, count, errors[item]]
+                      for item, count in top]}
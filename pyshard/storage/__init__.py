@@ -1,6 +1,8 @@
 from .inmemory import InMemoryStorage
+from .sorted import SortedStorage
+from .lsm import LSMStorage
 
 
 __all__ = [
-    'InMemoryStorage'
+    'InMemoryStorage', 'SortedStorage', 'LSMStorage'
 ]
@@ -1,17 +1,44 @@
+from ..utils import get_size
+
+
 class BaseStorage:
     def read(self, index, key): ...
     def write(self, index, key, record): ...
     def pop(self, index, key): ...
+    def replace(self, index, key, record): ...
     def remove(self, index, key): ...
+    def write_many(self, items): ...
+    def write_blob(self, index, key, doc): ...
+    def read_blob(self, index, key): ...
+    def pop_blob(self, index, key): ...
+    def blob_values(self): ...
+    def flush(self): ...
+    def bloom(self, index): ...
+    def snapshot(self): ...
 
-    def create_index(self, index): ...
+    def create_index(self, index, secondary=None): ...
     def drop_index(self, index): ...
 
     def values(self): ...
+    def chunked_values(self, chunk_size=None): ...
     def index_values(self, index): ...
+    def items(self, index): ...
+    def scan(self, index, after=None): ...
+    def range(self, index, lo=None, hi=None, limit=None, after=None): ...
+    def prefix(self, index, prefix, limit=None, after=None): ...
 
     def empty(self): ...
 
     def _get_index(self, index): ...
 
     def keys(self, index): ...
+
+    def find(self, index, path, value): ...
+    def find_range(self, index, path, lo=None, hi=None): ...
+    def secondary_indexes(self, index): ...
+
+    def size_of(self, doc):
+        """
+        Returns memory doc takes once stored, shard counts it against its max_size
+        """
+        return get_size(doc['record'])
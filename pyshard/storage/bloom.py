@@ -0,0 +1,107 @@
+import json
+import base64
+import hashlib
+
+from ..settings import settings
+
+
+def _key_bytes(key):
+    if isinstance(key, float) and key.is_integer():  # 1.0 and 1 are the same key
+        key = int(key)
+
+    return json.dumps(key).encode()
+
+
+class BloomFilter:
+    """
+    Set of keys answering `key in bloom` with false positives only:
+    key that was never added is reported absent with probability 1 - error rate
+    """
+    __slots__ = ('size', 'hashes', '_bits')
+
+    def __init__(self, size, hashes, bits=None):
+        """
+        :param size: number of bits
+        :param hashes: number of bits set per key
+        :param bits: bytearray of filter state
+        """
+        self.size = size
+        self.hashes = hashes
+        self._bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, bits_per_key=10):
+        """
+        Returns empty filter for capacity keys, 10 bits per key give about 1% false positives
+        """
+        return cls(max(64, capacity * bits_per_key), max(1, round(bits_per_key * 0.69)))
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(_key_bytes(key), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def to_dict(self):
+        return {'size': self.size, 'hashes': self.hashes, 'bits': base64.b64encode(bytes(self._bits)).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['size'], data['hashes'], bytearray(base64.b64decode(data['bits'])))
+
+
+class KeyFilter:
+    """
+    Bloom filter of keys of one index. Removed keys can't be taken out of the filter,
+    so it is rebuilt from index keys once added keys outgrow its capacity (`full`)
+    or removed keys make half of them (`stale`)
+    """
+    def __init__(self, keys=(), bits_per_key=None, min_capacity=None):
+        """
+        :param keys: keys index has
+        :param bits_per_key: settings.BLOOM_FILTER_BITS_PER_KEY by default
+        :param min_capacity: settings.BLOOM_FILTER_MIN_CAPACITY by default
+        """
+        self._bits_per_key = bits_per_key or settings.BLOOM_FILTER_BITS_PER_KEY
+        self._min_capacity = min_capacity or settings.BLOOM_FILTER_MIN_CAPACITY
+        self.rebuild(keys)
+
+    def rebuild(self, keys):
+        keys = list(keys)
+        self.capacity = max(self._min_capacity, 2 * len(keys))
+        self.filter = BloomFilter.for_capacity(self.capacity, self._bits_per_key)
+        for key in keys:
+            self.filter.add(key)
+        self.added = len(keys)
+        self.removed = 0
+
+    def add(self, key):
+        self.filter.add(key)
+        self.added += 1
+
+    def discard(self, key):
+        self.removed += 1
+
+    def __contains__(self, key):
+        return key in self.filter
+
+    @property
+    def full(self):
+        return self.added > self.capacity
+
+    @property
+    def stale(self):
+        return self.removed * 2 > self.added
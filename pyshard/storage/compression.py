@@ -0,0 +1,58 @@
+import sys
+import json
+import zlib
+
+from ..utils import get_size
+
+
+class Compressed:
+    """
+    Record kept as zlib compressed json
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.data.__sizeof__()
+
+
+def compress(record, threshold, level=1):
+    """
+    Returns Compressed record if its json is not shorter than threshold and compresses well, record otherwise
+
+    :param record: json serializable record
+    :param threshold: bytes, None disables compression
+    :param level: zlib compression level
+    :return:
+    """
+    if threshold is None:
+        return record
+
+    encoded = json.dumps(record).encode()
+    if len(encoded) < threshold:
+        return record
+
+    data = zlib.compress(encoded, level)
+    if len(data) >= len(encoded):
+        return record
+
+    return Compressed(data)
+
+
+def stored_size(doc):
+    """
+    Returns memory doc takes in storage: size of compressed data or of uncompressed record
+    """
+    if isinstance(doc, Compressed):
+        return sys.getsizeof(doc)
+
+    return get_size(doc['record'])
+
+
+def decompress(record):
+    if isinstance(record, Compressed):
+        return json.loads(zlib.decompress(record.data))
+
+    return record
@@ -1,2 +1,6 @@
 class IndexNotFoundError(Exception): ...
 class IndexExistsError(Exception): ...
+class SecondaryIndexError(Exception): ...
+class SecondaryIndexNotFoundError(SecondaryIndexError): ...
+class UnorderedStorageError(Exception): ...
+class UnorderableKeyError(Exception): ...
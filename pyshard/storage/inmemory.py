@@ -1,14 +1,64 @@
 import os
 import json
+import base64
+import bisect
 
 from .base import BaseStorage
-from .errors import IndexNotFoundError, IndexExistsError
+from .errors import IndexNotFoundError, IndexExistsError, SecondaryIndexNotFoundError, UnorderedStorageError
+from .secondary import make_secondary_index
+from .compression import compress, decompress, stored_size
+from .bloom import KeyFilter
+
+
+class ScanOrder:
+    """
+    Keys of index numbered by increasing positions in write order, so that scan resumes after
+    position whatever was written or popped meanwhile. Popped keys are dropped from entries
+    once they make half of them
+    """
+    def __init__(self):
+        self._positions = dict()  # key: position
+        self._entries = []  # (position, key) in position order
+        self._next = 0
+
+    def add(self, key):
+        self._positions[key] = self._next
+        self._entries.append((self._next, key))
+        self._next += 1
+
+    def discard(self, key):
+        self._positions.pop(key, None)
+        if len(self._entries) > 2 * len(self._positions) + 64:
+            self._entries = [(position, key) for position, key in self._entries
+                             if self._positions.get(key) == position]
+
+    def scan(self, after=None):
+        """
+        Yields (position, key) after position
+        """
+        entries = self._entries
+        i = 0 if after is None else bisect.bisect_left(entries, (after + 1,))  # positions are unique
+        for position, key in entries[i:]:
+            if self._positions.get(key) == position:
+                yield position, key
 
 
 class InMemoryStorage(BaseStorage):
-    def __init__(self, dump_filepath=None):
+    def __init__(self, dump_filepath=None, compress_threshold=None, compress_level=1):
+        """
+        :param dump_filepath: file to load storage from on start and dump it to on stop
+        :param compress_threshold: bytes, records with longer json are kept zlib compressed,
+            None disables compression
+        :param compress_level: zlib compression level
+        """
         self._storage = dict()
+        self._secondary = dict()
+        self._blobs = dict()
+        self._filters = dict()
+        self._order = dict()
         self._dump_filepath = dump_filepath
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
 
     @property
     def indexes(self):
@@ -20,44 +70,209 @@ class InMemoryStorage(BaseStorage):
 
     def read(self, index, key):
         collection = self._get_index(index)
-        return collection.get(key)
+        return decompress(collection.get(key))
 
     def write(self, index, key, record):
         collection = self._get_index(index)
         if key in collection:
             return 0
-        collection[key] = record
+        collection[key] = compress(record, self._compress_threshold, self._compress_level)
+        for secondary in self._secondary[index].values():
+            secondary.add(key, record)
+        self._order[index].add(key)
+        self._add_key(index, key)
+
+    def size_of(self, doc):
+        return stored_size(compress(doc, self._compress_threshold, self._compress_level))
+
+    def _add_key(self, index, key):
+        keys = self._filters[index]
+        keys.add(key)
+        if keys.full:
+            keys.rebuild(self.keys(index))
+
+    def bloom(self, index):
+        """
+        Returns bloom filter of index keys (BloomFilter.to_dict), key it doesn't contain is not in index
+        """
+        self._get_index(index)
+        keys = self._filters[index]
+        if keys.stale:
+            keys.rebuild(self.keys(index))
+
+        return keys.filter.to_dict()
+
+    def write_many(self, items):
+        """
+        Writes several records at once
+
+        :param items: list of (index, key, record)
+        :return: list of write results, exception instance for failed item
+        """
+        results = []
+        for index, key, record in items:
+            try:
+                results.append(self.write(index, key, record))
+            except Exception as err:
+                results.append(err)
+
+        return results
+
+    def flush(self): ...  # nothing to persist until stop
+
+    def write_blob(self, index, key, doc):
+        blobs = self._get_blobs(index)
+        if key in blobs:
+            return 0
+        blobs[key] = doc
+
+    def read_blob(self, index, key):
+        return self._get_blobs(index).get(key)
+
+    def pop_blob(self, index, key):
+        return self._get_blobs(index).pop(key, None)
+
+    def blob_values(self):
+        for blobs in self._blobs.values():
+            yield from blobs.values()
+
+    def _get_blobs(self, index):
+        self._get_index(index)
+        return self._blobs[index]
 
     def pop(self, index, key):
         collection = self._get_index(index)
-        return collection.pop(key, None)
+        record = decompress(collection.pop(key, None))
+        if record is not None:
+            for secondary in self._secondary[index].values():
+                secondary.discard(key, record)
+            self._order[index].discard(key)
+            self._filters[index].discard(key)
+
+        return record
+
+    def replace(self, index, key, record):
+        """
+        Writes record whether key exists or not
+
+        :return: replaced record or None
+        """
+        old = self.pop(index, key)
+        self.write(index, key, record)
+
+        return old
 
     def remove(self, index, key):
         collection = self._get_index(index)
-        del collection[key]
+        record = decompress(collection.pop(key))
+        for secondary in self._secondary[index].values():
+            secondary.discard(key, record)
+        self._order[index].discard(key)
+        self._filters[index].discard(key)
+
+    def create_index(self, index, secondary=None):
+        """
+        Creates index
 
-    def create_index(self, index):
+        :param index: index name
+        :param secondary: secondary indexes as {field path: kind},
+            e.g. {'user.id': 'hash', 'created': 'sorted'}
+        :return:
+        """
         if index in self._storage:
             raise IndexExistsError(index)
+        self._secondary[index] = {path: make_secondary_index(path, kind)
+                                  for path, kind in (secondary or {}).items()}
         self._storage[index] = dict()
+        self._blobs[index] = dict()
+        self._filters[index] = KeyFilter()
+        self._order[index] = self._new_order()
+
+    def _new_order(self):
+        return ScanOrder()
 
     def drop_index(self, index):
         del self._storage[index]
+        del self._blobs[index]
+        del self._secondary[index]
+        del self._filters[index]
+        del self._order[index]
+
+    def find(self, index, path, value):
+        secondary = self._get_secondary(index, path)
+        collection = self._storage[index]
+        return [(key, decompress(collection[key])) for key in secondary.find(value)]
+
+    def find_range(self, index, path, lo=None, hi=None):
+        secondary = self._get_secondary(index, path)
+        collection = self._storage[index]
+        return [(key, decompress(collection[key])) for key in secondary.find_range(lo, hi)]
+
+    def secondary_indexes(self, index):
+        self._get_index(index)
+        return {path: secondary.kind for path, secondary in self._secondary[index].items()}
+
+    def _get_secondary(self, index, path):
+        self._get_index(index)
+        try:
+            return self._secondary[index][path]
+        except KeyError:
+            raise SecondaryIndexNotFoundError(f'No secondary index on {path!r} in index={index!r}')
 
     def values(self):
         for index in self.indexes:
             for value in self.index_values(index):
                 yield value
 
+    def chunked_values(self, chunk_size=None):
+        """
+        Yields lists of records and blob docs. Collections are copied up front, so storage
+        may change between chunks
+
+        :param chunk_size: docs per chunk, one chunk if not set
+        :return:
+        """
+        docs = []
+        for index in list(self.indexes):
+            docs.extend(self._storage[index].values())
+            docs.extend(self._blobs[index].values())
+        chunk_size = chunk_size or len(docs) or 1
+        for i in range(0, len(docs), chunk_size):
+            yield [decompress(doc) for doc in docs[i:i + chunk_size]]
+
     def index_values(self, index):
         collection = self._get_index(index)
         for key in collection:
-            yield collection[key]
+            yield decompress(collection[key])
+
+    def items(self, index):
+        collection = self._get_index(index)
+        if self._compress_threshold is None:
+            return iter(collection.items())
+
+        return ((key, decompress(record)) for key, record in collection.items())
+
+    def scan(self, index, after=None):
+        """
+        Yields (cursor, key, record) in order scan can be resumed in after cursor,
+        keys written after the cursor was taken may be missed
+
+        :param after: cursor of last item scanned before, None to scan from start
+        """
+        collection = self._get_index(index)
+        for cursor, key in self._order[index].scan(after):
+            yield cursor, key, decompress(collection[key])
+
+    def range(self, index, lo=None, hi=None, limit=None, after=None):
+        raise UnorderedStorageError(f'{type(self).__name__} does not keep keys ordered, use SortedStorage')
+
+    def prefix(self, index, prefix, limit=None, after=None):
+        raise UnorderedStorageError(f'{type(self).__name__} does not keep keys ordered, use SortedStorage')
 
     @property
     def empty(self):
         for index in self.indexes:
-            if self._storage[index]:
+            if self._storage[index] or self._blobs[index]:
                 return False
         return True
 
@@ -81,17 +296,70 @@ class InMemoryStorage(BaseStorage):
 
     def _load_dump(self, file):
         data = json.load(file)
-        self._storage = data
+        if data.get('version') == 1 and isinstance(data.get('storage'), dict):
+            storage, secondary, blobs = data['storage'], data['secondary'], data.get('blobs', {})
+        else:  # dump without secondary indexes
+            storage, secondary, blobs = data, dict(), dict()
+
+        self._storage = dict()
+        self._secondary = dict()
+        self._blobs = dict()
+        self._filters = dict()
+        self._order = dict()
+        for index, collection in storage.items():
+            self.create_index(index, secondary.get(index))
+            for key, record in collection.items():
+                self.write(index, key, record)
+            for key, doc in blobs.get(index, {}).items():
+                self.write_blob(index, key, dict(doc, blob=base64.b64decode(doc['blob'])))
 
     def stop(self):
         if not self._dump_filepath:
             return
 
-        with open(self._dump_filepath, 'w') as f:
+        self._dump_to(self._dump_filepath)
+
+    def snapshot(self):
+        """
+        Dumps storage in forked process, which sees copy-on-write copy of storage,
+        so caller doesn't wait for dump. Dumps in place if fork is not available
+
+        :return: pid of dumping process or None if dump is done
+        """
+        if not self._dump_filepath:
+            return None
+
+        if not hasattr(os, 'fork'):
+            self._dump_to(self._dump_filepath)
+            return None
+
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 1
+        try:
+            self._dump_to(self._dump_filepath)
+            code = 0
+        finally:
+            os._exit(code)
+
+    def _dump_to(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
             self._dump(f)
+        os.replace(tmp_path, path)  # previous dump stays whole until new one is written
 
     def _dump(self, file):
-        json.dump(self._storage, file)
+        data = {
+            'version': 1,
+            'storage': self._storage,
+            'secondary': {index: self.secondary_indexes(index) for index in self.indexes},
+            'blobs': {index: {key: dict(doc, blob=base64.b64encode(doc['blob']).decode())
+                              for key, doc in blobs.items()}
+                      for index, blobs in self._blobs.items()}
+        }
+        json.dump(data, file, default=decompress)  # compressed records are dumped as plain json
 
     def __enter__(self):
         self.start()
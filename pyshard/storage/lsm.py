@@ -0,0 +1,722 @@
+"""
+Disk-backed log-structured merge storage.
+
+Writes go to write ahead log and memtable. Full memtable is written by background
+thread as sorted table file per index, tables of index are merged into one by
+background compaction once there are settings.LSM_COMPACTION_TABLES of them.
+Reads check memtables, then tables from newest to oldest, skipping tables whose
+bloom filter doesn't have the key. Keys missing from in-memory bloom filter of
+index (built from index keys on start) are not looked up at all.
+
+Layout of storage directory:
+    indexes.json                    created indexes with seq of their first memtable
+    wal-<seq>.log                   write ahead log of memtable <seq>
+    <index>/<kind>/<lo>-<hi>.sst    json lines [key, record] ([key] for deleted key) sorted by key
+    <index>/<kind>/<lo>-<hi>.idx    sparse index and bloom filter of table, table is complete once it exists
+where kind is 'docs' or 'blobs' and table holds memtables <lo>..<hi>.
+"""
+import os
+import json
+import queue
+import heapq
+import bisect
+import base64
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
+from urllib.parse import quote
+
+from ..settings import settings
+from .base import BaseStorage
+from .bloom import BloomFilter, KeyFilter
+from .errors import IndexNotFoundError, IndexExistsError, SecondaryIndexError, SecondaryIndexNotFoundError
+from .sorted import SortedKeys, _order
+
+
+logger = logging.getLogger(__name__)
+
+_TOMBSTONE = object()
+_DOCS, _BLOBS = 'docs', 'blobs'
+# bytes read from table file at once by point reads and by scans
+_GET_READ_SIZE = 4096
+_SCAN_READ_SIZE = 64 * 1024
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SSTable:
+    """
+    Immutable table file with sparse index of every settings.LSM_INDEX_INTERVAL-th key
+    and bloom filter of all keys kept in memory. File is opened once and read at offsets,
+    so that table replaced by compaction stays readable while someone still holds it
+    """
+    def __init__(self, path, lo, hi, index, bloom, count):
+        self.path = path
+        self.lo = lo
+        self.hi = hi
+        self.bloom = bloom
+        self.count = count
+        self._orders = [_order(key) for key, _ in index]
+        self._offsets = [offset for _, offset in index]
+        self._fd = os.open(path, os.O_RDONLY)
+
+    @staticmethod
+    def name(lo, hi):
+        return f'{lo:010d}-{hi:010d}'
+
+    @classmethod
+    def write(cls, directory, lo, hi, items, capacity):
+        """
+        Writes table, returns None if there are no items
+
+        :param items: (key, record or _TOMBSTONE) pairs in key order
+        :param capacity: expected number of items, sizes bloom filter
+        :return:
+        """
+        path = os.path.join(directory, cls.name(lo, hi))
+        interval = settings.LSM_INDEX_INTERVAL
+        bloom = BloomFilter.for_capacity(capacity, settings.LSM_BLOOM_BITS_PER_KEY)
+        index = []
+        count = offset = 0
+        with open(f'{path}.sst.tmp', 'wb') as f:
+            for key, value in items:
+                if count % interval == 0:
+                    index.append((key, offset))
+                bloom.add(key)
+                line = json.dumps([key] if value is _TOMBSTONE else [key, value]).encode() + b'\n'
+                f.write(line)
+                offset += len(line)
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        if not count:
+            os.remove(f'{path}.sst.tmp')
+            return None
+
+        os.replace(f'{path}.sst.tmp', f'{path}.sst')
+        _write_json(f'{path}.idx', {'index': index, 'bloom': bloom.to_dict(), 'count': count})
+
+        return cls(f'{path}.sst', lo, hi, index, bloom, count)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns table of .sst file or None if it is not complete
+        """
+        base = path[:-len('.sst')]
+        try:
+            with open(f'{base}.idx') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        lo, hi = map(int, os.path.basename(base).split('-'))
+        return cls(path, lo, hi, meta['index'], BloomFilter.from_dict(meta['bloom']), meta['count'])
+
+    def get(self, key):
+        """
+        Returns record, _TOMBSTONE for deleted key or None if table has no key
+        """
+        if key not in self.bloom:
+            return None
+
+        order = _order(key)
+        block = bisect.bisect_right(self._orders, order) - 1
+        if block < 0:
+            return None
+
+        for line in islice(self._lines(self._offsets[block], _GET_READ_SIZE), settings.LSM_INDEX_INTERVAL):
+            item = json.loads(line)
+            item_order = _order(item[0])
+            if item_order == order:
+                return item[1] if len(item) > 1 else _TOMBSTONE
+            if item_order > order:
+                return None
+
+        return None
+
+    def scan(self, start=None, after=False):
+        """
+        Yields (key, record or _TOMBSTONE) in key order
+
+        :param start: order of first key
+        :param after: skip key equal to start
+        """
+        offset = 0
+        if start is not None:
+            block = bisect.bisect_right(self._orders, start) - 1
+            offset = self._offsets[block] if block >= 0 else 0
+
+        for line in self._lines(offset, _SCAN_READ_SIZE):
+            item = json.loads(line)
+            if start is not None:
+                item_order = _order(item[0])
+                if item_order < start or after and item_order == start:
+                    continue
+                start = None
+            yield item[0], item[1] if len(item) > 1 else _TOMBSTONE
+
+    def _lines(self, offset, size):
+        # reads don't use file position, so that scans and point reads don't move each other's
+        parts = []  # of line read so far
+        while True:
+            chunk = os.pread(self._fd, size, offset)
+            if not chunk:
+                tail = b''.join(parts)
+                if tail:
+                    yield tail
+                return
+            offset += len(chunk)
+            lines = chunk.split(b'\n')
+            if len(lines) > 1:
+                parts.append(lines[0])
+                yield b''.join(parts)
+                yield from lines[1:-1]
+                parts = [lines[-1]]
+            else:
+                parts.append(chunk)
+
+    def remove(self):
+        base = self.path[:-len('.sst')]
+        for path in (f'{base}.idx', self.path):  # table without index is incomplete, never loaded
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __del__(self):
+        os.close(self._fd)
+
+
+class _Memtable:
+    """
+    Records written since memtable was created: {(index, kind): {key: record or _TOMBSTONE}}
+    with sorted keys for scans
+    """
+    def __init__(self, seq):
+        self.seq = seq
+        self.trees = dict()
+        self.keys = dict()
+        self.size = 0
+
+    def get(self, tree, key):
+        records = self.trees.get(tree)
+        return records.get(key) if records is not None else None
+
+    def put(self, tree, key, value):
+        records = self.trees.get(tree)
+        if records is None:
+            records = self.trees[tree] = dict()
+            self.keys[tree] = SortedKeys()
+        if key not in records:
+            self.keys[tree].add(key)
+        records[key] = value
+
+    def drop(self, index):
+        for tree in (index, _DOCS), (index, _BLOBS):
+            self.trees.pop(tree, None)
+            self.keys.pop(tree, None)
+
+    def items(self, tree, start=None, after=False):
+        records = self.trees.get(tree)
+        if records is None:
+            return
+        keys = self.keys[tree]
+        lo, after_key = (None, None) if start is None else ((None, start[1]) if after else (start[1], None))
+        for key in keys.irange(lo, None, after_key):
+            yield key, records[key]
+
+    def snapshot(self, tree):
+        # sorted copy, memtable may change while it is iterated
+        return list(self.items(tree))
+
+
+class LSMStorage(BaseStorage):
+    def __init__(self, path, memtable_size=None, compaction_tables=None, cache_size=None):
+        """
+        :param path: storage directory
+        :param memtable_size: bytes of logged writes before memtable is flushed, settings.LSM_MEMTABLE_SIZE by default
+        :param compaction_tables: tables of index merged together, settings.LSM_COMPACTION_TABLES by default
+        :param cache_size: records read from tables kept in memory, settings.LSM_CACHE_SIZE by default
+        """
+        self._path = path
+        self._memtable_size = memtable_size or settings.LSM_MEMTABLE_SIZE
+        self._compaction_tables = compaction_tables or settings.LSM_COMPACTION_TABLES
+        self._cache_size = settings.LSM_CACHE_SIZE if cache_size is None else cache_size
+        self._indexes = dict()  # index: seq of memtable index was created in
+        self._memtable = _Memtable(0)
+        self._immutable = []  # memtables being flushed, newest first
+        self._tables = dict()  # (index, kind): tables newest first
+        self._filters = dict()  # index: KeyFilter of doc keys
+        self._cache = OrderedDict()
+        self._wal = None
+        self._lock = threading.Lock()  # guards replacing table and memtable lists
+        self._jobs = queue.Queue()
+        self._worker = None
+
+    @property
+    def indexes(self):
+        return self._indexes.keys()
+
+    def _tree_dir(self, index, kind):
+        return os.path.join(self._path, quote(index, safe=''), kind)
+
+    def _get_index(self, index):
+        if index not in self._indexes:
+            raise IndexNotFoundError(index)
+
+    # point operations
+
+    def _get(self, index, kind, key):
+        tree = (index, kind)
+        value = self._memtable.get(tree, key)
+        if value is None:
+            for memtable in self._immutable:
+                value = memtable.get(tree, key)
+                if value is not None:
+                    break
+        if value is None:
+            value = self._cache.get((index, kind, key))
+            if value is not None:
+                self._cache.move_to_end((index, kind, key))
+                return value
+            for table in self._tables.get(tree, ()):
+                value = table.get(key)
+                if value is not None:
+                    if value is not _TOMBSTONE and self._cache_size:
+                        self._cache[(index, kind, key)] = value
+                        if len(self._cache) > self._cache_size:
+                            self._cache.popitem(last=False)
+                    break
+
+        return None if value is _TOMBSTONE else value
+
+    def _put(self, index, kind, key, value):
+        _order(key)  # fail before anything is logged
+        entry = [index, kind, key] if value is _TOMBSTONE else [index, kind, key, value]
+        line = json.dumps(entry) + '\n'
+        self._wal.write(line)
+        self._memtable.put((index, kind), key, value)
+        self._memtable.size += len(line)
+        self._cache.pop((index, kind, key), None)
+        if self._memtable.size >= self._memtable_size:
+            self._rotate()
+
+    def _get_doc(self, index, key):
+        self._get_index(index)
+        if key not in self._filters[index]:
+            return None
+
+        return self._get(index, _DOCS, key)
+
+    def has(self, index, key):
+        return self._get_doc(index, key) is not None
+
+    def read(self, index, key):
+        return self._get_doc(index, key)
+
+    def write(self, index, key, record):
+        if self._get_doc(index, key) is not None:
+            return 0
+        self._put(index, _DOCS, key, record)
+        self._add_key(index, key)
+
+    def _add_key(self, index, key):
+        keys = self._filters[index]
+        keys.add(key)
+        if keys.full:
+            keys.rebuild(self.keys(index))
+
+    def bloom(self, index):
+        """
+        Returns bloom filter of index keys (BloomFilter.to_dict), key it doesn't contain is not in index
+        """
+        self._get_index(index)
+        keys = self._filters[index]
+        if keys.stale:
+            keys.rebuild(self.keys(index))
+
+        return keys.filter.to_dict()
+
+    def write_many(self, items):
+        results = []
+        for index, key, record in items:
+            try:
+                results.append(self.write(index, key, record))
+            except Exception as err:
+                results.append(err)
+
+        return results
+
+    def pop(self, index, key):
+        record = self._get_doc(index, key)
+        if record is not None:
+            self._put(index, _DOCS, key, _TOMBSTONE)
+            self._filters[index].discard(key)
+
+        return record
+
+    def replace(self, index, key, record):
+        old = self._get_doc(index, key)
+        self._put(index, _DOCS, key, record)
+        if old is None:
+            self._add_key(index, key)
+
+        return old
+
+    def remove(self, index, key):
+        if self.pop(index, key) is None:
+            raise KeyError(key)
+
+    def write_blob(self, index, key, doc):
+        self._get_index(index)
+        if self._get(index, _BLOBS, key) is not None:
+            return 0
+        self._put(index, _BLOBS, key, dict(doc, blob=base64.b64encode(doc['blob']).decode()))
+
+    def read_blob(self, index, key):
+        self._get_index(index)
+        return self._decode_blob(self._get(index, _BLOBS, key))
+
+    def pop_blob(self, index, key):
+        doc = self.read_blob(index, key)
+        if doc is not None:
+            self._put(index, _BLOBS, key, _TOMBSTONE)
+
+        return doc
+
+    @staticmethod
+    def _decode_blob(doc):
+        if doc is None:
+            return None
+
+        return dict(doc, blob=base64.b64decode(doc['blob']))
+
+    def flush(self):
+        self._wal.flush()
+        if settings.LSM_SYNC:
+            os.fsync(self._wal.fileno())
+
+    def snapshot(self):
+        self.flush()  # logged writes are restored on start, nothing to dump
+
+    # indexes
+
+    def create_index(self, index, secondary=None):
+        if secondary:
+            raise SecondaryIndexError(f'{type(self).__name__} does not support secondary indexes')
+        if index in self._indexes:
+            raise IndexExistsError(index)
+
+        if self._memtable.size:  # logged writes of index dropped earlier must not be replayed into new one
+            self._rotate()
+        for kind in (_DOCS, _BLOBS):
+            os.makedirs(self._tree_dir(index, kind), exist_ok=True)
+        self._indexes[index] = self._memtable.seq
+        self._filters[index] = KeyFilter()
+        self._save_indexes()
+
+    def drop_index(self, index):
+        self._get_index(index)
+        with self._lock:
+            del self._indexes[index]
+            self._memtable.drop(index)
+            for memtable in self._immutable:
+                memtable.drop(index)
+            for kind in (_DOCS, _BLOBS):
+                self._tables.pop((index, kind), None)
+        del self._filters[index]
+        self._cache = OrderedDict((key, value) for key, value in self._cache.items() if key[0] != index)
+        self._save_indexes()
+        shutil.rmtree(os.path.join(self._path, quote(index, safe='')), ignore_errors=True)
+
+    def _save_indexes(self):
+        _write_json(os.path.join(self._path, 'indexes.json'), self._indexes)
+
+    def secondary_indexes(self, index):
+        self._get_index(index)
+        return {}
+
+    def find(self, index, path, value):
+        self._get_index(index)
+        raise SecondaryIndexNotFoundError(f'No secondary index on {path!r} in index={index!r}')
+
+    def find_range(self, index, path, lo=None, hi=None):
+        self._get_index(index)
+        raise SecondaryIndexNotFoundError(f'No secondary index on {path!r} in index={index!r}')
+
+    # scans
+
+    def _scan(self, index, kind, start=None, after=False, snapshot=False):
+        """
+        Yields live (key, record) of tree in key order merged over memtables and tables
+
+        :param start: order of first key
+        :param after: skip key equal to start
+        :param snapshot: copy memtables first, so that writes made while scan is paused are not seen
+        """
+        tree = (index, kind)
+        memtables = [self._memtable] + self._immutable
+        sources = [memtable.snapshot(tree) if snapshot else memtable.items(tree, start, after)
+                   for memtable in memtables]
+        sources.extend(table.scan(start, after) for table in self._tables.get(tree, ()))
+
+        def tagged(rank, items):
+            for key, value in items:
+                yield _order(key), rank, key, value
+
+        last = None
+        for order, _, key, value in heapq.merge(*(tagged(rank, items) for rank, items in enumerate(sources))):
+            if order == last:  # older version of the same key
+                continue
+            last = order
+            if start is not None and (order < start or after and order == start):
+                continue
+            if value is not _TOMBSTONE:
+                yield key, value
+
+    def keys(self, index):
+        self._get_index(index)
+        return [key for key, _ in self._scan(index, _DOCS)]
+
+    def items(self, index):
+        self._get_index(index)
+        return self._scan(index, _DOCS)
+
+    def index_values(self, index):
+        self._get_index(index)
+        for _, record in self._scan(index, _DOCS):
+            yield record
+
+    def scan(self, index, after=None):
+        self._get_index(index)
+        for key, record in self._scan(index, _DOCS, _order(after) if after is not None else None, True):
+            yield key, key, record
+
+    def values(self):
+        for index in list(self.indexes):
+            yield from self.index_values(index)
+
+    def blob_values(self):
+        for index in list(self.indexes):
+            for _, doc in self._scan(index, _BLOBS):
+                yield self._decode_blob(doc)
+
+    def chunked_values(self, chunk_size=None):
+        chunk = []
+        for index in list(self.indexes):
+            for kind in (_DOCS, _BLOBS):
+                for _, doc in self._scan(index, kind, snapshot=True):
+                    chunk.append(self._decode_blob(doc) if kind == _BLOBS else doc)
+                    if chunk_size and len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+        if chunk:
+            yield chunk
+
+    def range(self, index, lo=None, hi=None, limit=None, after=None):
+        self._get_index(index)
+        start = _order(after) if after is not None else (_order(lo) if lo is not None else None)
+        end = _order(hi) if hi is not None else None
+        items = []
+        for key, record in self._scan(index, _DOCS, start, after is not None):
+            if end is not None and _order(key) > end or limit is not None and len(items) >= limit:
+                break
+            items.append((key, record))
+
+        return items
+
+    def prefix(self, index, prefix, limit=None, after=None):
+        self._get_index(index)
+        start = _order(after) if after is not None else _order(prefix)
+        items = []
+        for key, record in self._scan(index, _DOCS, start, after is not None):
+            if not isinstance(key, str) or not key.startswith(prefix) or limit is not None and len(items) >= limit:
+                break
+            items.append((key, record))
+
+        return items
+
+    @property
+    def empty(self):
+        for index in self.indexes:
+            for kind in (_DOCS, _BLOBS):
+                for _ in self._scan(index, kind):
+                    return False
+        return True
+
+    # memtable flushes and compaction
+
+    def _wal_path(self, seq):
+        return os.path.join(self._path, f'wal-{seq:010d}.log')
+
+    def _rotate(self):
+        self._wal.close()
+        with self._lock:
+            self._immutable = [self._memtable] + self._immutable
+            self._memtable = _Memtable(self._memtable.seq + 1)
+        self._wal = open(self._wal_path(self._memtable.seq), 'a')
+        self._jobs.put(self._flush_oldest)
+
+    def _flush_oldest(self):
+        memtable = self._immutable[-1]
+        for tree, records in list(memtable.trees.items()):
+            try:
+                table = SSTable.write(self._tree_dir(*tree), memtable.seq, memtable.seq,
+                                      ((key, records[key]) for key in memtable.keys[tree]), len(records))
+            except OSError:
+                if tree[0] in self._indexes:
+                    raise
+                continue  # index directory is removed by drop
+            if table is None:
+                continue
+            with self._lock:
+                if tree[0] not in self._indexes:  # dropped meanwhile
+                    table.remove()
+                    continue
+                self._tables[tree] = tables = [table] + self._tables.get(tree, [])
+            if len(tables) >= self._compaction_tables:
+                self._jobs.put(lambda tree=tree: self._compact(tree))
+
+        with self._lock:
+            self._immutable = self._immutable[:-1]
+        os.remove(self._wal_path(memtable.seq))
+
+    def _compact(self, tree):
+        """
+        Merges all tables of tree into one, deleted keys are dropped since no older table is left
+        """
+        tables = self._tables.get(tree, [])
+        if len(tables) < self._compaction_tables:  # compacted by earlier job
+            return
+
+        def tagged(rank, table):
+            for key, value in table.scan():
+                yield _order(key), rank, key, value
+
+        def merged():
+            last = None
+            for order, _, key, value in heapq.merge(*(tagged(rank, table) for rank, table in enumerate(tables))):
+                if order != last and value is not _TOMBSTONE:
+                    yield key, value
+                last = order
+
+        lo, hi = min(table.lo for table in tables), max(table.hi for table in tables)
+        table = SSTable.write(self._tree_dir(*tree), lo, hi, merged(), sum(table.count for table in tables))
+        with self._lock:
+            if tree[0] not in self._indexes:
+                if table is not None:
+                    table.remove()
+                return
+            current = [t for t in self._tables.get(tree, []) if t not in tables]  # flushed meanwhile
+            self._tables[tree] = current + ([table] if table is not None else [])
+        for old in tables:
+            old.remove()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception:
+                logger.exception(f'LSM storage job failed in {self._path}')
+            finally:
+                self._jobs.task_done()
+
+    # lifecycle
+
+    def start(self):
+        os.makedirs(self._path, exist_ok=True)
+        try:
+            with open(os.path.join(self._path, 'indexes.json')) as f:
+                self._indexes = json.load(f)
+        except FileNotFoundError:
+            self._indexes = dict()
+
+        last_seq = -1
+        for index in self._indexes:
+            for kind in (_DOCS, _BLOBS):
+                tables = self._load_tables(self._tree_dir(index, kind))
+                self._tables[(index, kind)] = tables
+                last_seq = max([last_seq] + [table.hi for table in tables])
+
+        wal_seqs = sorted(int(name[len('wal-'):-len('.log')]) for name in os.listdir(self._path)
+                          if name.startswith('wal-') and name.endswith('.log'))
+        for seq in wal_seqs:
+            self._memtable = _Memtable(seq)
+            self._replay(seq)
+            self._immutable = [self._memtable] + self._immutable
+        last_seq = max([last_seq] + wal_seqs)
+
+        self._memtable = _Memtable(last_seq + 1)
+        self._wal = open(self._wal_path(self._memtable.seq), 'a')
+        while self._immutable:  # restored memtables are flushed before storage is used
+            self._flush_oldest()
+        self._filters = {index: KeyFilter(self.keys(index)) for index in self._indexes}
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def _load_tables(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        tables = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith('.sst'):
+                table = SSTable.load(path)
+                if table is None:
+                    os.remove(path)
+                else:
+                    tables.append(table)
+
+        live = []
+        for table in tables:  # compaction may have stopped before removing its inputs
+            if any(other is not table and other.lo <= table.lo and table.hi <= other.hi for other in tables):
+                table.remove()
+            else:
+                live.append(table)
+
+        return sorted(live, key=lambda table: table.hi, reverse=True)
+
+    def _replay(self, seq):
+        with open(self._wal_path(seq)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # torn last write
+                    break
+                index, kind, key = entry[:3]
+                if self._indexes.get(index, seq + 1) <= seq:
+                    self._memtable.put((index, kind), key, entry[3] if len(entry) > 3 else _TOMBSTONE)
+
+    def stop(self):
+        if self._wal is None:
+            return
+
+        if self._memtable.trees:
+            self._rotate()
+        self._jobs.put(None)
+        self._worker.join()
+        self._wal.close()
+        os.remove(self._wal_path(self._memtable.seq))  # nothing was written to it
+        self._wal = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
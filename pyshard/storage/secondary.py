@@ -0,0 +1,209 @@
+import bisect
+from numbers import Number
+
+from .errors import SecondaryIndexError
+
+
+_MISSING = object()
+
+
+def resolve_path(value, path):
+    """
+    Returns value of dotted field path (e.g. 'user.id') or _MISSING
+
+    :param value: stored document
+    :param path: dotted field path
+    :return:
+    """
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+
+    return value
+
+
+class SecondaryIndexBase:
+    kind = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, key, value):
+        field = resolve_path(value, self.path)
+        if field is not _MISSING:
+            self._add(key, field)
+
+    def discard(self, key, value):
+        field = resolve_path(value, self.path)
+        if field is not _MISSING:
+            self._discard(key, field)
+
+    def find(self, field): ...
+    def find_range(self, lo=None, hi=None): ...
+
+    def _add(self, key, field): ...
+    def _discard(self, key, field): ...
+
+
+class HashIndex(SecondaryIndexBase):
+    kind = 'hash'
+
+    def __init__(self, path):
+        self._keys = dict()
+
+        super(HashIndex, self).__init__(path)
+
+    def _add(self, key, field):
+        try:
+            self._keys.setdefault(field, dict())[key] = None
+        except TypeError:  # unhashable field (dict, list) is not indexed
+            pass
+
+    def _discard(self, key, field):
+        try:
+            keys = self._keys.get(field)
+        except TypeError:
+            return
+        if keys is None:
+            return
+
+        keys.pop(key, None)
+        if not keys:
+            del self._keys[field]
+
+    def find(self, field):
+        try:
+            return list(self._keys.get(field, ()))
+        except TypeError:
+            return []
+
+    def find_range(self, lo=None, hi=None):
+        raise SecondaryIndexError(f'Hash index on {self.path!r} does not support range queries')
+
+
+def _sort_key(field):
+    # numbers go before strings, other types are not indexed
+    if isinstance(field, bool):
+        return None
+    if isinstance(field, Number):
+        return 0, field
+    if isinstance(field, str):
+        return 1, field
+
+    return None
+
+
+class SortedIndex(SecondaryIndexBase):
+    """
+    Keys ordered by field value, kept in chunks of up to 2 * load entries: writes shift
+    one chunk, lookups find their first chunk by bisecting chunk maxima
+    """
+    kind = 'sorted'
+
+    def __init__(self, path, load=1000):
+        # parallel lists of chunks so that keys are never compared with each other
+        self._load = load
+        self._fields = []
+        self._keys = []
+        self._maxes = []
+
+        super(SortedIndex, self).__init__(path)
+
+    def _add(self, key, field):
+        sort_key = _sort_key(field)
+        if sort_key is None:
+            return
+
+        if not self._fields:
+            self._fields.append([sort_key])
+            self._keys.append([key])
+            self._maxes.append(sort_key)
+            return
+
+        i = min(bisect.bisect_right(self._maxes, sort_key), len(self._maxes) - 1)
+        fields, keys = self._fields[i], self._keys[i]
+        j = bisect.bisect_right(fields, sort_key)
+        fields.insert(j, sort_key)
+        keys.insert(j, key)
+        self._maxes[i] = fields[-1]
+
+        if len(fields) > 2 * self._load:
+            self._fields[i:i + 1] = [fields[:self._load], fields[self._load:]]
+            self._keys[i:i + 1] = [keys[:self._load], keys[self._load:]]
+            self._maxes[i:i + 1] = [fields[self._load - 1], fields[-1]]
+
+    def _discard(self, key, field):
+        sort_key = _sort_key(field)
+        if sort_key is None:
+            return
+
+        for i in range(bisect.bisect_left(self._maxes, sort_key), len(self._maxes)):
+            fields, keys = self._fields[i], self._keys[i]
+            lo = bisect.bisect_left(fields, sort_key)
+            hi = bisect.bisect_right(fields, sort_key)
+            for j in range(lo, hi):
+                if keys[j] == key:
+                    del fields[j]
+                    del keys[j]
+                    if fields:
+                        self._maxes[i] = fields[-1]
+                    else:
+                        del self._fields[i], self._keys[i], self._maxes[i]
+                    return
+            if hi < len(fields):  # equal values don't continue in next chunk
+                return
+
+    def _between(self, lo, hi):
+        # keys with sort key in range [lo, hi], None bound is unbounded
+        keys = []
+        i = 0 if lo is None else bisect.bisect_left(self._maxes, lo)
+        for i in range(i, len(self._maxes)):
+            fields = self._fields[i]
+            start = 0 if lo is None else bisect.bisect_left(fields, lo)
+            end = len(fields) if hi is None else bisect.bisect_right(fields, hi)
+            keys.extend(self._keys[i][start:end])
+            if end < len(fields):
+                break
+
+        return keys
+
+    def find(self, field):
+        sort_key = _sort_key(field)
+        if sort_key is None:
+            return []
+
+        return self._between(sort_key, sort_key)
+
+    def find_range(self, lo=None, hi=None):
+        """
+        Returns keys with field value in range [lo, hi]
+
+        :param lo: lower bound or None for unbounded
+        :param hi: upper bound or None for unbounded
+        :return:
+        """
+        return self._between(self._bound(lo) if lo is not None else None,
+                             self._bound(hi) if hi is not None else None)
+
+    def _bound(self, field):
+        sort_key = _sort_key(field)
+        if sort_key is None:
+            raise SecondaryIndexError(f'Range bound must be a number or a string, got: {field!r}')
+
+        return sort_key
+
+
+SECONDARY_INDEXES = {
+    HashIndex.kind: HashIndex,
+    SortedIndex.kind: SortedIndex
+}
+
+
+def make_secondary_index(path, kind):
+    try:
+        index_class = SECONDARY_INDEXES[kind]
+    except KeyError:
+        raise SecondaryIndexError(f'Unknown secondary index kind={kind!r}')
+
+    return index_class(path)
@@ -0,0 +1,183 @@
+import bisect
+from numbers import Number
+
+from .inmemory import InMemoryStorage
+from .errors import UnorderableKeyError
+from .compression import decompress
+
+
+def _order(key):
+    # numbers go before strings, so that keys of both types can share index
+    if isinstance(key, str):
+        return 1, key
+    if isinstance(key, Number) and not isinstance(key, bool):
+        return 0, key
+
+    raise UnorderableKeyError(f'Key must be a number or a string, got: {key!r}')
+
+
+class SortedKeys:
+    """
+    Sorted keys kept in chunks of up to 2 * load keys: insertion and removal
+    shift one chunk, scans find their start by bisecting chunk maxima
+    """
+    def __init__(self, load=1000):
+        self._load = load
+        self._chunks = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for _, key in chunk:
+                yield key
+
+    def add(self, key):
+        item = _order(key)
+        self._len += 1
+        if not self._chunks:
+            self._chunks.append([item])
+            self._maxes.append(item)
+            return
+
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._maxes):  # appending is the common case of time series keys
+            i -= 1
+            chunk = self._chunks[i]
+            chunk.append(item)
+            self._maxes[i] = item
+        else:
+            chunk = self._chunks[i]
+            bisect.insort(chunk, item)
+
+        if len(chunk) > 2 * self._load:
+            self._chunks[i:i + 1] = [chunk[:self._load], chunk[self._load:]]
+            self._maxes[i:i + 1] = [chunk[self._load - 1], chunk[-1]]
+
+    def discard(self, key):
+        item = _order(key)
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            return
+
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, item)
+        if j == len(chunk) or chunk[j] != item:
+            return
+
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def scan(self, after=None):
+        """
+        Yields (key, key) after key, see ScanOrder.scan
+        """
+        for key in self.irange(after=after):
+            yield key, key
+
+    def irange(self, lo=None, hi=None, after=None):
+        """
+        Yields keys in range [lo, hi] in order
+
+        :param lo: lower bound or None for unbounded
+        :param hi: upper bound or None for unbounded
+        :param after: key to continue from (exclusive), overrides lo
+        :return:
+        """
+        if after is not None:
+            start, bisect_ = _order(after), bisect.bisect_right
+        elif lo is not None:
+            start, bisect_ = _order(lo), bisect.bisect_left
+        else:
+            start, bisect_ = None, None
+        end = _order(hi) if hi is not None else None
+
+        i, j = 0, 0
+        if start is not None:
+            i = bisect_(self._maxes, start)
+            if i == len(self._maxes):
+                return
+            j = bisect_(self._chunks[i], start)
+
+        for chunk in self._chunks[i:]:
+            for item in chunk[j:]:
+                if end is not None and item > end:
+                    return
+                yield item[1]
+            j = 0
+
+
+class SortedStorage(InMemoryStorage):
+    """
+    InMemoryStorage keeping keys of every index sorted (numbers before strings):
+    keys and items are returned in order, range and prefix scans don't sort
+    """
+    def write(self, index, key, record):
+        self._get_index(index)
+        _order(key)  # fail before record is stored
+
+        return super(SortedStorage, self).write(index, key, record)
+
+    def _new_order(self):
+        return SortedKeys()
+
+    def _get_sorted(self, index):
+        self._get_index(index)
+        return self._order[index]
+
+    def keys(self, index):
+        return list(self._get_sorted(index))
+
+    def index_values(self, index):
+        collection = self._get_index(index)
+        for key in self._order[index]:
+            yield decompress(collection[key])
+
+    def items(self, index):
+        collection = self._get_index(index)
+        return ((key, decompress(collection[key])) for key in self._order[index])
+
+    def range(self, index, lo=None, hi=None, limit=None, after=None):
+        """
+        Returns (key, record) pairs with key in range [lo, hi] in key order
+
+        :param lo: lower bound or None for unbounded
+        :param hi: upper bound or None for unbounded
+        :param limit: max number of pairs
+        :param after: key to continue from (exclusive), overrides lo
+        :return:
+        """
+        collection = self._get_index(index)
+        items = []
+        for key in self._order[index].irange(lo, hi, after):
+            if limit is not None and len(items) >= limit:
+                break
+            items.append((key, decompress(collection[key])))
+
+        return items
+
+    def prefix(self, index, prefix, limit=None, after=None):
+        """
+        Returns (key, record) pairs with string key starting with prefix in key order
+
+        :param prefix: key prefix
+        :param limit: max number of pairs
+        :param after: key to continue from (exclusive)
+        :return:
+        """
+        collection = self._get_index(index)
+        items = []
+        for key in self._order[index].irange(prefix, None, after):
+            if not key.startswith(prefix) or limit is not None and len(items) >= limit:
+                break
+            items.append((key, decompress(collection[key])))
+
+        return items
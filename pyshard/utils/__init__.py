@@ -10,6 +10,26 @@ def from_bytes(bytes_obj: bytes, codec: Codec) -> str:
     return bytes_obj.decode(codec)
 
 
+def iter_chunks(data, chunk_size):
+    """
+    Yields chunks of bytes-like object (as memoryviews, without copying) or binary file
+
+    :param data: bytes-like object or file object opened in binary mode
+    :param chunk_size: max chunk size, bytes
+    :return:
+    """
+    if hasattr(data, 'read'):
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        view = memoryview(data)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+
 def get_size(obj):
     if isinstance(obj, dict):
         size = sum((get_size(v) for v in obj.values()))
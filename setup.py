@@ -23,6 +23,9 @@ setup(
         'pyshard.storage',
         'pyshard.console'
     ],
+    extras_require={
+        'uvloop': ['uvloop']
+    },
     entry_points={
         'console_scripts': [
             'pyshard=pyshard.console.pyshard:main'
@@ -1,7 +1,19 @@
+import os
+import time
+import socket
+import asyncio
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
-from pyshard import Pyshard
+from pyshard import Pyshard, ShardServer
+from pyshard.app import app as app_module
+from pyshard.app.app import TransactionError
+from pyshard.shard.client import ShardClient
+from pyshard.core.client import ServerBusyError, ClientError
 from pyshard.utils import get_size
+from pyshard.storage import SortedStorage
 from pyshard.settings import settings
 
 
@@ -72,3 +84,421 @@ class TestCommands(unittest.TestCase):
         key = 'test_key'
         self.assertEqual(self.app.pop(self.TEST_INDEX, key).result,
                          None, f'couldn\'t populate key={key}')
+
+
+class TestFind(unittest.TestCase):
+    TEST_INDEX = 'test_find'
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER)
+        cls.app.create_index(cls.TEST_INDEX, secondary={'user_id': 'hash', 'ts': 'sorted'})
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app:
+            cls.app.drop_index(cls.TEST_INDEX)
+
+    def test_find(self):
+        docs = {f'key{i}': {'user_id': i % 3, 'ts': i} for i in range(10)}
+        for key, doc in docs.items():
+            self.app.write(self.TEST_INDEX, key, doc)
+
+        found = sorted(key for key, _ in self.app.find(self.TEST_INDEX, 'user_id', 1))
+        self.assertEqual(found, ['key1', 'key4', 'key7'])
+
+        found = sorted(key for key, _ in self.app.find_range(self.TEST_INDEX, 'ts', 3, 5))
+        self.assertEqual(found, ['key3', 'key4', 'key5'])
+
+        self.app.remove(self.TEST_INDEX, 'key4')
+        found = sorted(key for key, _ in self.app.find(self.TEST_INDEX, 'user_id', 1))
+        self.assertEqual(found, ['key1', 'key7'])
+
+
+class TestQuery(unittest.TestCase):
+    TEST_INDEX = 'test_query'
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER)
+        cls.app.create_index(cls.TEST_INDEX)
+        for i in range(10):
+            cls.app.write(cls.TEST_INDEX, f'key{i}', {'n': i, 'user': {'name': f'user{i % 2}'}})
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app:
+            cls.app.drop_index(cls.TEST_INDEX)
+
+    def test_query(self):
+        result = dict(self.app.query(self.TEST_INDEX, where={'n': {'$gte': 7}}, batch_size=1))
+        self.assertEqual(sorted(result), ['key7', 'key8', 'key9'])
+
+    def test_query_projection(self):
+        result = dict(self.app.query(self.TEST_INDEX, where={'user.name': 'user1', 'n': {'$lt': 5}},
+                                     fields=['n']))
+        self.assertEqual({key: doc['record'] for key, doc in result.items()},
+                         {'key1': {'n': 1}, 'key3': {'n': 3}})
+
+    def test_query_all(self):
+        self.assertEqual(len(list(self.app.query(self.TEST_INDEX))), 10)
+
+    def test_aggregate(self):
+        metrics = {'count': ['count'], 'total': ['sum', 'n']}
+        self.assertEqual(self.app.aggregate(self.TEST_INDEX, metrics), {'count': 10, 'total': 45})
+        self.assertEqual(self.app.aggregate(self.TEST_INDEX, metrics, group_by='user.name'),
+                         {'user0': {'count': 5, 'total': 20}, 'user1': {'count': 5, 'total': 25}})
+
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        app_module._maps.clear()
+
+    def test_lazy(self):
+        with Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER) as app:
+            self.assertFalse(any(shard.connected for shard in app._master.shards))
+            self.assertIsNone(app.read('test', 'missing').result)
+            self.assertEqual(sum(shard.connected for shard in app._master.shards), 1)
+
+    def test_parallel(self):
+        with Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER, connect='parallel') as app:
+            self.assertTrue(all(shard.connected for shard in app._master.shards))
+
+    def test_map_cache(self):
+        with Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER) as app:
+            self.assertTrue(app._bootstrap_client.connected)
+        with Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER) as app:
+            self.assertFalse(app._bootstrap_client.connected)
+            self.assertEqual(len(list(app._master.shards)), 2)
+
+    def test_map_cache_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'maps.json')
+            with mock.patch.object(settings, 'MAP_CACHE_PATH', path):
+                Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER).close()
+                app_module._maps.clear()
+                with Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER) as app:
+                    self.assertFalse(app._bootstrap_client.connected)
+
+
+class TestHotKeys(unittest.TestCase):
+    TEST_INDEX = 'hot'
+
+    def setUp(self):
+        self.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER, hot_key_ttl=60)
+        self.app.create_index(self.TEST_INDEX)
+        self.app.write(self.TEST_INDEX, 'viral', 'value')
+
+    def tearDown(self):
+        self.app.drop_index(self.TEST_INDEX)
+        self.app.close()
+
+    def test_cached(self):
+        _, shard = self.app._master.get_shard(self.TEST_INDEX, 'viral')
+        for _ in range(settings.HOT_KEY_MIN_ACCESSES):
+            shard.read(self.TEST_INDEX, 'viral')
+
+        self.assertEqual(self.app.read(self.TEST_INDEX, 'viral').result['record'], 'value')
+        self.assertEqual(shard.last_meta, {'hot': True})
+        shard.remove(self.TEST_INDEX, 'viral')  # not seen by app cache
+        self.assertEqual(self.app.read(self.TEST_INDEX, 'viral').result['record'], 'value')
+
+        self.app.remove(self.TEST_INDEX, 'viral')
+        self.assertIsNone(self.app.read(self.TEST_INDEX, 'viral').result)
+
+
+class TestAtomic(unittest.TestCase):
+    TEST_INDEX = 'atomic'
+
+    def setUp(self):
+        self.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER)
+        self.app.create_index(self.TEST_INDEX)
+
+    def tearDown(self):
+        for key in ('doc', 'counter'):
+            self.app.remove(self.TEST_INDEX, key)
+        self.app.drop_index(self.TEST_INDEX)
+        self.app.close()
+
+    def test_cas(self):
+        self.app.write(self.TEST_INDEX, 'doc', {'n': 1})
+        doc = self.app.read(self.TEST_INDEX, 'doc').result
+        self.assertEqual(self.app.cas(self.TEST_INDEX, 'doc', doc['version'], {'n': 2}).result, 2)
+        self.assertIsNone(self.app.cas(self.TEST_INDEX, 'doc', doc['version'], {'n': 3}).result)
+        self.assertEqual(self.app.update(self.TEST_INDEX, 'doc', {'n': 4}).result, 3)
+        self.assertEqual(self.app.read(self.TEST_INDEX, 'doc').result['record'], {'n': 4})
+
+    def test_incr(self):
+        for _ in range(3):
+            self.app.incr(self.TEST_INDEX, 'counter')
+
+        self.assertEqual(self.app.incr(self.TEST_INDEX, 'counter', -1).result, 2)
+
+
+class TestTransaction(unittest.TestCase):
+    TEST_INDEX = 'accounts'
+    KEYS = ['alice', 'bob', 'dave', 'erin']  # two keys on each test shard
+
+    def setUp(self):
+        self.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER)
+        self.app.create_index(self.TEST_INDEX)
+        for key in self.KEYS:
+            self.app.write(self.TEST_INDEX, key, 100)
+
+    def tearDown(self):
+        for key in self.KEYS:
+            self.app.remove(self.TEST_INDEX, key)
+        self.app.drop_index(self.TEST_INDEX)
+        self.app.close()
+
+    def _balances(self):
+        return [self.app.read(self.TEST_INDEX, key).result['record'] for key in self.KEYS]
+
+    def test_commit(self):
+        with self.app.transaction() as tx:
+            for i, key in enumerate(self.KEYS):
+                tx.set(self.TEST_INDEX, key, 100 + (-10 if i % 2 else 10), expected_version=1)
+
+        self.assertEqual(tx.results, [2] * len(self.KEYS))
+        self.assertEqual(self._balances(), [110, 90, 110, 90])
+
+    def test_abort(self):
+        self.app.incr(self.TEST_INDEX, self.KEYS[-1])
+        with self.assertRaises(TransactionError):
+            with self.app.transaction() as tx:
+                for key in self.KEYS:
+                    tx.set(self.TEST_INDEX, key, 0, expected_version=1)
+
+        self.assertEqual(self._balances(), [100, 100, 100, 101])
+        self.app.incr(self.TEST_INDEX, self.KEYS[0])  # keys are unlocked
+
+    def test_locked_key(self):
+        hash_, shard = self.app._master.get_shard(self.TEST_INDEX, self.KEYS[0])
+        shard.prepare('tx', [['set', self.TEST_INDEX, self.KEYS[0], hash_, 0, None]])
+        try:
+            with self.assertRaises(ServerBusyError):  # retried and given up
+                self.app.incr(self.TEST_INDEX, self.KEYS[0])
+            self.assertEqual(self.app.incr(self.TEST_INDEX, self.KEYS[1]).result, 101)
+        finally:
+            shard.abort('tx')
+
+    def test_commit_retried(self):
+        _, shard = self.app._master.get_shard(self.TEST_INDEX, self.KEYS[0])
+        commit, calls = shard.commit, []
+
+        def drop_first(txid):
+            calls.append(txid)
+            if len(calls) == 1:
+                raise ConnectionResetError('connection lost')
+            return commit(txid)
+
+        with mock.patch.object(shard, 'commit', drop_first), \
+                mock.patch.object(settings, 'TRANSACTION_RETRY_BACKOFF', 0.01):
+            with self.app.transaction() as tx:
+                for key in self.KEYS:
+                    tx.set(self.TEST_INDEX, key, 0)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self._balances(), [0] * len(self.KEYS))
+
+    def test_commit_given_up(self):
+        _, shard = self.app._master.get_shard(self.TEST_INDEX, self.KEYS[0])
+        commit, calls = shard.commit, []
+
+        def drop(txid):
+            calls.append(txid)
+            raise ConnectionResetError('connection lost')
+
+        with mock.patch.object(shard, 'commit', drop), \
+                mock.patch.object(settings, 'TRANSACTION_RETRY_BACKOFF', 0.01), \
+                mock.patch.object(settings, 'TRANSACTION_RETRY_TIMEOUT', 0.1):
+            with self.assertRaises(TransactionError) as context:
+                with self.app.transaction() as tx:
+                    for key in self.KEYS:
+                        tx.set(self.TEST_INDEX, key, 0)
+
+        self.assertEqual(list(context.exception.errors), [shard.addr])
+        self.assertGreater(len(calls), 1)
+        commit(calls[0])  # transaction stays prepared on shard until it's settled
+        self.assertEqual(self._balances(), [0] * len(self.KEYS))
+
+    def test_shard_down(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        down = ShardClient(*sock.getsockname(), lazy=True)  # nothing listens there
+        sock.close()
+        get_shard = self.app._master.get_shard
+
+        def route(index, key):
+            hash_, shard = get_shard(index, key)
+            return hash_, down if key == self.KEYS[0] else shard
+
+        started = time.time()
+        with mock.patch.object(self.app._master, 'get_shard', route):
+            with self.assertRaises(TransactionError) as context:
+                with self.app.transaction() as tx:
+                    for key in self.KEYS:
+                        tx.set(self.TEST_INDEX, key, 0)
+
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(list(context.exception.errors), [down.addr])
+        self.assertIsInstance(context.exception.errors[down.addr], ConnectionRefusedError)
+        self.assertEqual(self._balances(), [100] * len(self.KEYS))
+        self.assertEqual(self.app.incr(self.TEST_INDEX, self.KEYS[1]).result, 101)  # prepared shards aborted
+
+
+class TestKeyFilters(unittest.TestCase):
+    TEST_INDEX = 'bloom'
+
+    def setUp(self):
+        self.app = Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER, bloom_refresh=60)
+        self.app.create_index(self.TEST_INDEX)
+        self.app.write(self.TEST_INDEX, 'present', 'value')
+
+    def tearDown(self):
+        for key in ('present', 'mine', 'other'):
+            self.app.remove(self.TEST_INDEX, key)
+        self.app.drop_index(self.TEST_INDEX)
+        self.app.close()
+
+    def _wait_pulled(self):
+        for _ in range(100):
+            if len(self.app._key_filters._filters) == len(self.app._master.shards):
+                time.sleep(0.05)  # let pull finish
+                return
+            time.sleep(0.01)
+        self.fail('Filters are not pulled')
+
+    def test_absent(self):
+        self.assertFalse(self.app.has(self.TEST_INDEX, 'missing').result)  # asks shard, pulls filters
+        self._wait_pulled()
+        self.assertTrue(self.app.has(self.TEST_INDEX, 'present').result)
+        self.assertEqual(self.app.read(self.TEST_INDEX, 'present').result['record'], 'value')
+
+        hash_, shard = self.app._master.get_shard(self.TEST_INDEX, 'other')
+        shard.write(self.TEST_INDEX, 'other', hash_, 'value')  # written by other client
+        self.assertIsNone(self.app.read(self.TEST_INDEX, 'other').result)
+        self.app.write(self.TEST_INDEX, 'mine', 'value')
+        self.assertTrue(self.app.has(self.TEST_INDEX, 'mine').result)
+
+        self.app._key_filters.refresh()  # background thread waits for next pull
+        self.assertEqual(self.app.read(self.TEST_INDEX, 'other').result['record'], 'value')
+
+
+class _LocalShards:
+    # test env runs shards with default settings, tests needing others run two shards in process
+    SHARDS = {}
+    SHARD_KWARGS = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        servers = [ShardServer(*addr, loop=cls.loop, start=float(start), end=float(start) + 0.5,
+                               max_size=1024 * 1024, **cls.SHARD_KWARGS)
+                   for start, addr in cls.SHARDS.items()]
+
+        async def serve():
+            await asyncio.gather(*(server._do_run() for server in servers))
+
+        cls.task = cls.loop.create_task(serve())
+        cls.thread = threading.Thread(target=cls._run, args=(servers,), daemon=True)
+        cls.thread.start()
+        time.sleep(0.1)
+
+    @classmethod
+    def _run(cls, servers):
+        asyncio.set_event_loop(cls.loop)
+        try:
+            cls.loop.run_until_complete(cls.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for server in servers:
+                server.sock.close()
+            cls.loop.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.task.cancel)
+        cls.thread.join(1)
+
+    @classmethod
+    def _connect(cls):
+        with mock.patch.object(app_module, '_load_map', return_value=cls.SHARDS):
+            return Pyshard(bootstrap_server=settings.BOOTSTRAP_SERVER)
+
+
+class TestSubscribe(_LocalShards, unittest.TestCase):
+    TEST_INDEX = 'feed'
+    KEYS = ['alice', 'dave']  # key on each test shard
+    SHARDS = {'0.0': ['127.0.0.1', 7158], '0.5': ['127.0.0.1', 7159]}
+    SHARD_KWARGS = {'change_log_size': 100}  # change log is off by default
+
+    def setUp(self):
+        self.app = self._connect()
+        self.app.create_index(self.TEST_INDEX)
+
+    def tearDown(self):
+        for key in self.KEYS:
+            self.app.remove(self.TEST_INDEX, key)
+        self.app.drop_index(self.TEST_INDEX)
+        self.app.close()
+
+    def _changes(self, changes, number):
+        return sorted([next(changes) for _ in range(number)], key=lambda change: (change[3], change[1]))
+
+    def test_subscribe(self):
+        changes = self.app.subscribe(self.TEST_INDEX)
+        for key in self.KEYS:
+            self.app.write(self.TEST_INDEX, key, 1)
+            self.app.incr(self.TEST_INDEX, key)
+            self.app.remove(self.TEST_INDEX, key)
+
+        received = self._changes(changes, 6)
+        changes.close()
+        self.assertEqual([(op, key, doc and doc['record']) for _, _, op, key, doc in received],
+                         [('write', 'alice', 1), ('write', 'alice', 2), ('remove', 'alice', None),
+                          ('write', 'dave', 1), ('write', 'dave', 2), ('remove', 'dave', None)])
+        for i in (0, 3):  # offsets of shard follow one another
+            self.assertEqual([offset for _, offset, *_ in received[i:i + 3]],
+                             list(range(received[i][1], received[i][1] + 3)))
+
+        resumed = self.app.subscribe(self.TEST_INDEX, {name: offset for name, offset, *_ in received[1::3]})
+        self.assertEqual([change[2:4] for change in self._changes(resumed, 4)],
+                         [('write', 'alice'), ('remove', 'alice'), ('write', 'dave'), ('remove', 'dave')])
+        resumed.close()
+
+    def test_truncated(self):
+        with self.assertRaises(ClientError):
+            self.app.subscribe(self.TEST_INDEX, {shard.name: -1 for shard in self.app._master.shards})
+
+
+class TestRange(_LocalShards, unittest.TestCase):
+    TEST_INDEX = 'series'
+    KEYS = [f's:{i:02}' for i in range(10)]
+    SHARDS = {'0.0': ['127.0.0.1', 7156], '0.5': ['127.0.0.1', 7157]}
+    SHARD_KWARGS = {'storage_class': SortedStorage}  # test env runs default unordered storage
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestRange, cls).setUpClass()
+        cls.app = cls._connect()
+        cls.app.create_index(cls.TEST_INDEX)
+        for i, key in enumerate(cls.KEYS):
+            cls.app.write(cls.TEST_INDEX, key, i)
+        cls.app.write(cls.TEST_INDEX, 'other', -1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.close()
+        super(TestRange, cls).tearDownClass()
+
+    def test_range(self):
+        keys = [key for key, _ in self.app.range(self.TEST_INDEX, 's:02', 's:08', batch_size=2)]
+        self.assertEqual(keys, self.KEYS[2:9])
+
+    def test_prefix(self):
+        items = list(self.app.prefix(self.TEST_INDEX, 's:', limit=7, batch_size=3))
+        self.assertEqual([doc['record'] for _, doc in items], list(range(7)))
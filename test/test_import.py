@@ -0,0 +1,33 @@
+import sys
+import subprocess
+import unittest
+
+
+SERVER_MODULES = ('asyncio', 'concurrent.futures', 'pyshard.core.server', 'pyshard.master.master',
+                  'pyshard.shard.server')
+
+SCRIPT = '''
+import sys
+{statement}
+print(','.join(module for module in {modules!r} if module in sys.modules))
+'''
+
+
+def _loaded_server_modules(statement):
+    script = SCRIPT.format(statement=statement, modules=SERVER_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE).stdout
+
+    return [module for module in output.decode().strip().split(',') if module]
+
+
+class TestImport(unittest.TestCase):
+    def test_client_import_is_light(self):
+        self.assertEqual(_loaded_server_modules('from pyshard import Pyshard, MasterClient'), [])
+
+    def test_package_import_is_lazy(self):
+        self.assertEqual(_loaded_server_modules('import pyshard'), [])
+
+    def test_server_exports(self):
+        self.assertIn('pyshard.core.server', _loaded_server_modules('from pyshard import ShardServer'))
+        import pyshard
+        self.assertEqual(sorted(pyshard.__all__), sorted(set(dir(pyshard)) & set(pyshard.__all__)))
@@ -0,0 +1,626 @@
+import io
+import os
+import json
+import time
+import zlib
+import tempfile
+import socket
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from pyshard.core.client import ClientBase, ClientError, ServerBusyError, ClientTimeoutError
+from pyshard.core.connect import Protocol, AsyncProtocol, FLAG_COMPRESSED
+from pyshard.core.streams import StreamProtocol
+from pyshard.core.server import ServerBase
+from pyshard.core.metrics import Histogram, ServerMetrics, render_prometheus
+from pyshard.core.scheduling import FairQueue
+from pyshard.master.client import MasterClient
+from pyshard.master.sharding import Master, FanOutError, _Shards
+from pyshard.shard.server import ShardServer
+from pyshard.shard.client import ShardClient
+from pyshard.settings import settings
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.quantile(0.5), 1.0)
+        self.assertEqual(histogram.quantile(1.0), float('inf'))
+
+    def test_render_prometheus(self):
+        metrics = ServerMetrics()
+        metrics.observe_request('read', 0.0002)
+        metrics.observe_request('read', 0.003, error=True)
+
+        text = render_prometheus(metrics.snapshot({}))
+        self.assertIn('pyshard_requests_total{endpoint="read"} 2', text)
+        self.assertIn('pyshard_request_errors_total{endpoint="read"} 1', text)
+        self.assertIn('pyshard_request_duration_seconds_bucket{endpoint="read",le="+Inf"} 2', text)
+
+    def test_metrics_endpoint(self):
+        client = MasterClient(*settings.BOOTSTRAP_SERVER)
+        try:
+            client.get_map()
+            metrics = client.metrics()
+            self.assertGreaterEqual(metrics['endpoints']['get_map']['requests'], 1)
+            self.assertIn('default', metrics['queues'])
+            self.assertGreater(metrics['bytes_in'], 0)
+            self.assertIn('pyshard_requests_total{endpoint="get_map"}', client.metrics(format='prometheus'))
+        finally:
+            client.close()
+
+
+class TestTracing(unittest.TestCase):
+    def test_trace(self):
+        client = MasterClient(*settings.BOOTSTRAP_SERVER, trace=True, slow_request_threshold=1e-9)
+        try:
+            with self.assertLogs('pyshard.core.tracing', level='WARNING') as logs:
+                client.get_map()
+        finally:
+            client.close()
+
+        trace = client.last_trace
+        self.assertEqual(trace['endpoint'], 'get_map')
+        self.assertEqual(set(trace['spans']), {'total', 'network', 'queue', 'lock', 'handler'})
+        self.assertLessEqual(trace['client_send'], trace['client_receive'])
+        self.assertIn(trace['id'], logs.output[0])
+
+    def test_no_trace(self):
+        client = MasterClient(*settings.BOOTSTRAP_SERVER, trace=False)
+        try:
+            client.get_map()
+        finally:
+            client.close()
+
+        self.assertIsNone(client.last_trace)
+
+    def test_malformed_trace(self):
+        client = MasterClient(*settings.BOOTSTRAP_SERVER, trace=False)
+        client._transport.settimeout(5)
+        try:
+            for _ in range(2):  # server keeps answering
+                client._transport.send(client._serialize({'endpoint': 'get_map', 'trace': 1}))
+                resp = client._deserialize(client._transport.recv())
+                self.assertEqual(resp['type'], 'success')
+                self.assertNotIn('trace', resp)
+        finally:
+            client.close()
+
+
+class _SlowServer(ServerBase):
+    @ServerBase.endpoint('sleep')
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+        return delay
+
+
+class TestAdmissionControl(unittest.TestCase):
+    ADDR = ('127.0.0.1', 7150)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = _SlowServer(*cls.ADDR, buffer_size=1, loop=cls.loop)
+        cls.task = cls.loop.create_task(cls.server._do_run())
+        cls.thread = threading.Thread(target=cls._run, daemon=True)
+        cls.thread.start()
+        time.sleep(0.1)
+
+    @classmethod
+    def _run(cls):
+        asyncio.set_event_loop(cls.loop)
+        try:
+            cls.loop.run_until_complete(cls.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            cls.server.sock.close()
+            cls.loop.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.task.cancel)
+        cls.thread.join(1)
+
+    def _call_concurrently(self, clients_num, **client_kwargs):
+        results = []
+
+        def call():
+            client = ClientBase(*self.ADDR, **client_kwargs)
+            try:
+                results.append(client._execute('sleep', 0.05))
+            except ServerBusyError as err:
+                results.append(err)
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=call) for _ in range(clients_num)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_shed(self):
+        results = self._call_concurrently(4, busy_retries=0)
+        self.assertTrue(any(isinstance(result, ServerBusyError) for result in results))
+        self.assertIn(0.05, results)
+
+    def test_retry(self):
+        results = self._call_concurrently(4, busy_retries=10, busy_backoff=0.05)
+        self.assertEqual(results, [0.05] * 4)
+
+
+class TestFairQueue(unittest.TestCase):
+    def _drain(self, queue, num):
+        async def drain():
+            return [await queue.get() for _ in range(num)]
+
+        return asyncio.run(drain())
+
+    def test_weights(self):
+        async def fill():
+            queue = FairQueue()
+            for i in range(6):
+                await queue.put(('batch', i), flow='batch', weight=1)
+            for i in range(4):
+                await queue.put(('service', i), flow='service', weight=2)
+            return queue
+
+        queue = asyncio.run(fill())
+        served = [flow for flow, _ in self._drain(queue, 6)]
+        self.assertEqual(served.count('service'), 4)
+        self.assertEqual(served.count('batch'), 2)
+
+    def test_fifo_per_flow(self):
+        async def fill():
+            queue = FairQueue()
+            for i in range(3):
+                await queue.put(('a', i), flow='a')
+                await queue.put(('b', i), flow='b')
+            return queue
+
+        items = self._drain(asyncio.run(fill()), 6)
+        self.assertEqual([i for flow, i in items if flow == 'a'], [0, 1, 2])
+        self.assertEqual([i for flow, i in items if flow == 'b'], [0, 1, 2])
+
+    def test_rate_limit(self):
+        async def run():
+            queue = FairQueue()
+            for i in range(3):
+                await queue.put(('limited', i), flow='limited', rate=20, burst=1)
+            started = time.monotonic()
+            for _ in range(3):
+                await queue.get()
+            return time.monotonic() - started
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_rate_limited_not_ready(self):
+        async def run():
+            queue = FairQueue()
+            for i in range(2):
+                await queue.put(i, flow='limited', rate=1, burst=1)
+            self.assertTrue(queue.ready())
+            self.assertEqual(queue.get_nowait(), 0)
+
+            self.assertFalse(queue.empty())  # item is queued, but not allowed yet
+            self.assertFalse(queue.ready())
+            with self.assertRaises(asyncio.QueueEmpty):
+                queue.get_nowait()
+
+        asyncio.run(run())
+
+    def test_idle_flows_forgotten(self):
+        async def run():
+            queue = FairQueue()
+            for i in range(5):  # e.g. connections gone
+                await queue.put(i, flow=('addr', i), rate=1000, burst=1)
+                await queue.get()
+            await asyncio.sleep(0.01)  # buckets are refilled
+            await queue.put(5, flow=('addr', 5), rate=1000, burst=1)
+            return len(queue._flows)
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class _BatchServer(ServerBase):
+    def __init__(self, *args, **kwargs):
+        super(_BatchServer, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    @ServerBase.endpoint('add', batch='add_batch')
+    async def add(self, a, b):
+        return a + b
+
+    async def add_batch(self, requests):
+        self.batches.append(len(requests))
+        results = []
+        for args, kwargs in requests:
+            try:
+                results.append(await self.add.method(self, *args, **kwargs))
+            except TypeError as err:
+                results.append(err)
+        return results
+
+
+class TestWriteCoalescing(unittest.TestCase):
+    ADDR = ('127.0.0.1', 7152)
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = _BatchServer(*self.ADDR, buffer_size=64, loop=self.loop, max_in_flight=64)
+        self.server._batch_window = 0.05
+        self.task = self.loop.create_task(self.server._do_run())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        time.sleep(0.1)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.server.sock.close()
+            self.loop.close()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join(1)
+
+    def test_coalesce(self):
+        results = {}
+
+        def call(i):
+            client = ClientBase(*self.ADDR)
+            try:
+                results[i] = client._execute('add', i, b=1)
+                try:
+                    client._execute('add', i)
+                except Exception as err:
+                    results[-i - 1] = err
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual({i: results[i] for i in range(8)}, {i: i + 1 for i in range(8)})
+        self.assertEqual(len([key for key in results if key < 0]), 8)
+        self.assertTrue(any(size > 1 for size in self.server.batches))
+        self.assertGreater(self.server.metrics_snapshot()['coalesced'], 1)
+        self.assertEqual(self.server.metrics_snapshot()['endpoints']['add']['requests'], 16)
+
+    def test_rate_limited_pipeline(self):
+        client = ClientBase(*self.ADDR)
+        try:
+            with mock.patch.object(settings, 'QOS', {None: {'rate': 20, 'burst': 1}}):
+                client.connect()
+                client._transport.settimeout(5)  # dead server isn't waited forever
+                for i in range(3):  # queued behind each other in one rate limited flow
+                    client._transport.send(client._serialize({'endpoint': 'add', 'args': [i, 1], 'kwargs': {}}))
+                results = [client._deserialize(client._transport.recv())['message'] for _ in range(3)]
+        finally:
+            client.close()
+
+        self.assertEqual(results, [1, 2, 3])
+        self.assertFalse(self.task.done())
+
+
+class TestResponseTemplates(unittest.TestCase):
+    def test_render_matches_json(self):
+        server = _SlowServer('127.0.0.1', 7151, buffer_size=2, loop=asyncio.new_event_loop())
+        try:
+            for message, trace in [(None, None), ({'a': [1, 'b']}, None), ('x"y', {'id': 'abc'})]:
+                expected = {"type": "success", "message": message}
+                if trace is not None:
+                    expected['trace'] = trace
+                self.assertEqual(server._handle_success_resp(message, trace), json.dumps(expected))
+
+            self.assertEqual(server._handle_error_resp(KeyError('key')),
+                             json.dumps({"type": "error", "message": ('key',)}))
+        finally:
+            server.sock.close()
+
+
+class TestCompression(unittest.TestCase):
+    PAYLOAD = b'{"record": "' + b'lorem ipsum ' * 100 + b'"}'
+
+    def _exchange(self, client, server):
+        left, right = socket.socketpair()
+        try:
+            client.do_send(self.PAYLOAD, left)
+            self.assertEqual(server.do_recv(right), self.PAYLOAD)
+            server.do_send(self.PAYLOAD, right)
+            prefix = left.recv(server._prefix.size, socket.MSG_PEEK)
+            self.assertEqual(client.do_recv(left), self.PAYLOAD)
+        finally:
+            left.close()
+            right.close()
+
+        return server._prefix.unpack(prefix)
+
+    def test_negotiated(self):
+        length, flags = self._exchange(Protocol(compress_threshold=64), Protocol(compress_threshold=64))
+        self.assertTrue(flags & FLAG_COMPRESSED)
+        self.assertLess(length, len(self.PAYLOAD) / 5)
+
+    def test_decompressed_size_limited(self):
+        payload = zlib.compress(b'\0' * 1024)  # tiny frame, large once decompressed
+        left, right = socket.socketpair()
+        try:
+            protocol = Protocol(compress_threshold=64)
+            left.sendall(protocol._prefix.pack(len(payload), FLAG_COMPRESSED) + payload)
+            with mock.patch.object(settings, 'MAX_FRAME_SIZE', 512):
+                with self.assertRaises(AssertionError):
+                    protocol.do_recv(right)
+        finally:
+            left.close()
+            right.close()
+
+    def test_peer_without_compression(self):
+        length, flags = self._exchange(Protocol(), Protocol(compress_threshold=64))
+        self.assertFalse(flags & FLAG_COMPRESSED)
+        self.assertEqual(length, len(self.PAYLOAD))
+
+
+class TestFraming(unittest.TestCase):
+    def test_header(self):
+        protocol = Protocol()
+        self.assertEqual(protocol._pack(b'abc'), b'\x03' + b'\x00' * 7 + b'\x00' + b'abc')
+
+    def test_stream(self):
+        protocol = Protocol(buffer_size=7)
+        left, right = socket.socketpair()
+        try:
+            sender = threading.Thread(target=protocol.send_stream, args=([b'ab', b'', b'cde' * 10], left))
+            sender.start()
+            chunks = list(protocol.recv_stream(right))
+            sender.join()
+        finally:
+            left.close()
+            right.close()
+
+        self.assertEqual(chunks, [b'ab', b'cde' * 10])
+
+    def test_message_is_not_chunk(self):
+        protocol = Protocol()
+        left, right = socket.socketpair()
+        try:
+            protocol.do_send(b'message', left)
+            with self.assertRaises(AssertionError):
+                list(protocol.recv_stream(right))
+        finally:
+            left.close()
+            right.close()
+
+    def test_async_recv(self):
+        async def recv(sock):
+            protocol = AsyncProtocol(buffer_size=3, loop=asyncio.get_running_loop())
+            return await protocol.do_recv(sock)
+
+        left, right = socket.socketpair()
+        right.setblocking(False)
+        try:
+            left.sendall(Protocol()._pack(b'hello world'))  # prefix and payload arrive in several reads
+            self.assertEqual(asyncio.run(recv(right)), b'hello world')
+        finally:
+            left.close()
+            right.close()
+
+    def test_frame_too_large(self):
+        async def recv_stream_protocol():
+            reader = asyncio.StreamReader()
+            reader.feed_data(Protocol()._prefix.pack(2 ** 40, 0))  # never read
+            await StreamProtocol().do_recv(reader)
+
+        left, right = socket.socketpair()
+        try:
+            with mock.patch.object(settings, 'MAX_FRAME_SIZE', 16):
+                Protocol().do_send(b'x' * 17, left)
+                with self.assertRaises(AssertionError):
+                    Protocol().do_recv(right)
+                with self.assertRaises(AssertionError):
+                    asyncio.run(recv_stream_protocol())
+        finally:
+            left.close()
+            right.close()
+
+
+class TestBlobStreaming(unittest.TestCase):
+    ADDR = ('127.0.0.1', 7153)
+    INDEX = 'blobs'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = ShardServer(*cls.ADDR, loop=cls.loop, start=0.0, end=1.0, max_size=64 * 1024 * 1024)
+        cls.task = cls.loop.create_task(cls.server._do_run())
+        cls.thread = threading.Thread(target=cls._run, daemon=True)
+        cls.thread.start()
+        time.sleep(0.1)
+        cls.client = ShardClient(*cls.ADDR)
+        cls.client.create_index(cls.INDEX)
+
+    @classmethod
+    def _run(cls):
+        asyncio.set_event_loop(cls.loop)
+        try:
+            cls.loop.run_until_complete(cls.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            cls.server.sock.close()
+            cls.loop.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.loop.call_soon_threadsafe(cls.task.cancel)
+        cls.thread.join(1)
+
+    def test_write_and_read(self):
+        blob = bytes(range(256)) * 20000
+        self.assertEqual(self.client.write_blob(self.INDEX, 'large', 0.5, io.BytesIO(blob), chunk_size=65536),
+                         len(blob))
+        self.assertEqual(self.client.write_blob(self.INDEX, 'large', 0.5, b'other'), 0)
+
+        file = io.BytesIO()
+        self.assertEqual(self.client.read_blob(self.INDEX, 'large', file), {'hash_': 0.5, 'size': len(blob)})
+        self.assertEqual(file.getvalue(), blob)
+        self.assertEqual(self.client.read_blob(self.INDEX, 'large')['blob'], blob)
+
+        self.assertEqual(self.client.remove_blob(self.INDEX, 'large'), len(blob))
+        self.assertIsNone(self.client.read_blob(self.INDEX, 'large'))
+
+    def test_error_keeps_connection(self):
+        with self.assertRaises(ClientError):
+            self.client.write_blob('missing', 'key', 0.5, b'value')
+        self.assertIsNone(self.client.read_blob(self.INDEX, 'missing'))
+
+
+class TestMaintenance(unittest.TestCase):
+    ADDR = ('127.0.0.1', 7154)
+    INDEX = 'test'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.dump_path = os.path.join(cls.tmp.name, 'dump.json')
+        cls.loop = asyncio.new_event_loop()
+        cls.server = ShardServer(*cls.ADDR, loop=cls.loop, start=0.0, end=1.0, max_size=1024 * 1024,
+                                 bins_num=2, dump_filepath=cls.dump_path)
+        cls.task = cls.loop.create_task(cls.server._do_run())
+        cls.thread = threading.Thread(target=cls._run, daemon=True)
+        cls.thread.start()
+        time.sleep(0.1)
+        cls.client = ShardClient(*cls.ADDR)
+        cls.client.create_index(cls.INDEX)
+        for i in range(10):
+            cls.client.write(cls.INDEX, f'key{i}', i / 10, i)
+
+    @classmethod
+    def _run(cls):
+        asyncio.set_event_loop(cls.loop)
+        try:
+            cls.loop.run_until_complete(cls.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            cls.server.sock.close()
+            cls.loop.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.loop.call_soon_threadsafe(cls.task.cancel)
+        cls.thread.join(1)
+        cls.tmp.cleanup()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(5)
+
+    def test_update_distr(self):
+        self.assertFalse(self.server._routes['update_distr'].exclusive)
+        update_distr = self.server._dispatch('update_distr')
+
+        async def concurrently():
+            return await asyncio.gather(update_distr(), update_distr())
+
+        with mock.patch.object(settings, 'MAINTENANCE_CHUNK_SIZE', 3):
+            self._call(concurrently())
+
+        self.assertEqual(self.client.get_stat()['distribution'], {'0.0': 5, '0.5': 5})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork is not available')
+    def test_snapshot(self):
+        snapshot = self.server._dispatch('snapshot')
+
+        async def twice():  # second call comes before snapshot task gets to run
+            return await snapshot(), await snapshot()
+
+        self.assertEqual(self._call(twice()), (True, False))
+        while self.client.get_stat()['snapshot']['running']:
+            time.sleep(0.01)
+
+        self.assertTrue(self.client.get_stat()['snapshot']['last']['ok'])
+        with open(self.dump_path) as f:
+            self.assertEqual(len(json.load(f)['storage'][self.INDEX]), 10)
+
+
+class TestFanOut(unittest.TestCase):
+    ADDR = ('127.0.0.1', 7155)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = ShardServer(*cls.ADDR, loop=cls.loop, start=0.0, end=0.5, max_size=1024 * 1024)
+        cls.server._shard.name = 'shard0'
+        cls.task = cls.loop.create_task(cls.server._do_run())
+        cls.thread = threading.Thread(target=cls._run, daemon=True)
+        cls.thread.start()
+        time.sleep(0.1)
+
+    @classmethod
+    def _run(cls):
+        asyncio.set_event_loop(cls.loop)
+        try:
+            cls.loop.run_until_complete(cls.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            cls.server.sock.close()
+            cls.loop.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.task.cancel)
+        cls.thread.join(1)
+
+    def setUp(self):
+        self.silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # accepts connections, never answers
+        self.silent.bind(('127.0.0.1', 0))
+        self.silent.listen(8)
+        self.master = Master(_Shards({0.0: ShardClient(*self.ADDR), 0.5: ShardClient(*self.silent.getsockname())}))
+
+    def tearDown(self):
+        self.master.close()
+        self.silent.close()
+
+    def test_partial_failure(self):
+        with mock.patch.object(settings, 'FAN_OUT_TIMEOUT', 0.2):
+            started = time.time()
+            stat = self.master.stat()
+            self.assertLess(time.time() - started, 1)
+
+            with self.assertRaises(FanOutError) as context:
+                self.master.create_index('fan_out')
+
+            started = time.time()
+            with self.assertRaises(FanOutError):  # partial aggregate would be wrong
+                self.master.aggregate('fan_out', {'n': ['count', None]})
+            self.assertLess(time.time() - started, 1)
+
+        self.assertEqual(list(stat['shards']), ['shard0'])
+        self.assertEqual([error['addr'] for error in stat['errors']], [self.silent.getsockname()])
+        self.assertEqual(list(context.exception.errors), [self.silent.getsockname()])
+        self.assertIsInstance(context.exception.errors[self.silent.getsockname()], ClientTimeoutError)
+        self.assertIn('fan_out', self.server._shard.storage.indexes)
+
+    def test_name_cached(self):
+        shard = ShardClient(*self.ADDR)
+        self.assertEqual(shard.name, 'shard0')
+        shard.close()  # cached name doesn't need connection
+        self.assertEqual(shard.name, 'shard0')
@@ -0,0 +1,409 @@
+import unittest
+from unittest import mock
+
+from pyshard.shard.shard import Shard, TransactionError, KeyLockedError
+from pyshard.shard.query import merge_aggregates
+from pyshard.utils import get_size
+from pyshard.settings import settings
+from pyshard.shard.sketch import HeavyHitters, merge_histograms, merge_heavy_hitters
+from pyshard.shard.changes import ChangeLog, ChangeLogError
+from pyshard.storage.errors import IndexNotFoundError
+
+
+class TestShardQuery(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = Shard(start=0.0, end=1.0, max_size=1024 * 1024)
+        self.shard.create_index(self.TEST_INDEX, {'kind': 'hash'})
+        for i in range(6):
+            self.shard.write(self.TEST_INDEX, f'key{i}', i / 10, {'kind': i % 2, 'n': i, 'tags': ['a', str(i)]})
+
+    def test_where(self):
+        page = self.shard.query(self.TEST_INDEX, where={'n': {'$gt': 1, '$lte': 3}})
+        self.assertEqual([key for key, _ in page['items']], ['key2', 'key3'])
+        self.assertIsNone(page['cursor'])
+
+    def test_operators(self):
+        page = self.shard.query(self.TEST_INDEX, where={'tags': {'$contains': '4'}, 'missing': {'$exists': False}})
+        self.assertEqual([key for key, _ in page['items']], ['key4'])
+
+        page = self.shard.query(self.TEST_INDEX, where={'n': {'$in': [0, 5]}})
+        self.assertEqual([key for key, _ in page['items']], ['key0', 'key5'])
+
+    def test_secondary_index_and_projection(self):
+        page = self.shard.query(self.TEST_INDEX, where={'kind': 1}, fields=['n'])
+        self.assertEqual([(key, doc['record']) for key, doc in page['items']],
+                         [('key1', {'n': 1}), ('key3', {'n': 3}), ('key5', {'n': 5})])
+
+    def test_cursor(self):
+        for where in ({'kind': 0}, {'n': {'$in': [0, 2, 4]}}):  # secondary index lookup and scan
+            keys = []
+            page = self.shard.query(self.TEST_INDEX, where=where, limit=2)
+            while True:
+                keys.extend(key for key, _ in page['items'])
+                if page['cursor'] is None:
+                    break
+                page = self.shard.query(self.TEST_INDEX, where=where, cursor=page['cursor'], limit=2)
+
+            self.assertEqual(keys, ['key0', 'key2', 'key4'])
+
+    def test_cursor_after_changes(self):
+        page = self.shard.query(self.TEST_INDEX, limit=2)
+        self.shard.pop(self.TEST_INDEX, 'key0')  # changes before cursor don't shift the next page
+        self.shard.pop(self.TEST_INDEX, 'key3')
+        self.shard.write(self.TEST_INDEX, 'key6', 0.6, {'kind': 0, 'n': 6})
+
+        page = self.shard.query(self.TEST_INDEX, cursor=page['cursor'])
+        self.assertEqual([key for key, _ in page['items']], ['key2', 'key4', 'key5', 'key6'])
+
+
+class TestShardAggregate(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shards = [Shard(start=0.0, end=1.0, max_size=1024 * 1024) for _ in range(2)]
+        for i, shard in enumerate(self.shards):
+            shard.create_index(self.TEST_INDEX)
+            for j in range(3):
+                n = i * 3 + j
+                shard.write(self.TEST_INDEX, f'key{n}', n / 10, {'category': 'odd' if n % 2 else 'even', 'price': n})
+
+    def test_merge(self):
+        metrics = {'n': ['count'], 'total': ['sum', 'price'], 'low': ['min', 'price'],
+                   'high': ['max', 'price'], 'mean': ['avg', 'price']}
+        partials = [shard.aggregate(self.TEST_INDEX, metrics) for shard in self.shards]
+
+        self.assertEqual(merge_aggregates(partials, metrics),
+                         {'n': 6, 'total': 15, 'low': 0, 'high': 5, 'mean': 2.5})
+
+    def test_group_by(self):
+        metrics = {'n': ['count'], 'total': ['sum', 'price']}
+        partials = [shard.aggregate(self.TEST_INDEX, metrics, group_by='category', where={'price': {'$gt': 0}})
+                    for shard in self.shards]
+
+        self.assertEqual(merge_aggregates(partials, metrics, group_by='category'),
+                         {'odd': {'n': 3, 'total': 9}, 'even': {'n': 2, 'total': 6}})
+
+    def test_empty(self):
+        metrics = {'n': ['count'], 'mean': ['avg', 'price']}
+        partials = [shard.aggregate(self.TEST_INDEX, metrics, where={'price': {'$gt': 100}})
+                    for shard in self.shards]
+
+        self.assertEqual(merge_aggregates(partials, metrics), {'n': 0, 'mean': None})
+
+
+class _CountingShard(Shard):
+    def __init__(self, *args, **kwargs):
+        super(_CountingShard, self).__init__(*args, **kwargs)
+        self.flushes = 0
+        flush = self.storage.flush
+
+        def counting_flush():
+            self.flushes += 1
+            flush()
+
+        self.storage.flush = counting_flush
+
+
+class TestShardWriteMany(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = _CountingShard(start=0.0, end=1.0, max_size=500)
+        self.shard.create_index(self.TEST_INDEX)
+
+    def test_group_commit(self):
+        results = self.shard.write_many([(self.TEST_INDEX, f'key{i}', i / 10, f'value{i}') for i in range(3)])
+
+        self.assertEqual(self.shard.flushes, 1)
+        self.assertTrue(all(isinstance(result, int) and result > 0 for result in results))
+        self.assertEqual(self.shard.size, sum(results))
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'key2')['record'], 'value2')
+
+    def test_item_errors(self):
+        self.shard.write(self.TEST_INDEX, 'dup', 0.1, 'value')
+        results = self.shard.write_many([(self.TEST_INDEX, 'dup', 0.1, 'other'),
+                                         ('missing', 'key', 0.1, 'value'),
+                                         (self.TEST_INDEX, 'big', 0.1, 'x' * 1000),
+                                         (self.TEST_INDEX, 'key', 0.1, 'value')])
+
+        self.assertEqual(results[0], 0)
+        self.assertIsInstance(results[1], Exception)
+        self.assertIsInstance(results[2], MemoryError)
+        self.assertGreater(results[3], 0)
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'dup')['record'], 'value')
+
+
+class TestShardUpdateDistr(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = Shard(start=0.0, end=1.0, max_size=1024 * 1024, bins_num=2)
+        self.shard.create_index(self.TEST_INDEX)
+        for i in range(10):
+            self.shard.write(self.TEST_INDEX, f'key{i}', i / 10, i)
+
+    def test_interleaved_writes(self):
+        rebuild = self.shard.iter_update_distr(chunk_size=3)
+        next(rebuild)
+        self.shard.write(self.TEST_INDEX, 'new', 0.95, 'value')
+        self.shard.pop(self.TEST_INDEX, 'key0')
+        next(rebuild)
+        self.shard.pop(self.TEST_INDEX, 'key9')
+        for _ in rebuild:
+            pass
+
+        self.assertEqual(sum(self.shard.distr.values()), 9)
+
+    def test_running(self):
+        rebuild = self.shard.iter_update_distr(chunk_size=3)
+        next(rebuild)
+        with self.assertRaises(RuntimeError):
+            next(self.shard.iter_update_distr())
+        self.shard.write(self.TEST_INDEX, 'new', 0.95, 'value')
+        for _ in rebuild:
+            pass
+
+        self.assertEqual(sum(self.shard.distr.values()), 11)
+        self.assertEqual(dict(self.shard.distr), dict(self._expected()))
+
+    def _expected(self):
+        shard = Shard(start=0.0, end=1.0, max_size=1024 * 1024, bins_num=2)
+        shard.create_index(self.TEST_INDEX)
+        for key, doc in self.shard.storage.items(self.TEST_INDEX):
+            shard.write(self.TEST_INDEX, key, doc['hash_'], doc['record'])
+        return shard.distr
+
+
+class TestShardAtomic(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = Shard(start=0.0, end=1.0, max_size=1024)
+        self.shard.create_index(self.TEST_INDEX, {'kind': 'hash'})
+
+    def test_update(self):
+        self.assertIsNone(self.shard.update(self.TEST_INDEX, 'a', {'kind': 1}))
+        self.shard.write(self.TEST_INDEX, 'a', 0.1, {'kind': 1})
+        self.assertEqual(self.shard.update(self.TEST_INDEX, 'a', {'kind': 2, 'n': 1}), 2)
+
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'a'),
+                         {'hash_': 0.1, 'record': {'kind': 2, 'n': 1}, 'version': 2})
+        self.assertEqual(self.shard.find(self.TEST_INDEX, 'kind', 1), [])
+        self.assertEqual(self.shard.size, get_size({'kind': 2, 'n': 1}))
+        self.assertEqual(self.shard.upsert(self.TEST_INDEX, 'b', 0.2, 'value'), 1)
+        self.assertEqual(self.shard.upsert(self.TEST_INDEX, 'b', 0.2, 'other'), 2)
+        self.assertEqual(sum(self.shard.distr.values()), 2)
+
+    def test_cas(self):
+        self.assertEqual(self.shard.cas(self.TEST_INDEX, 'a', 0.1, 0, 'first'), 1)
+        self.assertIsNone(self.shard.cas(self.TEST_INDEX, 'a', 0.1, 0, 'second'))
+        self.assertEqual(self.shard.cas(self.TEST_INDEX, 'a', 0.1, 1, 'second'), 2)
+        self.assertIsNone(self.shard.cas(self.TEST_INDEX, 'a', 0.1, 1, 'third'))
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'a')['record'], 'second')
+
+        with self.assertRaises(MemoryError):
+            self.shard.cas(self.TEST_INDEX, 'a', 0.1, 2, 'x' * 2048)
+
+    def test_incr(self):
+        self.assertEqual(self.shard.incr(self.TEST_INDEX, 'counter', 0.1), 1)
+        self.assertEqual(self.shard.incr(self.TEST_INDEX, 'counter', 0.1, 10), 11)
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'counter')['version'], 2)
+
+        self.shard.write(self.TEST_INDEX, 'text', 0.2, 'value')
+        with self.assertRaises(TypeError):
+            self.shard.incr(self.TEST_INDEX, 'text', 0.2)
+
+
+class TestShardCompression(unittest.TestCase):
+    TEST_INDEX = 'test'
+    RECORD = {'body': 'lorem ipsum ' * 200}
+
+    def _shard(self, **storage_kwargs):
+        shard = Shard(start=0.0, end=1.0, max_size=1024, **storage_kwargs)
+        shard.create_index(self.TEST_INDEX)
+        return shard
+
+    def test_stored_size_counted(self):
+        with self.assertRaises(MemoryError):
+            self._shard().write(self.TEST_INDEX, 'a', 0.1, self.RECORD)
+
+        shard = self._shard(compress_threshold=64)
+        size = shard.write(self.TEST_INDEX, 'a', 0.1, self.RECORD)
+        self.assertLess(size, 1024)
+        self.assertEqual(shard.size, size)
+
+        self.assertEqual(shard.update(self.TEST_INDEX, 'a', {'body': 'dolor sit amet ' * 200}), 2)
+        size = shard.size
+        self.assertEqual(shard.remove(self.TEST_INDEX, 'a'), size)
+        self.assertEqual(shard.size, 0)
+
+
+class TestShardTransactions(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = Shard(start=0.0, end=1.0, max_size=1024)
+        self.shard.create_index(self.TEST_INDEX)
+        self.shard.write(self.TEST_INDEX, 'a', 0.1, 10)
+        self.shard.write(self.TEST_INDEX, 'b', 0.2, 20)
+
+    def test_commit(self):
+        ops = [['set', self.TEST_INDEX, 'a', 0.1, 5, 1], ['remove', self.TEST_INDEX, 'b', None, None, None],
+               ['set', self.TEST_INDEX, 'c', 0.3, 'new', 0]]
+        self.assertTrue(self.shard.prepare('tx', ops))
+
+        for key in ('a', 'b', 'c'):
+            with self.assertRaises(KeyLockedError):
+                self.shard.incr(self.TEST_INDEX, key, 0.1)
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'a')['record'], 10)  # reads see committed state
+        self.shard.write(self.TEST_INDEX, 'd', 0.4, 'other key')
+
+        self.assertEqual(self.shard.commit('tx'), [2, get_size(20), 1])
+        self.assertEqual(self.shard.read(self.TEST_INDEX, 'a')['record'], 5)
+        self.assertIsNone(self.shard.read(self.TEST_INDEX, 'b'))
+        self.assertEqual(self.shard.incr(self.TEST_INDEX, 'a', 0.1), 6)
+        with self.assertRaises(TransactionError):
+            self.shard.commit('tx')
+
+    def test_conflict(self):
+        with self.assertRaises(TransactionError):
+            self.shard.prepare('tx', [['set', self.TEST_INDEX, 'a', 0.1, 5, 2]])
+        with self.assertRaises(MemoryError):
+            self.shard.prepare('tx', [['set', self.TEST_INDEX, 'a', 0.1, 'x' * 2048, None]])
+
+        self.shard.prepare('tx', [['set', self.TEST_INDEX, 'a', 0.1, 5, None]])
+        with self.assertRaises(KeyLockedError):
+            self.shard.prepare('other', [['set', self.TEST_INDEX, 'a', 0.1, 6, None]])
+        self.assertTrue(self.shard.abort('tx'))
+        self.assertFalse(self.shard.abort('tx'))
+        self.assertEqual(self.shard.size, get_size(10) + get_size(20))
+        self.assertEqual(self.shard.incr(self.TEST_INDEX, 'a', 0.1), 11)
+
+    def test_in_doubt(self):
+        self.shard.prepare('tx', [['remove', self.TEST_INDEX, 'a', None, None, None]])
+        self.assertEqual(self.shard.in_doubt(), [])
+
+        with mock.patch.object(settings, 'TRANSACTION_TIMEOUT', 0):
+            self.assertEqual(self.shard.in_doubt(), ['tx'])
+            self.assertEqual(self.shard.get_stat()['transactions'], {'prepared': 1, 'in_doubt': ['tx']})
+            with self.assertRaises(KeyLockedError):  # other shards may have committed it
+                self.shard.incr(self.TEST_INDEX, 'a', 0.1)
+            self.assertEqual(self.shard.commit('tx'), [get_size(10)])
+        self.assertIsNone(self.shard.read(self.TEST_INDEX, 'a'))
+
+
+class TestShardChanges(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def setUp(self):
+        self.shard = Shard(start=0.0, end=1.0, max_size=1024, change_log_size=100)
+        self.shard.create_index(self.TEST_INDEX)
+        self.shard.create_index('other')
+
+    def test_read_changes(self):
+        self.shard.write(self.TEST_INDEX, 'a', 0.1, 10)
+        self.shard.write('other', 'a', 0.1, 'other index')
+        self.shard.incr(self.TEST_INDEX, 'a', 0.1)
+        self.shard.pop(self.TEST_INDEX, 'a')
+        self.shard.remove(self.TEST_INDEX, 'a')  # no change of absent key
+
+        changes, offset = self.shard.read_changes(self.TEST_INDEX, 0)
+        self.assertEqual(changes, [[0, 'write', 'a', {'hash_': 0.1, 'record': 10, 'version': 1}],
+                                   [2, 'write', 'a', {'hash_': 0.1, 'record': 11, 'version': 2}],
+                                   [3, 'remove', 'a', None]])
+        self.assertEqual(offset, 4)
+        self.assertEqual(self.shard.read_changes(self.TEST_INDEX, 1, limit=1), (changes[1:2], 3))
+        self.assertEqual(self.shard.read_changes(self.TEST_INDEX, offset), ([], 4))
+        with self.assertRaises(IndexNotFoundError):
+            self.shard.read_changes('missing', 0)
+
+    def test_trimmed(self):
+        log = ChangeLog(2)
+        for key in range(5):
+            log.append(self.TEST_INDEX, 'write', key, key)
+
+        self.assertEqual(log.first_offset, 2)
+        self.assertEqual(log.read(self.TEST_INDEX, 3), ([[3, 'write', 3, 3], [4, 'write', 4, 4]], 5))
+        for offset in (1, 6):
+            with self.assertRaises(ChangeLogError):
+                log.read(self.TEST_INDEX, offset)
+
+
+class TestShardLoad(unittest.TestCase):
+    TEST_INDEX = 'test'
+
+    def _shard(self, start, end):
+        shard = Shard(start=start, end=end, max_size=1024 * 1024, load_buckets=10, hot_keys=4)
+        shard.create_index(self.TEST_INDEX)
+        return shard
+
+    def test_histogram(self):
+        shard = self._shard(0.0, 1.0)
+        size = shard.write(self.TEST_INDEX, 'a', 0.05, 'value')
+        shard.write(self.TEST_INDEX, 'b', 0.55, 'value')
+        shard.read(self.TEST_INDEX, 'a')
+        shard.read(self.TEST_INDEX, 'a')
+        shard.pop(self.TEST_INDEX, 'b')
+
+        load = shard.get_stat()['load']
+        self.assertEqual(load, {'buckets': 10, 'load': {'0': [1, size, 2, 1], '5': [0, 0, 0, 2]}})
+
+        shard.update_distr()
+        self.assertEqual(shard.get_stat()['load'], load)
+
+    def test_merge(self):
+        left, right = self._shard(0.0, 0.5), self._shard(0.5, 1.0)
+        left.write(self.TEST_INDEX, 'a', 0.05, 'value')
+        right.write(self.TEST_INDEX, 'b', 0.95, 'value')
+        for _ in range(3):
+            right.read(self.TEST_INDEX, 'b')
+
+        merged = merge_histograms([left.get_stat()['load'], right.get_stat()['load']])
+        self.assertEqual(sorted(merged['load']), ['0', '9'])
+        self.assertEqual(merged['load']['9'][2], 3)
+
+        hot = merge_heavy_hitters([left.get_stat()['hot_keys'], right.get_stat()['hot_keys']])
+        self.assertEqual(hot['items'][0], [[self.TEST_INDEX, 'b'], 4, 0])
+
+    def test_merge_missing_items(self):
+        full, partial = HeavyHitters(2), HeavyHitters(2)
+        for item in ['a', 'a', 'a', 'b', 'b', 'c']:  # 'c' took over 'b' counter
+            full.observe(item)
+        partial.observe('b')
+
+        merged = merge_heavy_hitters([full.snapshot(), partial.snapshot()], capacity=3)
+        self.assertEqual({item: (count, error) for item, count, error in merged['items']},
+                         {'a': (3, 0), 'c': (3, 2), 'b': (4, 3)})  # 'b' may be counted by 'c' in full sketch
+
+    def test_heavy_hitters(self):
+        sketch = HeavyHitters(4)
+        for i in range(1000):
+            sketch.observe('hot' if i % 3 == 0 else f'cold{i}')
+
+        item, count, error = sketch.top(1)[0]
+        self.assertEqual(item, 'hot')
+        self.assertLessEqual(count - error, 334)
+        self.assertGreaterEqual(count, 334)
+        self.assertEqual(len(sketch), 4)
+
+    def test_decay(self):
+        sketch = HeavyHitters(4, decay=100)
+        for i in range(99):
+            sketch.observe('old')
+        sketch.observe('new')
+
+        self.assertEqual(sketch.total, 50)
+        self.assertEqual(sketch.top(), [('old', 49, 0), ('new', 1, 0)])
+        self.assertEqual(sketch.share('old'), 49 / 50)
+        self.assertEqual(sketch.share('missing'), 0.0)
+
+    def test_is_hot(self):
+        shard = self._shard(0.0, 1.0)
+        shard.write(self.TEST_INDEX, 'hot', 0.5, 'value')
+        for i in range(settings.HOT_KEY_MIN_ACCESSES):
+            shard.read(self.TEST_INDEX, 'hot' if i % 2 else f'cold{i}')
+
+        self.assertTrue(shard.is_hot(self.TEST_INDEX, 'hot'))
+        self.assertFalse(shard.is_hot(self.TEST_INDEX, 'cold0'))
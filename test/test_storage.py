@@ -1,7 +1,18 @@
+import os
+import sys
+import json
+import tempfile
 import unittest
+from io import StringIO
 
-from pyshard.storage import InMemoryStorage
-from pyshard.storage.errors import IndexNotFoundError
+from pyshard.storage import InMemoryStorage, SortedStorage, LSMStorage
+from pyshard.storage.bloom import BloomFilter
+from pyshard.storage.sorted import SortedKeys, _order
+from pyshard.storage.lsm import SSTable
+from pyshard.storage.secondary import SortedIndex
+from pyshard.storage.compression import Compressed
+from pyshard.storage.errors import (IndexNotFoundError, SecondaryIndexNotFoundError, UnorderedStorageError,
+                                   UnorderableKeyError)
 
 
 class TestInMemoryStorage(unittest.TestCase):
@@ -77,3 +88,300 @@ class TestInMemoryStorage(unittest.TestCase):
 
         self.storage.drop_index(index)
         self.assertTrue(index not in self.storage.indexes)
+
+    def test_secondary_hash_index(self):
+        index = 'test'
+        self.storage.create_index(index, {'user.id': 'hash'})
+
+        self.storage.write(index, 'a', {'user': {'id': 1}})
+        self.storage.write(index, 'b', {'user': {'id': 1}})
+        self.storage.write(index, 'c', {'user': {'id': 2}})
+        self.storage.write(index, 'd', 'no user')
+
+        self.assertEqual(sorted(key for key, _ in self.storage.find(index, 'user.id', 1)), ['a', 'b'])
+
+        self.storage.pop(index, 'a')
+        self.storage.remove(index, 'c')
+        self.assertEqual(self.storage.find(index, 'user.id', 1), [('b', {'user': {'id': 1}})])
+        self.assertEqual(self.storage.find(index, 'user.id', 2), [])
+
+    def test_secondary_sorted_index(self):
+        index = 'test'
+        self.storage.create_index(index, {'ts': 'sorted'})
+
+        for key, ts in [('a', 3), ('b', 1), ('c', 2), ('d', 5)]:
+            self.storage.write(index, key, {'ts': ts})
+
+        self.assertEqual([key for key, _ in self.storage.find_range(index, 'ts', 2, 3)], ['c', 'a'])
+        self.assertEqual([key for key, _ in self.storage.find_range(index, 'ts', hi=2)], ['b', 'c'])
+
+        self.storage.pop(index, 'c')
+        self.assertEqual([key for key, _ in self.storage.find_range(index, 'ts', lo=2)], ['a', 'd'])
+
+    def test_sorted_index_chunks(self):
+        secondary = SortedIndex('ts', load=4)
+        for key in range(50):
+            secondary.add(key, {'ts': key // 10})  # equal values span chunks
+        for key in range(0, 50, 3):
+            secondary.discard(key, {'ts': key // 10})
+
+        self.assertEqual(sorted(secondary.find(2)), [key for key in range(20, 30) if key % 3])
+        self.assertEqual(sorted(secondary.find_range(1, 3)), [key for key in range(10, 40) if key % 3])
+        self.assertEqual(secondary.find(7), [])
+
+    def test_secondary_index_not_exists(self):
+        index = 'test'
+        self._create_index(index)
+
+        with self.assertRaises(SecondaryIndexNotFoundError):
+            self.storage.find(index, 'user.id', 1)
+
+    def test_secondary_index_dump(self):
+        index = 'test'
+        self.storage.create_index(index, {'user.id': 'hash'})
+        self.storage.write(index, 'a', {'user': {'id': 1}})
+
+        dump = StringIO()
+        self.storage._dump(dump)
+        dump.seek(0)
+
+        storage = InMemoryStorage()
+        storage._load_dump(dump)
+        self.assertEqual(storage.find(index, 'user.id', 1), [('a', {'user': {'id': 1}})])
+
+    def test_blob_dump(self):
+        index = 'test'
+        self.storage.create_index(index)
+        self.storage.write_blob(index, 'a', {'hash_': 0.1, 'blob': b'\x00\xff'})
+
+        dump = StringIO()
+        self.storage._dump(dump)
+        dump.seek(0)
+
+        storage = InMemoryStorage()
+        storage._load_dump(dump)
+        self.assertEqual(storage.read_blob(index, 'a'), {'hash_': 0.1, 'blob': b'\x00\xff'})
+        self.assertIsNone(storage.read(index, 'a'))
+
+    def test_chunked_values(self):
+        index = 'test'
+        self.storage.create_index(index)
+        for i in range(5):
+            self.storage.write(index, f'key{i}', {'hash_': i / 10})
+        self.storage.write_blob(index, 'blob', {'hash_': 0.9, 'blob': b''})
+
+        chunks = self.storage.chunked_values(2)
+        first = next(chunks)
+        self.storage.write(index, 'late', {'hash_': 0.5})  # written after snapshot is taken
+        docs = first + [doc for chunk in chunks for doc in chunk]
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(sorted(doc['hash_'] for doc in docs), [0.0, 0.1, 0.2, 0.3, 0.4, 0.9])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork is not available')
+    def test_snapshot(self):
+        index = 'test'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dump.json')
+            storage = InMemoryStorage(dump_filepath=path)
+            storage.create_index(index)
+            storage.write(index, 'a', 'value')
+
+            pid = storage.snapshot()
+            storage.write(index, 'b', 'after snapshot')
+            _, status = os.waitpid(pid, 0)
+
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+            with open(path) as f:
+                self.assertEqual(json.load(f)['storage'], {index: {'a': 'value'}})
+            self.assertEqual(os.listdir(tmp), ['dump.json'])
+
+    def test_bloom(self):
+        index = 'test'
+        self._create_index(index)
+        for i in range(3000):  # filter is rebuilt for more keys
+            self.storage.write(index, i, 'value')
+
+        bloom = BloomFilter.from_dict(self.storage.bloom(index))
+        self.assertTrue(all(i in bloom for i in range(3000)))
+        self.assertGreaterEqual(self.storage._filters[index].capacity, 3000)
+
+        for i in range(2000):
+            self.storage.pop(index, i)
+        self.assertTrue(self.storage._filters[index].stale)
+        bloom = BloomFilter.from_dict(self.storage.bloom(index))  # rebuilt without removed keys
+        self.assertTrue(all(i in bloom for i in range(2000, 3000)))
+        self.assertLess(sum(i in bloom for i in range(2000)), 100)
+
+
+class TestCompressedStorage(unittest.TestCase):
+    INDEX = 'test'
+
+    def setUp(self):
+        self.storage = InMemoryStorage(compress_threshold=64)
+        self.storage.create_index(self.INDEX, {'kind': 'hash'})
+        self.large = {'kind': 'text', 'body': 'lorem ipsum ' * 100}
+        self.storage.write(self.INDEX, 'large', self.large)
+        self.storage.write(self.INDEX, 'small', {'kind': 'text'})
+
+    def test_compressed_at_rest(self):
+        stored = self.storage._storage[self.INDEX]
+        self.assertIsInstance(stored['large'], Compressed)
+        self.assertLess(sys.getsizeof(stored['large']), len(self.large['body']) / 5)
+        self.assertEqual(stored['small'], {'kind': 'text'})
+
+    def test_read(self):
+        self.assertEqual(self.storage.read(self.INDEX, 'large'), self.large)
+        self.assertEqual(dict(self.storage.items(self.INDEX))['large'], self.large)
+        self.assertEqual(dict(self.storage.find(self.INDEX, 'kind', 'text'))['large'], self.large)
+        self.assertEqual(self.storage.pop(self.INDEX, 'large'), self.large)
+        self.assertEqual(self.storage.find(self.INDEX, 'kind', 'text'), [('small', {'kind': 'text'})])
+
+    def test_dump(self):
+        dump = StringIO()
+        self.storage._dump(dump)
+        dump.seek(0)
+
+        storage = InMemoryStorage()
+        storage._load_dump(dump)
+        self.assertEqual(storage.read(self.INDEX, 'large'), self.large)
+
+
+class TestSortedStorage(unittest.TestCase):
+    INDEX = 'test'
+
+    def setUp(self):
+        self.storage = SortedStorage()
+        self.storage.create_index(self.INDEX)
+        for key in ['b', 'a2', 10, 'a1', 2, 'c']:
+            self.storage.write(self.INDEX, key, str(key))
+
+    def test_keys(self):
+        self.assertEqual(self.storage.keys(self.INDEX), [2, 10, 'a1', 'a2', 'b', 'c'])
+        self.storage.pop(self.INDEX, 'a2')
+        self.storage.remove(self.INDEX, 10)
+        self.assertEqual([key for key, _ in self.storage.items(self.INDEX)], [2, 'a1', 'b', 'c'])
+
+    def test_range(self):
+        self.assertEqual(self.storage.range(self.INDEX, 'a', 'b'), [('a1', 'a1'), ('a2', 'a2'), ('b', 'b')])
+        self.assertEqual(self.storage.range(self.INDEX, hi=10), [(2, '2'), (10, '10')])
+        self.assertEqual(self.storage.range(self.INDEX, limit=2, after=10), [('a1', 'a1'), ('a2', 'a2')])
+        self.assertEqual(self.storage.prefix(self.INDEX, 'a'), [('a1', 'a1'), ('a2', 'a2')])
+        self.assertEqual(self.storage.prefix(self.INDEX, 'a', after='a1'), [('a2', 'a2')])
+        self.assertEqual(self.storage.prefix(self.INDEX, 'x'), [])
+
+    def test_errors(self):
+        with self.assertRaises(UnorderableKeyError):
+            self.storage.write(self.INDEX, None, 'value')
+        self.assertFalse(self.storage.has(self.INDEX, None))
+        with self.assertRaises(UnorderedStorageError):
+            InMemoryStorage().range(self.INDEX)
+
+    def test_dump(self):
+        dump = StringIO()
+        self.storage._dump(dump)
+        dump.seek(0)
+
+        storage = SortedStorage()
+        storage._load_dump(dump)
+        # json object keys are strings
+        self.assertEqual(storage.keys(self.INDEX), ['10', '2', 'a1', 'a2', 'b', 'c'])
+
+    def test_chunks(self):
+        keys = SortedKeys(load=4)
+        for key in reversed(range(50)):
+            keys.add(key)
+        for key in range(0, 50, 3):
+            keys.discard(key)
+
+        expected = [key for key in range(50) if key % 3]
+        self.assertEqual(list(keys), expected)
+        self.assertEqual(len(keys), len(expected))
+        self.assertEqual(list(keys.irange(10, 20)), [key for key in expected if 10 <= key <= 20])
+        self.assertEqual(list(keys.irange(after=44)), [46, 47, 49])
+
+
+class TestLSMStorage(unittest.TestCase):
+    INDEX = 'test'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = self._open()
+        self.storage.create_index(self.INDEX)
+
+    def tearDown(self):
+        self.storage.stop()
+        self.tmp.cleanup()
+
+    def _open(self):
+        storage = LSMStorage(self.tmp.name, memtable_size=1024, compaction_tables=3)
+        storage.start()
+        return storage
+
+    def _fill(self, n=200):
+        for i in range(n):
+            self.storage.write(self.INDEX, f'key{i:03}', {'n': i})
+        for i in range(0, n, 4):
+            self.storage.pop(self.INDEX, f'key{i:03}')
+        self.storage._jobs.join()
+
+    def test_write_and_read(self):
+        self._fill()
+
+        tables = self.storage._tables[(self.INDEX, 'docs')]
+        self.assertLess(len(tables), 3)  # compacted
+        self.assertEqual(self.storage.read(self.INDEX, 'key001'), {'n': 1})
+        self.assertIsNone(self.storage.read(self.INDEX, 'key004'))
+        self.assertFalse(self.storage.has(self.INDEX, 'key200'))
+        self.assertEqual(self.storage.write(self.INDEX, 'key001', {'n': -1}), 0)
+        self.assertEqual(len(self.storage.keys(self.INDEX)), 150)
+        self.assertEqual(self.storage.range(self.INDEX, 'key010', 'key013'),
+                         [('key010', {'n': 10}), ('key011', {'n': 11}), ('key013', {'n': 13})])
+        self.assertEqual(self.storage.prefix(self.INDEX, 'key19', limit=2, after='key193'),
+                         [('key194', {'n': 194}), ('key195', {'n': 195})])
+
+    def test_recovery(self):
+        self._fill()
+        self.storage.write_blob(self.INDEX, 'blob', {'hash_': 0.5, 'blob': b'\x00\xff'})
+        self.storage.write(self.INDEX, 'last', {'n': -1})
+        self.storage.flush()
+        keys = self.storage.keys(self.INDEX)
+
+        self.storage = self._open()  # not stopped, memtable is restored from write ahead log
+        self.assertEqual(self.storage.read(self.INDEX, 'last'), {'n': -1})
+        self.assertEqual(self.storage.read_blob(self.INDEX, 'blob'), {'hash_': 0.5, 'blob': b'\x00\xff'})
+        self.assertEqual(self.storage.keys(self.INDEX), keys)
+        self.assertIn('last', BloomFilter.from_dict(self.storage.bloom(self.INDEX)))
+        self.assertEqual(sum(map(len, self.storage.chunked_values(10))), 152)
+
+    def test_drop_index(self):
+        self.storage.write(self.INDEX, 'old', 'value')
+        self.storage.drop_index(self.INDEX)
+        self.storage.create_index(self.INDEX)
+        self.storage.flush()
+
+        self.storage = self._open()
+        self.assertIsNone(self.storage.read(self.INDEX, 'old'))
+        self.assertTrue(self.storage.empty)
+
+    def test_replaced_table_readable(self):
+        items = [(f'key{i:03}', {'n': i}) for i in range(100)]
+        table = SSTable.write(self.tmp.name, 0, 0, items, len(items))
+        table.remove()  # e.g. by compaction while reader holds old tables
+
+        self.assertEqual(table.get('key042'), {'n': 42})
+        self.assertEqual(list(table.scan(_order('key097'))), items[97:])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.for_capacity(1000)
+        for i in range(1000):
+            bloom.add(f'key{i}')
+
+        self.assertTrue(all(f'key{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other{i}' in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+        bloom.add(1)
+        restored = BloomFilter.from_dict(bloom.to_dict())
+        self.assertIn(1.0, restored)
+        self.assertIn('key1', restored)